@@ -0,0 +1,254 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import socket
+import sys
+
+from codec import CONTROL_PACKET_CONNECT_REQUEST_SIZE, OP_CONNECTION_REQUEST_APPROVED, OP_CONNECTION_REQUEST_REJECTED, OP_STEPPER_INFO_RESPONSE
+from codec import HEADER_STRUCT, CONNECT_REQUEST_FRAME, STEPPER_INFO_REQUEST_FRAME, DeviceSnapshot, PacketEncoder, decode_stepper_info_dicts
+from control import CONTROL_PORT
+
+####
+## Global Constants
+####
+
+ASYNC_CONTROL_TIMEOUT = 2.0
+
+####
+## Classes
+####
+
+class AsyncControl:
+    """
+        Creates new AsyncControl class instance, the asyncio counterpart of Control.
+        \ host: the IPv4 address of the device.
+        \ port: the port of the device.
+        \ timeout: max seconds to wait for connecting or for a response.
+    """
+    def __init__ (self, host, port = CONTROL_PORT, timeout = ASYNC_CONTROL_TIMEOUT, silent = True):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._silent = silent
+
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self._encoder = PacketEncoder ()
+
+        # Only one request / response exchange may be in progress at a time, else
+        #  concurrent coroutines would read each other's responses.
+        self._request_lock = asyncio.Lock ()
+
+        # Receives every response frame, see attach_recorder.
+        self._recorder = None
+
+    """
+        Attempts to connect the TCP stream.
+    """
+    async def tcp_connect (self):
+        self._reader, self._writer = await asyncio.wait_for (asyncio.open_connection (self._host, self._port), self._timeout)
+        self._connected = True
+
+        # Small control frames must not be held back by Nagle.
+        sock = self._writer.get_extra_info ("socket")
+        if sock != None:
+            sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if not self._silent:
+            print (f"Stream connected to {self._host}:{self._port}")
+
+    """
+        Performs the protocol-layer connection.
+    """
+    async def proto_connect (self):
+        assert (self._connected == True)
+
+        op, frame = await self._exchange (CONNECT_REQUEST_FRAME)
+
+        # Checks the response
+        if len (frame) != CONTROL_PACKET_CONNECT_REQUEST_SIZE:
+            if not self._silent:
+                print (f"Size must be 4 for {self._host}:{self._port}")
+        elif op == OP_CONNECTION_REQUEST_APPROVED:
+            if not self._silent:
+                print (f"Connection approved for {self._host}:{self._port}")
+
+            return True
+        elif op == OP_CONNECTION_REQUEST_REJECTED:
+            if not self._silent:
+                print (f"Connection rejected for {self._host}:{self._port}")
+        elif not self._silent:
+            print (f"Invalid opcode {op} for {self._host}:{self._port}")
+
+        await self.close ()
+        return False
+
+    """
+        Reads exactly one frame from the stream and returns it as (op, frame), the
+         length in the header includes the header itself.
+    """
+    async def _read_frame (self):
+        header = await asyncio.wait_for (self._reader.readexactly (HEADER_STRUCT.size), self._timeout)
+        length, op = HEADER_STRUCT.unpack (header)
+
+        if length < HEADER_STRUCT.size:
+            raise ConnectionError (f"Invalid frame length {length} from {self._host}:{self._port}")
+
+        if length > HEADER_STRUCT.size:
+            header += await asyncio.wait_for (self._reader.readexactly (length - HEADER_STRUCT.size), self._timeout)
+
+        return op, header
+
+    """
+        Sends a request and reads its response frame, as (op, frame). A timeout, a
+         cancellation or a broken stream leaves a response unread, which the next request
+         would get, so the session is closed then and later requests fail right away.
+        \ frame: the encoded request.
+    """
+    async def _exchange (self, frame):
+        async with self._request_lock:
+            if not self._connected:
+                raise ConnectionError (f"Not connected to {self._host}:{self._port}")
+
+            try:
+                self._writer.write (frame)
+                await self._writer.drain ()
+
+                return await self._read_frame ()
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.CancelledError, OSError):
+                self._abort ()
+                raise
+
+    """
+        Closes the stream without waiting, marking the session as disconnected.
+    """
+    def _abort (self):
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self._connected = False
+
+        if writer != None:
+            writer.close ()
+
+    """
+        Moves the stepper to the specified position.
+    """
+    async def send_stepper_move_to (self, stepper, pos):
+        assert (self._connected == True)
+        self._writer.write (self._encoder.move_to (stepper, pos))
+        await self._writer.drain ()
+
+    """
+        Enables / Disables specified stepper.
+    """
+    async def stepper_enable_disable (self, stepper, enabled):
+        assert (self._connected == True)
+        self._writer.write (self._encoder.enable_disable (stepper, enabled))
+        await self._writer.drain ()
+
+    """
+        Requests the stepper info, and returns the response frame, or None if the
+         device answered with something else.
+    """
+    async def _stepper_info_frame (self):
+        op, frame = await self._exchange (STEPPER_INFO_REQUEST_FRAME)
+
+        if self._recorder != None:
+            self._recorder.append (frame)
+
+        # Makes sure that it's an stepper info response.
+        if op != OP_STEPPER_INFO_RESPONSE:
+            return None
+
+        return frame
+
+    """
+        Requests the stepper info, returns the same list of dicts as Control.get_stepper_info.
+    """
+    async def get_stepper_info (self):
+        frame = await self._stepper_info_frame ()
+        if frame == None:
+            return None
+
+        # Unpacks the motor data.
+        return decode_stepper_info_dicts (frame)
+
+    """
+        Requests the stepper info, updating the given snapshot in place, or a new one.
+        \ snapshot: the DeviceSnapshot to update.
+    """
+    async def get_stepper_state (self, snapshot = None):
+        frame = await self._stepper_info_frame ()
+        if frame == None:
+            return None
+
+        if snapshot == None:
+            snapshot = DeviceSnapshot ()
+
+        snapshot.update (frame)
+        return snapshot
+
+    """
+        Attaches a recorder, which gets every stepper info response frame appended.
+        \ recorder: the TelemetryRecorder, or None to detach.
+    """
+    def attach_recorder (self, recorder):
+        self._recorder = recorder
+
+    """
+        Closes the stream.
+    """
+    async def close (self):
+        if self._writer == None:
+            return
+
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self._connected = False
+
+        writer.close ()
+        try:
+            await writer.wait_closed ()
+        except (ConnectionError, OSError):
+            pass
+
+####
+## Testing Code
+####
+
+"""
+    Connects to every given host and polls them all concurrently from one loop.
+"""
+async def _main (hosts):
+    controls = [ AsyncControl (host, silent = False) for host in hosts ]
+
+    await asyncio.gather (*[ control.tcp_connect () for control in controls ])
+    approved = await asyncio.gather (*[ control.proto_connect () for control in controls ])
+    controls = [ control for control, ok in zip (controls, approved) if ok ]
+
+    for control, steppers in zip (controls, await asyncio.gather (*[ control.get_stepper_info () for control in controls ])):
+        print (f"{control._host}:{control._port} {steppers}")
+
+    await asyncio.gather (*[ control.close () for control in controls ])
+
+if __name__ == "__main__":
+    asyncio.run (_main (sys.argv[1:]))
@@ -0,0 +1,320 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import time
+import traceback
+
+import bench_codec
+
+from control import Control
+from discovery import Discovery
+from pool import ControlPool
+from simulator import SIMULATOR_STEPPERS, Simulator, raise_fd_limit
+
+####
+## Global Constants
+####
+
+# Not the real ports, so the discovery broadcasts don't reach real devices on the network.
+BENCH_CONTROL_PORT = 9085
+BENCH_DISCOVERY_PORT = 9084
+
+BENCH_RTT_SAMPLES = 5000
+BENCH_MOVE_TO_DURATION = 1.0 # seconds
+BENCH_DISCOVERY_COUNTS = (1, 10, 100, 1000)
+BENCH_DISCOVERY_TIMEOUT = 2.0
+BENCH_MEMORY_DEVICES = 500
+BENCH_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+BENCH_FDS_RESERVED = 256
+
+####
+## Functions
+####
+
+"""
+    Gets the given percentile of sorted samples, by nearest rank.
+    \ samples: the sorted samples.
+    \ percentile: 0 to 100.
+"""
+def percentile (samples, percentile):
+    assert (len (samples) > 0)
+
+    index = min (len (samples) - 1, max (0, int (round (percentile / 100.0 * len (samples))) - 1))
+    return samples[index]
+
+"""
+    Gets the resident set size of this process in bytes.
+"""
+def rss_bytes ():
+    with open ("/proc/self/statm", "r") as statm:
+        return int (statm.read ().split ()[1]) * os.sysconf ("SC_PAGE_SIZE")
+
+"""
+    Runs a simulator until the stop event is set, in a separate process. If it fails to
+     start, the traceback is put on the errors queue.
+"""
+def _run_simulator (count, ready, stop, errors):
+    async def serve ():
+        simulator = Simulator (count, control_port = BENCH_CONTROL_PORT, discovery_port = BENCH_DISCOVERY_PORT)
+
+        try:
+            await simulator.start ()
+        except Exception:
+            errors.put (traceback.format_exc ())
+            await simulator.close ()
+            return
+
+        ready.set ()
+
+        try:
+            await asyncio.get_running_loop ().run_in_executor (None, stop.wait)
+        finally:
+            await simulator.close ()
+
+    asyncio.run (serve ())
+
+"""
+    Runs a simulator of count devices in a separate process while in the context, so the
+     device side doesn't compete with the benchmark for the GIL, nor shows up in its memory.
+    \ count: the number of devices.
+"""
+@contextlib.contextmanager
+def simulator_process (count):
+    ready = multiprocessing.Event ()
+    stop = multiprocessing.Event ()
+    errors = multiprocessing.Queue ()
+
+    process = multiprocessing.Process (target = _run_simulator, args = (count, ready, stop, errors), daemon = True)
+    process.start ()
+
+    try:
+        # Gives up early once the simulator failed, and reports why.
+        deadline = time.monotonic () + max (10.0, count / 100.0)
+        while not ready.wait (0.1):
+            if not errors.empty () or not process.is_alive ():
+                try:
+                    error = errors.get (timeout = 1.0)
+                except queue.Empty:
+                    error = f"exit code {process.exitcode}"
+
+                raise RuntimeError (f"Simulator of {count} devices failed to start:\n{error}")
+
+            if time.monotonic () > deadline:
+                raise TimeoutError (f"Simulator of {count} devices didn't start")
+
+        yield _device_addresses (count)
+    finally:
+        stop.set ()
+        process.join (5.0)
+        if process.is_alive ():
+            process.terminate ()
+
+"""
+    Gets the addresses the simulated devices listen on.
+"""
+def _device_addresses (count):
+    return [ device.address for device in Simulator (count).devices ]
+
+"""
+    Connects a Control to a simulated device.
+"""
+def _connect (host):
+    control = Control (host, BENCH_CONTROL_PORT)
+    control.tcp_connect ()
+    if not control.proto_connect ():
+        raise ConnectionError (f"Simulated device {host} rejected the connection")
+
+    return control
+
+"""
+    Measures the get_stepper_info round-trip time, in microseconds.
+    \ samples: the number of requests.
+"""
+def bench_rtt (samples = BENCH_RTT_SAMPLES):
+    with simulator_process (1) as hosts:
+        control = _connect (hosts[0])
+
+        try:
+            for _ in range (0, samples // 10):
+                control.get_stepper_info ()
+
+            rtts = []
+            for _ in range (0, samples):
+                start = time.perf_counter_ns ()
+                control.get_stepper_info ()
+                rtts.append (time.perf_counter_ns () - start)
+        finally:
+            control._reset ()
+
+    rtts.sort ()
+    result = { f"p{p:g}_us": percentile (rtts, p) / 1e3 for p in BENCH_PERCENTILES }
+    result["min_us"] = rtts[0] / 1e3
+    result["max_us"] = rtts[-1] / 1e3
+    result["samples"] = samples
+    return result
+
+"""
+    Measures the send_stepper_move_to rate. The commands only count once the device
+     answered a stepper info request sent after them, so all of them were processed.
+    \ duration: the seconds to send for.
+"""
+def bench_move_to (duration = BENCH_MOVE_TO_DURATION):
+    with simulator_process (1) as hosts:
+        control = _connect (hosts[0])
+
+        try:
+            count = 0
+            start = time.perf_counter ()
+            end = start + duration
+
+            while time.perf_counter () < end:
+                for i in range (0, 100):
+                    control.send_stepper_move_to (i % SIMULATOR_STEPPERS, count + i)
+                count += 100
+
+            control.get_stepper_info ()
+            elapsed = time.perf_counter () - start
+        finally:
+            control._reset ()
+
+    return { "commands_per_second": count / elapsed, "commands": count }
+
+"""
+    Measures the decode cost per stepper record, based on the codec microbenchmarks.
+"""
+def bench_decode ():
+    return { name.replace ("decode_stepper_info_", "") + "_ns_per_record": ns / bench_codec.BENCH_CODEC_STEPPERS
+        for name, ns in bench_codec.run ().items () if name.startswith ("decode_") }
+
+"""
+    Measures how long discovery takes until every device answered, per device count.
+    \ counts: the device counts.
+"""
+def bench_discovery (counts = BENCH_DISCOVERY_COUNTS):
+    results = {}
+
+    for count in counts:
+        with simulator_process (count):
+            discovery = Discovery (BENCH_DISCOVERY_PORT, BENCH_DISCOVERY_TIMEOUT)
+
+            start = time.perf_counter ()
+
+            first = None
+            last = None
+            for _ in discovery.discover (count):
+                if first == None:
+                    first = time.perf_counter () - start
+
+            if len (discovery._devices) == count:
+                last = time.perf_counter () - start
+
+            results[str (count)] = {
+                "found": len (discovery._devices),
+                "first_device_ms": None if first == None else first * 1e3,
+                "all_devices_ms": None if last == None else last * 1e3,
+            }
+
+    return results
+
+"""
+    Connects to count devices in this process, and reports the memory that took.
+"""
+def _measure_memory (kind, count, results):
+    raise_fd_limit (count + BENCH_FDS_RESERVED)
+
+    hosts = _device_addresses (count)
+    before = rss_bytes ()
+
+    if kind == "control":
+        controls = [ _connect (host) for host in hosts ]
+        for control in controls:
+            control.get_stepper_info ()
+
+        after = rss_bytes ()
+
+        for control in controls:
+            control._reset ()
+    else:
+        async def connect ():
+            pool = ControlPool ()
+            for host in hosts:
+                pool.add (host, BENCH_CONTROL_PORT)
+
+            await pool.poll_all ()
+            rss = rss_bytes ()
+            await pool.close ()
+            return rss
+
+        after = asyncio.run (connect ())
+
+    results.put ((after - before) / count)
+
+"""
+    Measures the memory per connected device, both for blocking Controls and for
+     ControlPool sessions. Each is measured in a fresh process.
+    \ count: the number of devices to connect to.
+"""
+def bench_memory (count = BENCH_MEMORY_DEVICES):
+    results = { "devices": count }
+
+    with simulator_process (count):
+        for kind in ("control", "pool"):
+            measured = multiprocessing.Queue ()
+            process = multiprocessing.Process (target = _measure_memory, args = (kind, count, measured))
+            process.start ()
+            results[f"{kind}_bytes_per_device"] = measured.get (timeout = 60.0)
+            process.join ()
+
+    return results
+
+"""
+    Runs all benchmarks, returns the results as a JSON-serializable dict.
+"""
+def run ():
+    return {
+        "version": 1,
+        "time": time.time (),
+        "python": platform.python_version (),
+        "platform": platform.platform (),
+        "rtt": bench_rtt (),
+        "move_to": bench_move_to (),
+        "decode": bench_decode (),
+        "discovery": bench_discovery (),
+        "memory": bench_memory (),
+    }
+
+####
+## Main Code
+####
+
+if __name__ == "__main__":
+    results = run ()
+
+    if len (sys.argv) > 1:
+        with open (sys.argv[1], "w") as file:
+            json.dump (results, file, indent = 4)
+
+    print (json.dumps (results, indent = 4))
@@ -0,0 +1,131 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import struct
+import timeit
+
+from codec import CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE, ControlPkt_OP
+from codec import HEADER_STRUCT, STEPPER_INFO_RECORD_STRUCT, PacketEncoder, encode_move_to_into, decode_stepper_info, decode_stepper_info_dicts, decode_stepper_info_batch, np
+
+####
+## Global Constants
+####
+
+BENCH_CODEC_STEPPERS = 6
+BENCH_CODEC_REPEAT = 5
+BENCH_CODEC_BATCH = 10_000
+
+####
+## Legacy Implementations
+####
+
+"""
+    Encodes a StepperMoveTo the way Control did before the codec module.
+"""
+def legacy_encode_move_to (stepper, pos):
+    return struct.pack ("<HHBi?", CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, ControlPkt_OP.StepperMoveTo.value, stepper, pos, False)
+
+"""
+    Decodes a StepperInfoResponse the way Control did before the codec module.
+"""
+def legacy_decode_stepper_info (data):
+    _, op = struct.unpack ("<HH", data[:4])
+
+    if op != ControlPkt_OP.StepperInfoResponse.value:
+        return None
+
+    result = []
+    start = 4
+    while True:
+        motor, flags, target_pos, current_pos, min_speed, current_speed, target_speed, has_next = struct.unpack("<BBiiHHH?", data[start:start + 17])
+
+        result.append ({
+            "motor": motor,
+            "flags": flags,
+            "target_pos": target_pos,
+            "current_pos": current_pos,
+            "min_speed": min_speed,
+            "current_speed": current_speed,
+            "max_speed": target_speed
+        })
+
+        if not has_next:
+            break
+        else:
+            start = start + 17
+
+    return result
+
+####
+## Functions
+####
+
+"""
+    Builds a StepperInfoResponse frame with the given number of steppers.
+    \ steppers: number of stepper records.
+"""
+def make_stepper_info_frame (steppers = BENCH_CODEC_STEPPERS):
+    frame = bytearray (HEADER_STRUCT.size + steppers * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE)
+    HEADER_STRUCT.pack_into (frame, 0, len (frame), ControlPkt_OP.StepperInfoResponse.value)
+
+    for i in range (0, steppers):
+        STEPPER_INFO_RECORD_STRUCT.pack_into (frame, HEADER_STRUCT.size + i * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE,
+            i, 0b101, 10_000 + i, 5_000 - i, 100, 800, 1600, i + 1 < steppers)
+
+    return bytes (frame)
+
+"""
+    Gets the best-of-N time of a callable, in nanoseconds per call.
+    \ func: the callable to time.
+"""
+def ns_per_call (func):
+    timer = timeit.Timer (func)
+    number, _ = timer.autorange ()
+    return min (timer.repeat (BENCH_CODEC_REPEAT, number)) / number * 1e9
+
+"""
+    Runs the codec microbenchmarks, returns a dict of name to ns per packet.
+"""
+def run ():
+    frame = make_stepper_info_frame ()
+    encoder = PacketEncoder ()
+    buffer = bytearray (CONTROL_PACKET_MOTOR_MOVE_TO_SIZE)
+
+    results = {
+        "encode_move_to_legacy": ns_per_call (lambda: legacy_encode_move_to (3, 123_456)),
+        "encode_move_to_encoder": ns_per_call (lambda: encoder.move_to (3, 123_456)),
+        "encode_move_to_into": ns_per_call (lambda: encode_move_to_into (buffer, 0, 3, 123_456)),
+        "decode_stepper_info_legacy": ns_per_call (lambda: legacy_decode_stepper_info (frame)),
+        "decode_stepper_info_dicts": ns_per_call (lambda: decode_stepper_info_dicts (frame)),
+        "decode_stepper_info_records": ns_per_call (lambda: decode_stepper_info (frame)),
+    }
+
+    # The batch decoder is timed per batch, and reported per packet.
+    if np != None:
+        frames = [ frame ] * BENCH_CODEC_BATCH
+        results["decode_stepper_info_batch"] = ns_per_call (lambda: decode_stepper_info_batch (frames)) / BENCH_CODEC_BATCH
+
+    return results
+
+####
+## Main Code
+####
+
+if __name__ == "__main__":
+    for name, ns in run ().items ():
+        print (f"{name:32} {ns:10.1f} ns/packet")
@@ -0,0 +1,372 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import enum
+import struct
+import time
+
+# NumPy is optional, it's only needed for the batch decoder.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+####
+## Global Constants
+####
+
+CONTROL_PACKET_CONNECT_REQUEST_SIZE = 4 # uint16_t + uint16_t
+CONTROL_PACKET_MOTOR_MOVE_TO_SIZE = 10 # uint16_t (2) + uint16_t (2) + uint8_t (1) + uint32_t (4) + bool (1) = 10
+CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE = 7 # uint16_t (2) + uint16_t (2) + uint8_t (1) + bool (1) + bool (1) = 6
+CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE = 17 # uint8_t (1) + uint8_t (1) + int32_t (4) * 2 + uint16_t (2) * 3 + bool (1) = 17
+
+CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED = (1 << 0)
+CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC = (1 << 1)
+CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING = (1 << 2)
+
+####
+## Enums
+####
+
+class ControlPkt_OP (enum.Enum):
+    ConnectionRequest = 0
+    ConnectionRequestApproved = 1
+    ConnectionRequestRejected = 2
+    StepperInfoRequest = 4
+    StepperMoveTo = 5
+    StepperEnableDisable = 6
+    StepperInfoResponse = 7
+
+####
+## Precompiled Packets
+####
+
+# Plain integer opcodes, so the hot paths don't pay for an enum attribute lookup.
+OP_CONNECTION_REQUEST = ControlPkt_OP.ConnectionRequest.value
+OP_CONNECTION_REQUEST_APPROVED = ControlPkt_OP.ConnectionRequestApproved.value
+OP_CONNECTION_REQUEST_REJECTED = ControlPkt_OP.ConnectionRequestRejected.value
+OP_STEPPER_INFO_REQUEST = ControlPkt_OP.StepperInfoRequest.value
+OP_STEPPER_MOVE_TO = ControlPkt_OP.StepperMoveTo.value
+OP_STEPPER_ENABLE_DISABLE = ControlPkt_OP.StepperEnableDisable.value
+OP_STEPPER_INFO_RESPONSE = ControlPkt_OP.StepperInfoResponse.value
+
+HEADER_STRUCT = struct.Struct ("<HH")
+MOVE_TO_STRUCT = struct.Struct ("<HHBi?")
+ENABLE_DISABLE_STRUCT = struct.Struct ("<HHB??")
+STEPPER_INFO_RECORD_STRUCT = struct.Struct ("<BBiiHHH?")
+
+# Mirrors STEPPER_INFO_RECORD_STRUCT, a list dtype is packed so the itemsize is 17.
+if np != None:
+    STEPPER_INFO_DTYPE = np.dtype ([
+        ("motor", "u1"),
+        ("flags", "u1"),
+        ("target_pos", "<i4"),
+        ("current_pos", "<i4"),
+        ("min_speed", "<u2"),
+        ("current_speed", "<u2"),
+        ("max_speed", "<u2"),
+        ("has_next", "?")
+    ])
+else:
+    STEPPER_INFO_DTYPE = None
+
+# Packets without a body never change, so they're encoded once.
+CONNECT_REQUEST_FRAME = HEADER_STRUCT.pack (CONTROL_PACKET_CONNECT_REQUEST_SIZE, OP_CONNECTION_REQUEST)
+STEPPER_INFO_REQUEST_FRAME = HEADER_STRUCT.pack (CONTROL_PACKET_CONNECT_REQUEST_SIZE, OP_STEPPER_INFO_REQUEST)
+
+####
+## Classes
+####
+
+class StepperState:
+    """
+        Creates new stepper state record, as decoded from a StepperInfoResponse.
+    """
+    __slots__ = ("motor", "flags", "target_pos", "current_pos", "min_speed", "current_speed", "max_speed")
+
+    def __init__ (self, motor = 0, flags = 0, target_pos = 0, current_pos = 0, min_speed = 0, current_speed = 0, max_speed = 0):
+        self.motor = motor
+        self.flags = flags
+        self.target_pos = target_pos
+        self.current_pos = current_pos
+        self.min_speed = min_speed
+        self.current_speed = current_speed
+        self.max_speed = max_speed
+
+    """
+        Checks if the stepper is enabled.
+    """
+    @property
+    def enabled (self):
+        return (self.flags & CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED) != 0
+
+    """
+        Checks if the stepper is in automatic mode.
+    """
+    @property
+    def automatic (self):
+        return (self.flags & CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC) != 0
+
+    """
+        Checks if the stepper is moving.
+    """
+    @property
+    def moving (self):
+        return (self.flags & CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING) != 0
+
+    """
+        Gets the record as the dict layout returned by Control.get_stepper_info.
+    """
+    def as_dict (self):
+        return {
+            "motor": self.motor,
+            "flags": self.flags,
+            "target_pos": self.target_pos,
+            "current_pos": self.current_pos,
+            "min_speed": self.min_speed,
+            "current_speed": self.current_speed,
+            "max_speed": self.max_speed
+        }
+
+    def __repr__ (self):
+        return f"StepperState(motor={self.motor}, flags={self.flags}, target_pos={self.target_pos}, current_pos={self.current_pos}, min_speed={self.min_speed}, current_speed={self.current_speed}, max_speed={self.max_speed})"
+
+class DeviceSnapshot:
+    """
+        Creates new device snapshot, holding the latest state of every stepper on a device.
+        Updating it overwrites the existing StepperState records in place, so polling
+         doesn't allocate new records (or dicts) once the stepper count is known.
+    """
+    __slots__ = ("steppers", "generation", "timestamp")
+
+    def __init__ (self):
+        self.steppers = []
+        self.generation = 0
+        self.timestamp = None
+
+    """
+        Updates the snapshot from a StepperInfoResponse frame.
+        \ frame: the whole frame, including its header.
+        \ timestamp: when the frame was received, defaults to now.
+    """
+    def update (self, frame, timestamp = None):
+        steppers = self.steppers
+        count = 0
+
+        for record in STEPPER_INFO_RECORD_STRUCT.iter_unpack (_stepper_info_records (frame)):
+            if count == len (steppers):
+                steppers.append (StepperState ())
+
+            state = steppers[count]
+            state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed, has_next = record
+            count += 1
+
+            if not has_next:
+                break
+
+        # The device reported fewer steppers than last time.
+        if count < len (steppers):
+            del steppers[count:]
+
+        self.generation += 1
+        self.timestamp = time.monotonic () if timestamp == None else timestamp
+
+    """
+        Checks if any stepper is moving.
+    """
+    def any_moving (self):
+        for state in self.steppers:
+            if state.flags & CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING:
+                return True
+
+        return False
+
+class PacketEncoder:
+    """
+        Creates new packet encoder, which packs commands into buffers it owns and reuses.
+        The returned buffers are only valid until the next call of the same method.
+    """
+    def __init__ (self):
+        self._move_to = bytearray (CONTROL_PACKET_MOTOR_MOVE_TO_SIZE)
+        self._enable_disable = bytearray (CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE)
+
+    """
+        Encodes a StepperMoveTo packet.
+        \ stepper: the stepper index.
+        \ pos: the target position.
+    """
+    def move_to (self, stepper, pos):
+        MOVE_TO_STRUCT.pack_into (self._move_to, 0, CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, OP_STEPPER_MOVE_TO, stepper, pos, False)
+        return self._move_to
+
+    """
+        Encodes a StepperEnableDisable packet.
+        \ stepper: the stepper index.
+        \ enabled: enable or disable.
+    """
+    def enable_disable (self, stepper, enabled):
+        ENABLE_DISABLE_STRUCT.pack_into (self._enable_disable, 0, CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE, OP_STEPPER_ENABLE_DISABLE, stepper, enabled, False)
+        return self._enable_disable
+
+####
+## Functions
+####
+
+"""
+    Packs a StepperMoveTo packet into the given buffer, returns the offset past it.
+    \ buffer: the writable buffer.
+    \ offset: where to start writing.
+    \ stepper: the stepper index.
+    \ pos: the target position.
+"""
+def encode_move_to_into (buffer, offset, stepper, pos):
+    MOVE_TO_STRUCT.pack_into (buffer, offset, CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, OP_STEPPER_MOVE_TO, stepper, pos, False)
+    return offset + CONTROL_PACKET_MOTOR_MOVE_TO_SIZE
+
+"""
+    Packs a StepperEnableDisable packet into the given buffer, returns the offset past it.
+    \ buffer: the writable buffer.
+    \ offset: where to start writing.
+    \ stepper: the stepper index.
+    \ enabled: enable or disable.
+"""
+def encode_enable_disable_into (buffer, offset, stepper, enabled):
+    ENABLE_DISABLE_STRUCT.pack_into (buffer, offset, CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE, OP_STEPPER_ENABLE_DISABLE, stepper, enabled, False)
+    return offset + CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE
+
+"""
+    Gets a memoryview of the whole records in a StepperInfoResponse.
+    \ frame: the whole frame, including its header.
+"""
+def _stepper_info_records (frame):
+    count = (len (frame) - HEADER_STRUCT.size) // CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+    return memoryview (frame)[HEADER_STRUCT.size:HEADER_STRUCT.size + count * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE]
+
+"""
+    Yields the raw (motor, flags, target_pos, current_pos, min_speed, current_speed,
+     max_speed, has_next) tuples of a StepperInfoResponse, up to the first record
+     without has_next.
+    \ frame: the whole frame, including its header.
+"""
+def iter_stepper_info (frame):
+    for record in STEPPER_INFO_RECORD_STRUCT.iter_unpack (_stepper_info_records (frame)):
+        yield record
+
+        if not record[7]:
+            return
+
+"""
+    Decodes a StepperInfoResponse into a list of StepperState records.
+    \ frame: the whole frame, including its header.
+"""
+def decode_stepper_info (frame):
+    result = []
+
+    for record in STEPPER_INFO_RECORD_STRUCT.iter_unpack (_stepper_info_records (frame)):
+        # Bypasses __init__, assigning the slots straight from the unpacked tuple.
+        state = StepperState.__new__ (StepperState)
+        state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed, has_next = record
+        result.append (state)
+
+        if not has_next:
+            break
+
+    return result
+
+"""
+    Decodes a StepperInfoResponse into the list of dicts returned by Control.get_stepper_info.
+    \ frame: the whole frame, including its header.
+"""
+def decode_stepper_info_dicts (frame):
+    result = []
+
+    for motor, flags, target_pos, current_pos, min_speed, current_speed, max_speed, has_next in STEPPER_INFO_RECORD_STRUCT.iter_unpack (_stepper_info_records (frame)):
+        result.append ({
+            "motor": motor,
+            "flags": flags,
+            "target_pos": target_pos,
+            "current_pos": current_pos,
+            "min_speed": min_speed,
+            "current_speed": current_speed,
+            "max_speed": max_speed
+        })
+
+        if not has_next:
+            break
+
+    return result
+
+"""
+    Decodes a batch of StepperInfoResponse frames into columnar NumPy arrays, in one
+     pass without a Python loop over the records. Like decode_stepper_info, each frame
+     is decoded up to and including its first record without has_next, the records
+     after it are ignored, and a chain cut short by the frame length just ends there.
+
+    Returns a dict with the "frame" index of every record, and one array for each of
+     "motor", "flags", "target_pos", "current_pos", "min_speed", "current_speed" and
+     "max_speed".
+
+    \ frames: a sequence of whole frames, including their headers.
+"""
+def decode_stepper_info_batch (frames):
+    if np == None:
+        raise ImportError ("numpy is required for decode_stepper_info_batch")
+
+    lengths = np.fromiter (map (len, frames), dtype = np.int64, count = len (frames))
+    data = np.frombuffer (b"".join (frames), dtype = np.uint8)
+
+    if np.any (lengths < HEADER_STRUCT.size):
+        raise ValueError ("Frame shorter than its header")
+
+    starts = np.zeros (len (frames), dtype = np.int64)
+    np.cumsum (lengths[:-1], out = starts[1:])
+
+    # Makes sure we're only dealing with stepper info responses.
+    ops = data[starts + 2].astype (np.uint16) | (data[starts + 3].astype (np.uint16) << 8)
+    if np.any (ops != OP_STEPPER_INFO_RESPONSE):
+        raise ValueError ("Batch contains frames other than StepperInfoResponse")
+
+    counts = (lengths - HEADER_STRUCT.size) // CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+    frame_index = np.repeat (np.arange (len (frames), dtype = np.int64), counts)
+
+    if len (lengths) > 0 and np.all (lengths == lengths[0]):
+        # Same stepper count everywhere, the records are a plain 2D slice.
+        raw = data.reshape (len (frames), lengths[0])[:, HEADER_STRUCT.size:HEADER_STRUCT.size + counts[0] * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE]
+    else:
+        # Gathers the record bytes of each frame, skipping the headers.
+        first = np.repeat (np.cumsum (counts) - counts, counts)
+        offsets = starts[frame_index] + HEADER_STRUCT.size + (np.arange (len (frame_index), dtype = np.int64) - first) * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+        raw = data[offsets[:, None] + np.arange (CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE)]
+
+    records = np.ascontiguousarray (raw).view (STEPPER_INFO_DTYPE).reshape (-1)
+
+    # Like the scalar decoders, a frame ends at its first record without has_next, so only
+    #  the records with no chain end before them in their own frame are kept.
+    ends = np.zeros (len (records) + 1, dtype = np.int64)
+    np.cumsum (~records["has_next"], out = ends[1:])
+    keep = ends[:-1] == np.repeat (ends[np.cumsum (counts) - counts], counts)
+
+    if not np.all (keep):
+        records = records[keep]
+        frame_index = frame_index[keep]
+
+    result = { "frame": frame_index }
+    for name in STEPPER_INFO_DTYPE.names[:-1]:
+        result[name] = np.ascontiguousarray (records[name])
+
+    return result
@@ -16,10 +16,20 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import concurrent.futures
+import queue
+import selectors
 import socket
-import enum
+import threading
 import time
-import struct
+
+# The wire definitions live in codec, they're re-exported here for existing importers.
+from codec import CONTROL_PACKET_CONNECT_REQUEST_SIZE, CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE, CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED, CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC, CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING, ControlPkt_OP
+from codec import OP_CONNECTION_REQUEST, OP_CONNECTION_REQUEST_APPROVED, OP_CONNECTION_REQUEST_REJECTED, OP_STEPPER_MOVE_TO, OP_STEPPER_ENABLE_DISABLE, OP_STEPPER_INFO_RESPONSE
+from codec import HEADER_STRUCT, CONNECT_REQUEST_FRAME, STEPPER_INFO_REQUEST_FRAME, DeviceSnapshot, PacketEncoder, decode_stepper_info_dicts
+from framing import FrameDecoder, FrameError
+from stats import ControlStats
 
 ####
 ## Global Constants
@@ -27,27 +37,26 @@ import struct
 
 CONTROL_PORT = 8085
 CONTROL_STATUS_INTERVAL = 0.5
-
-CONTROL_PACKET_CONNECT_REQUEST_SIZE = 4 # uint16_t + uint16_t
-CONTROL_PACKET_MOTOR_MOVE_TO_SIZE = 10 # uint16_t (2) + uint16_t (2) + uint8_t (1) + uint32_t (4) + bool (1) = 10
-CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE = 7 # uint16_t (2) + uint16_t (2) + uint8_t (1) + bool (1) + bool (1) = 6
-
-CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED = (1 << 0)
-CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC = (1 << 1)
-CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING = (1 << 2)
+CONTROL_PIPELINE_WINDOW = 8
+CONTROL_THREAD_STOP_TIMEOUT = 1.0 # seconds the I/O thread gets to stop, before its socket is shut down
 
 ####
-## Enums
+## Functions
 ####
 
-class ControlPkt_OP (enum.Enum):
-    ConnectionRequest = 0
-    ConnectionRequestApproved = 1
-    ConnectionRequestRejected = 2
-    StepperInfoRequest = 4
-    StepperMoveTo = 5
-    StepperEnableDisable = 6
-    StepperInfoResponse = 7
+"""
+    Gets a decode function, which updates the given snapshot from a response frame.
+    \ snapshot: the DeviceSnapshot to update, or None for a new one.
+"""
+def _snapshot_decoder (snapshot):
+    if snapshot == None:
+        snapshot = DeviceSnapshot ()
+
+    def decode (frame):
+        snapshot.update (frame)
+        return snapshot
+
+    return decode
 
 ####
 ## Classes
@@ -58,14 +67,30 @@ class Control:
         Creates new Control class instance.
         \ host: the IPv4 address of the device.
         \ port: the port of the device.
+        \ pipeline_window: max number of StepperInfoRequests in flight.
     """
-    def __init__ (self, host, port = CONTROL_PORT, silent = True):
+    def __init__ (self, host, port = CONTROL_PORT, silent = True, pipeline_window = CONTROL_PIPELINE_WINDOW):
+        assert (pipeline_window >= 1)
+
         self._host = host
         self._port = port
         self._silent = silent
+        self._pipeline_window = pipeline_window
         
         self._socket = socket.socket (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         self._connected = False
+        self._decoder = FrameDecoder ()
+        self._encoder = PacketEncoder ()
+
+        # Outstanding requests as (future, decode, op, sent_ns), the device answers in order.
+        self._pending = collections.deque ()
+
+        # Always on, see stats.
+        self._stats = ControlStats ()
+        self._connect_sent_ns = 0
+
+        # Receives every response frame, see attach_recorder.
+        self._recorder = None
 
         if not self._silent:
             print (f"Socket created for {self._host}:{self._port}")
@@ -77,6 +102,9 @@ class Control:
         self._socket.connect ((self._host, self._port))
         self._connected = True
 
+        # Small, pipelined requests must not be held back by Nagle.
+        self._socket.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         if not self._silent:
             print (f"Socket connected to {self._host}:{self._port}")
     
@@ -91,23 +119,25 @@ class Control:
         Gets the connect request response, and either returns true or false.
     """
     def _connect_request_res (self):
-        data = self._socket.recv (128);
-        length, op = struct.unpack ("<HH", data[:4])
+        op, frame = self._recv_frame ()
+        self._stats.record_latency (OP_CONNECTION_REQUEST, time.perf_counter_ns () - self._connect_sent_ns)
 
         # Checks the response
-        if length != CONTROL_PACKET_CONNECT_REQUEST_SIZE:
+        if len (frame) != CONTROL_PACKET_CONNECT_REQUEST_SIZE:
+            self._stats.parse_errors += 1
             self._reset ()
 
             if not self._silent:
                 print (f"Size must be 4 for {self._host}:{self._port}")
 
             return False
-        elif op == ControlPkt_OP.ConnectionRequestApproved.value:
+        elif op == OP_CONNECTION_REQUEST_APPROVED:
             if not self._silent:
                 print (f"Connection approved for {self._host}:{self._port}")
             
             return True
-        elif op == ControlPkt_OP.ConnectionRequestRejected.value:
+        elif op == OP_CONNECTION_REQUEST_REJECTED:
+            self._stats.rejected_connections += 1
             self._reset ()
 
             if not self._silent:
@@ -115,6 +145,7 @@ class Control:
 
             return False
         else:
+            self._stats.parse_errors += 1
             self._reset ()
 
             if not self._silent:
@@ -122,13 +153,31 @@ class Control:
 
             return False
     
+    """
+        Blocks until one complete frame has been received, and returns it as (op, frame).
+    """
+    def _recv_frame (self):
+        try:
+            while True:
+                frame = self._decoder.next_frame ()
+                if frame != None:
+                    self._stats.received (frame[0], len (frame[1]))
+                    return frame
+
+                self._stats.bytes_received += self._decoder.recv_into (self._socket)
+        except FrameError:
+            self._stats.parse_errors += 1
+            raise
+
     """
         Sends the protocol layer connect request.
     """
     def _connect_request (self):
         assert (self._socket != None)
         assert (self._connected == True)
-        self._socket.send (struct.pack ("<HH", CONTROL_PACKET_CONNECT_REQUEST_SIZE, ControlPkt_OP.ConnectionRequest.value))
+        self._connect_sent_ns = time.perf_counter_ns ()
+        self._socket.sendall (CONNECT_REQUEST_FRAME)
+        self._stats.sent (OP_CONNECTION_REQUEST, len (CONNECT_REQUEST_FRAME))
     
     """
         Moves the stepper to the specified position.
@@ -136,7 +185,10 @@ class Control:
     def send_stepper_move_to (self, stepper, pos):
         assert (self._socket != None)
         assert (self._connected == True)
-        self._socket.send(struct.pack ("<HHBi?", CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, ControlPkt_OP.StepperMoveTo.value, stepper, pos, False))
+
+        frame = self._encoder.move_to (stepper, pos)
+        self._socket.sendall (frame)
+        self._stats.sent (OP_STEPPER_MOVE_TO, len (frame))
 
     """
         Enables / Disables specified stepper.
@@ -144,45 +196,186 @@ class Control:
     def stepper_enable_disable (self, stepper, enabled):
         assert (self._socket != None)
         assert (self._connected == True)
-        self._socket.send(struct.pack ("<HHB??", CONTROL_PACKET_MOTOR_ENABLE_DISABLE_SIZE, ControlPkt_OP.StepperEnableDisable.value, stepper, enabled, False))
 
-    def get_stepper_info (self):
+        frame = self._encoder.enable_disable (stepper, enabled)
+        self._socket.sendall (frame)
+        self._stats.sent (OP_STEPPER_ENABLE_DISABLE, len (frame))
+
+    """
+        Sends several encoded frames with a single vectored write.
+        \ buffers: the encoded frames.
+    """
+    def send_frames (self, buffers):
+        assert (self._socket != None)
+        assert (self._connected == True)
+
+        sent = self._socket.sendmsg (buffers)
+
+        # The kernel only takes part of it when the send buffer is full, sends the rest.
+        total = sum (len (buffer) for buffer in buffers)
+        if sent < total:
+            self._socket.sendall (b"".join (buffers)[sent:])
+
+        for buffer in buffers:
+            self._stats.sent (HEADER_STRUCT.unpack_from (buffer, 0)[1], len (buffer))
+
+    """
+        Sends a request, and queues the future its response will resolve.
+        \ frame: the encoded request.
+        \ decode: turns the response frame into the result.
+        \ future: the future to resolve, or None for a new one.
+    """
+    def _request (self, frame, decode, future = None):
         assert (self._socket != None)
         assert (self._connected == True)
-        self._socket.send (struct.pack ("<HH", CONTROL_PACKET_CONNECT_REQUEST_SIZE, ControlPkt_OP.StepperInfoRequest.value))
 
-        # Reads the data and unpacks it.
-        data = self._socket.recv (1024)
-        _, op = struct.unpack ("<HH", data[:4])
+        if future == None:
+            future = concurrent.futures.Future ()
+
+        # Requests cancelled before being sent are dropped.
+        if not future.set_running_or_notify_cancel ():
+            return future
+
+        # Waits for responses until there's room in the window.
+        while len (self._pending) >= self._pipeline_window:
+            self._pump ()
+
+        op = HEADER_STRUCT.unpack_from (frame, 0)[1]
+        sent_ns = time.perf_counter_ns ()
+
+        self._socket.sendall (frame)
+        self._pending.append ((future, decode, op, sent_ns))
+        self._stats.sent (op, len (frame))
+
+        return future
+
+    """
+        Performs a single receive, and resolves the futures of all completed responses.
+    """
+    def _pump (self):
+        try:
+            self._stats.bytes_received += self._decoder.recv_into (self._socket)
+
+            for op, frame in self._decoder:
+                self._on_frame (op, frame)
+        except FrameError as e:
+            self._stats.parse_errors += 1
+            self._fail_pending (e)
+            raise
+        except OSError as e:
+            self._fail_pending (e)
+            raise
+
+    """
+        Handles a received frame, by resolving the oldest outstanding request.
+        \ op: the frame opcode.
+        \ frame: the whole frame, including its header.
+    """
+    def _on_frame (self, op, frame):
+        received_ns = time.perf_counter_ns ()
+        self._stats.received (op, len (frame))
+
+        if self._recorder != None:
+            self._recorder.append (frame)
+
+        if len (self._pending) == 0:
+            self._stats.unexpected_frames += 1
+
+            if not self._silent:
+                print (f"Unsolicited opcode {op} from {self._host}:{self._port}")
+
+            return
+
+        future, decode, request_op, sent_ns = self._pending.popleft ()
+        self._stats.record_latency (request_op, received_ns - sent_ns)
 
         # Makes sure that it's an stepper info response.
-        if op != ControlPkt_OP.StepperInfoResponse.value:
-            return None
-        
-        # Starts unpacking the motor data
-        result = []
-        start = 4
-        while True:
-            motor, flags, target_pos, current_pos, min_speed, current_speed, target_speed, has_next = struct.unpack("<BBiiHHH?", data[start:start + 17])
+        if op != OP_STEPPER_INFO_RESPONSE:
+            self._stats.unexpected_frames += 1
+            future.set_result (None)
+            return
+
+        try:
+            future.set_result (decode (frame))
+        except Exception as e:
+            self._stats.parse_errors += 1
+            future.set_exception (e)
+
+    """
+        Fails all outstanding requests.
+        \ error: the exception to set.
+    """
+    def _fail_pending (self, error):
+        while len (self._pending) > 0:
+            future, _, _, _ = self._pending.popleft ()
+            future.set_exception (error)
+
+    """
+        Blocks until the given future has been resolved.
+        \ future: the future to wait for.
+    """
+    def _wait (self, future):
+        while not future.done ():
+            self._pump ()
+
+        return future.result ()
 
-            result.append ({
-                "motor": motor,
-                "flags": flags,
-                "target_pos": target_pos,
-                "current_pos": current_pos,
-                "min_speed": min_speed,
-                "current_speed": current_speed,
-                "max_speed": target_speed
-            })
+    """
+        Sends a StepperInfoRequest without waiting for the response, returns a future
+         which resolves to the list of dicts get_stepper_info would return. Up to
+         pipeline_window requests may be in flight, once it's full this blocks until
+         the oldest response arrives.
+    """
+    def request_stepper_info (self):
+        return self._request (STEPPER_INFO_REQUEST_FRAME, decode_stepper_info_dicts)
+
+    """
+        Sends a StepperInfoRequest without waiting for the response, returns a future
+         which resolves to the updated DeviceSnapshot.
+        \ snapshot: the DeviceSnapshot to update, or None for a new one.
+    """
+    def request_stepper_state (self, snapshot = None):
+        return self._request (STEPPER_INFO_REQUEST_FRAME, _snapshot_decoder (snapshot))
+
+    """
+        Attaches a recorder, which gets every response frame appended.
+        \ recorder: the TelemetryRecorder, or None to detach.
+    """
+    def attach_recorder (self, recorder):
+        self._recorder = recorder
+
+    """
+        Gets the connection statistics as a dict: byte, parse error and rejection counters,
+         and per op the frame counters and latency histogram (in ns).
+    """
+    def stats (self):
+        return self._stats.as_dict ()
 
-            if not has_next:
-                break
-            else:
-                start = start + 17
+    """
+        Gets the number of requests in flight.
+    """
+    def pending (self):
+        return len (self._pending)
 
-        # Returns the result.
-        return result
+    """
+        Blocks until all requests in flight have been answered.
+    """
+    def flush (self):
+        while len (self._pending) > 0:
+            self._pump ()
 
+    """
+        Gets the stepper info, as a list of dicts.
+    """
+    def get_stepper_info (self):
+        return self._wait (self.request_stepper_info ())
+
+    """
+        Gets the stepper info, updating the given snapshot in place, or a new one.
+        \ snapshot: the DeviceSnapshot to update.
+    """
+    def get_stepper_state (self, snapshot = None):
+        return self._wait (self.request_stepper_state (snapshot))
 
     """
         Resets the control class, by disconnecting the socket.
@@ -190,15 +383,260 @@ class Control:
     def _reset (self):
         assert (self._socket != None)
         assert (self._connected == True)
-        
-        self._socket.shutdown(socket.SHUT_RDWR)
+
+        # Fails if the peer reset the connection already, it gets closed all the same.
+        try:
+            self._socket.shutdown (socket.SHUT_RDWR)
+        except OSError:
+            pass
+
         self._socket.close ()
         self._socket = None
         self._connected = False
+        self._decoder.reset ()
+        self._fail_pending (ConnectionError (f"Connection to {self._host}:{self._port} reset"))
 
     """
         Makes sure the fd gets closed.
     """
     def __del__ (self):
         if self._socket != None:
-            self._socket.close ()
\ No newline at end of file
+            self._socket.close ()
+
+class ControlThread:
+    """
+        Creates new control I/O thread, which takes ownership of a connected Control so
+         any number of threads can share the session. Callers submit commands through
+         a queue.SimpleQueue, and get a concurrent.futures.Future back. The I/O thread
+         is the only one touching the socket, so frames never interleave and every
+         response resolves the future of the request it belongs to.
+
+        Once handed over, the Control must not be used directly anymore.
+
+        \ control: the connected Control.
+    """
+    def __init__ (self, control):
+        assert (control._connected == True)
+
+        self._control = control
+        self._queue = queue.SimpleQueue ()
+        self._running = True
+        self._sleeping = False
+
+        # Producers write into this pair to wake the I/O thread from select.
+        self._wake_r, self._wake_w = socket.socketpair ()
+        self._wake_r.setblocking (False)
+        self._wake_w.setblocking (False)
+
+        self._selector = selectors.DefaultSelector ()
+        self._selector.register (self._control._socket, selectors.EVENT_READ)
+        self._selector.register (self._wake_r, selectors.EVENT_READ)
+
+        self._thread = threading.Thread (target = self._run, name = f"control-{control._host}:{control._port}", daemon = True)
+        self._thread.start ()
+
+    """
+        Queues a command for the I/O thread, and returns its future.
+        \ func: called on the I/O thread with (future, *args).
+    """
+    def _submit (self, func, *args):
+        future = concurrent.futures.Future ()
+
+        if not self._running:
+            future.set_exception (ConnectionError (f"Control thread for {self._control._host}:{self._control._port} stopped"))
+            return future
+
+        self._queue.put ((func, future, args))
+
+        # The I/O thread may have stopped right after the check above.
+        if not self._running:
+            self._fail_queued ()
+
+        # Only pay for the wakeup syscall if the I/O thread is actually asleep.
+        if self._sleeping:
+            self._wake ()
+
+        return future
+
+    """
+        Wakes the I/O thread.
+    """
+    def _wake (self):
+        try:
+            self._wake_w.send (b"\0")
+        except BlockingIOError:
+            pass
+
+    """
+        Moves the stepper to the specified position, returns a future.
+    """
+    def send_stepper_move_to (self, stepper, pos):
+        return self._submit (self._do_command, Control.send_stepper_move_to, stepper, pos)
+
+    """
+        Enables / Disables specified stepper, returns a future.
+    """
+    def stepper_enable_disable (self, stepper, enabled):
+        return self._submit (self._do_command, Control.stepper_enable_disable, stepper, enabled)
+
+    """
+        Sends several encoded frames with a single vectored write, returns a future
+         resolving to the time.perf_counter_ns at which the write completed.
+        \ buffers: the encoded frames, they must stay untouched until it resolves.
+    """
+    def send_frames (self, buffers):
+        return self._submit (self._do_send_frames, buffers)
+
+    """
+        Gets the stepper info, returns a future resolving to the list of dicts.
+    """
+    def get_stepper_info (self):
+        return self._submit (self._do_request, decode_stepper_info_dicts)
+
+    """
+        Gets the stepper info, returns a future resolving to the updated DeviceSnapshot.
+        \ snapshot: the DeviceSnapshot to update, it's written from the I/O thread.
+    """
+    def get_stepper_state (self, snapshot = None):
+        return self._submit (self._do_request, _snapshot_decoder (snapshot))
+
+    """
+        Gets the connection statistics, see Control.stats.
+    """
+    def stats (self):
+        return self._control.stats ()
+
+    """
+        Stops the I/O thread, and resets the connection.
+    """
+    def close (self):
+        if self._thread.is_alive ():
+            self._submit (self._do_stop)
+            self._wake ()
+            self._thread.join (CONTROL_THREAD_STOP_TIMEOUT)
+
+        # Still blocked on the device, waiting for room in the pipeline window or in the
+        #  send buffer. Shutting the socket down fails those, which ends the thread.
+        if self._thread.is_alive ():
+            try:
+                self._control._socket.shutdown (socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            self._thread.join (CONTROL_THREAD_STOP_TIMEOUT)
+
+        if self._thread.is_alive ():
+            if not self._control._silent:
+                print (f"Control thread for {self._control._host}:{self._control._port} didn't stop")
+
+            return
+
+        if self._control._connected:
+            try:
+                self._control._reset ()
+            except OSError as e:
+                if not self._control._silent:
+                    print (f"Resetting {self._control._host}:{self._control._port} failed: {e}")
+
+        self._selector.close ()
+        self._wake_r.close ()
+        self._wake_w.close ()
+
+    """
+        Executes a command without a response.
+    """
+    def _do_command (self, future, method, *args):
+        if future.set_running_or_notify_cancel ():
+            method (self._control, *args)
+            future.set_result (None)
+
+    """
+        Executes a vectored write.
+    """
+    def _do_send_frames (self, future, buffers):
+        if future.set_running_or_notify_cancel ():
+            self._control.send_frames (buffers)
+            future.set_result (time.perf_counter_ns ())
+
+    """
+        Executes a pipelined request.
+    """
+    def _do_request (self, future, decode):
+        self._control._request (STEPPER_INFO_REQUEST_FRAME, decode, future)
+
+    """
+        Stops the I/O loop.
+    """
+    def _do_stop (self, future):
+        self._running = False
+        future.set_result (None)
+
+    """
+        Executes all queued commands.
+    """
+    def _drain_queue (self):
+        while self._running:
+            try:
+                func, future, args = self._queue.get_nowait ()
+            except queue.Empty:
+                return
+
+            try:
+                func (future, *args)
+            except Exception as e:
+                if not future.done ():
+                    future.set_exception (e)
+
+                if isinstance (e, OSError):
+                    raise
+
+    """
+        The I/O thread main loop.
+    """
+    def _run (self):
+        try:
+            while self._running:
+                self._drain_queue ()
+
+                # Announces that we're going to sleep, and checks the queue once more
+                #  so a command queued in between can't be missed.
+                self._sleeping = True
+                if not self._queue.empty () or not self._running:
+                    self._sleeping = False
+                    continue
+
+                events = self._selector.select ()
+                self._sleeping = False
+
+                for key, _ in events:
+                    if key.fileobj == self._wake_r:
+                        try:
+                            while self._wake_r.recv (4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self._control._pump ()
+        except Exception as e:
+            if not self._control._silent:
+                print (f"Control thread for {self._control._host}:{self._control._port} failed: {e}")
+
+            self._control._fail_pending (e)
+        finally:
+            self._running = False
+            self._fail_queued ()
+
+    """
+        Fails all queued commands, once the I/O thread has stopped.
+    """
+    def _fail_queued (self):
+        while True:
+            try:
+                func, future, args = self._queue.get_nowait ()
+            except queue.Empty:
+                return
+
+            if func == self._do_stop:
+                future.set_result (None)
+            elif future.set_running_or_notify_cancel ():
+                future.set_exception (ConnectionError (f"Control thread for {self._control._host}:{self._control._port} stopped"))
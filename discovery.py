@@ -16,11 +16,23 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
 import enum
+import ipaddress
+import random
 import socket
 import struct
+import sys
+import threading
 import time
-import select
+import selectors
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from stats import DiscoveryStats
 
 ####
 ## Global Constants
@@ -29,6 +41,26 @@ import select
 DISCOVERY_PORT = 8084
 DISCOVERY_TIMEOUT = 0.5
 DISCOVERY_PACKET_COUNT = 2
+DISCOVERY_RECV_BUFFER = 1024 * 1024 # responses of large fleets arrive in one burst
+
+DISCOVERY_SERVICE_INTERVAL = 2.0 # seconds between probes after a change
+DISCOVERY_SERVICE_MAX_INTERVAL = 30.0 # seconds between probes once nothing changes
+DISCOVERY_SERVICE_JITTER = 0.2 # fraction of the interval
+DISCOVERY_SERVICE_TTL = 95.0 # seconds without a response before a device is removed
+
+DISCOVERY_EVENT_ADDED = "added"
+DISCOVERY_EVENT_REMOVED = "removed"
+DISCOVERY_EVENT_CHANGED = "changed"
+
+DISCOVERY_BROADCAST = "<broadcast>"
+
+# Linux interface ioctls, and the struct ifreq flags we care about.
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
 
 DISCOVERY_PKT_FLAG_REQUEST = (1 << 0)
 DISCOVERY_PKT_FLAG_RESPONSE = (1 << 1)
@@ -40,6 +72,129 @@ DISCOVERY_PKT_FLAG_RESPONSE = (1 << 1)
 class DiscoveryPacketDevID (enum.Enum):
     ProjectA = 0x7132
 
+# HB: uint16_t, uint8_t
+DISCOVERY_REQUEST_PACKET = struct.pack ("HB", DiscoveryPacketDevID.ProjectA.value, DISCOVERY_PKT_FLAG_REQUEST)
+
+####
+## Functions
+####
+
+"""
+    Creates a non-blocking UDP broadcast socket for discovery.
+"""
+def _create_socket ():
+    sock = socket.socket (socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt (socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setsockopt (socket.SOL_SOCKET, socket.SO_RCVBUF, DISCOVERY_RECV_BUFFER)
+    sock.setblocking (False)
+    return sock
+
+"""
+    Sends the discovery request to every target from one socket. A target which can't
+     be reached is skipped, so one broken network doesn't hold back the others.
+    \ sock: the discovery socket.
+    \ targets: the addresses to send to, broadcast or unicast.
+    \ port: the discovery port.
+    \ stats: the DiscoveryStats to count the packets in.
+"""
+def _send_requests (sock, targets, port, stats, silent = True):
+    for target in targets:
+        try:
+            try:
+                sock.sendto (DISCOVERY_REQUEST_PACKET, (target, port))
+            except BlockingIOError:
+                # The send buffer is full during large sweeps, waits until there's room.
+                sock.setblocking (True)
+                try:
+                    sock.sendto (DISCOVERY_REQUEST_PACKET, (target, port))
+                finally:
+                    sock.setblocking (False)
+
+            stats.packets_sent += 1
+        except OSError as e:
+            if not silent:
+                print (f"Discovery request to {target} failed: {e}")
+
+"""
+    Gets the local IPv4 interfaces which are up, as a list of (name, address, netmask),
+     loopback excluded. Returns an empty list where they can't be enumerated.
+"""
+def local_interfaces ():
+    if fcntl == None or not hasattr (socket, "if_nameindex"):
+        return []
+
+    interfaces = []
+    sock = socket.socket (socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        for _, name in socket.if_nameindex ():
+            ifreq = struct.pack ("256s", name.encode ("utf8")[:15])
+
+            try:
+                flags = struct.unpack_from ("H", fcntl.ioctl (sock.fileno (), SIOCGIFFLAGS, ifreq), 16)[0]
+                if not (flags & IFF_UP) or (flags & IFF_LOOPBACK):
+                    continue
+
+                address = socket.inet_ntoa (fcntl.ioctl (sock.fileno (), SIOCGIFADDR, ifreq)[20:24])
+                netmask = socket.inet_ntoa (fcntl.ioctl (sock.fileno (), SIOCGIFNETMASK, ifreq)[20:24])
+            except OSError:
+                # Interfaces without an IPv4 address.
+                continue
+
+            interfaces.append ((name, address, netmask))
+    finally:
+        sock.close ()
+
+    return interfaces
+
+"""
+    Gets the discovery targets: the limited broadcast, the subnet-directed broadcast of
+     every local interface, and every host address of the given networks.
+    \ networks: CIDRs to sweep with unicast requests, like "10.1.0.0/24".
+    \ interfaces: whether to add the subnet-directed broadcasts of the local interfaces.
+"""
+def discovery_targets (networks = (), interfaces = True):
+    targets = [ DISCOVERY_BROADCAST ]
+
+    if interfaces:
+        for _, address, netmask in local_interfaces ():
+            network = ipaddress.IPv4Network (f"{address}/{netmask}", strict = False)
+
+            # Point-to-point networks have no broadcast address.
+            if network.prefixlen < 31:
+                targets.append (str (network.broadcast_address))
+
+    for network in networks:
+        network = ipaddress.IPv4Network (network, strict = False)
+        targets.extend (str (host) for host in (network.hosts () if network.prefixlen < 31 else network))
+
+    # Keeps the order, without sending anything twice.
+    return list (dict.fromkeys (targets))
+
+"""
+    Parses a discovery response, returns (name, port), or None if it isn't a ProjectA response.
+    \ data: the bytes.
+"""
+def _parse_response (data):
+    if len (data) < 7:
+        return None
+
+    # HBH: uint16_t, uint8_t, uint16_t
+    device_id, flags, port, name_len = struct.unpack ("<HBHH", data[0:7])
+
+    # Makes sure that it's a ProjectA instance, and that we're dealing with an response.
+    if device_id != DiscoveryPacketDevID.ProjectA.value:
+        return None
+    elif not (flags & DISCOVERY_PKT_FLAG_RESPONSE):
+        return None
+    elif name_len < 1 or len (data) < 7 + name_len - 1:
+        return None
+
+    # Reads the device name, the length includes the terminating zero.
+    name = struct.unpack (f"{name_len - 1}s", data[7:(8 + name_len - 2)])
+    return name[0].decode ('utf8', errors = 'replace'), port
+
 ####
 ## Classes
 ####
@@ -52,28 +207,33 @@ class Discovery:
         / packet_count: number of discover packets.
         / silent: show debug info?
     """
-    def __init__ (self, port = DISCOVERY_PORT, timeout = DISCOVERY_TIMEOUT, packet_count = DISCOVERY_PACKET_COUNT, silent = True):
+    def __init__ (self, port = DISCOVERY_PORT, timeout = DISCOVERY_TIMEOUT, packet_count = DISCOVERY_PACKET_COUNT, silent = True, targets = None):
         self._port = port
         self._timeout = timeout
         self._packet_count = packet_count
+        self._targets = [ DISCOVERY_BROADCAST ] if targets == None else list (targets)
         self._active = False
         self._silent = silent
 
         self._socket = None
+        self._selector = None
         self._start = None
+        self._sent_at = None
         
         self._devices = None
+        self._seen = None
+
+        # Always on, see stats.
+        self._stats = DiscoveryStats ()
 
     """
-        Sends a discovery packet.
+        Sends a discovery packet to every target.
     """
     def _send_discover (self):
         assert (self._active == True)
         assert (self._socket != None)
 
-        # HB: uint16_t, uint8_t
-        self._socket.sendto (struct.pack ("HB", DiscoveryPacketDevID.ProjectA.value, DISCOVERY_PKT_FLAG_REQUEST),
-            ("<broadcast>", self._port))
+        _send_requests (self._socket, self._targets, self._port, self._stats, self._silent)
 
     """
         Starts the UDP discovery.
@@ -86,14 +246,20 @@ class Discovery:
         self._active = True
 
         # Creates the broadcast socket.
-        self._socket = socket.socket (socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        self._socket.setsockopt (socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._socket = _create_socket ()
+
+        # Unlike select.select, selectors also handle fds above FD_SETSIZE.
+        self._selector = selectors.DefaultSelector ()
+        self._selector.register (self._socket, selectors.EVENT_READ)
 
         # Tells that we're starting the discovery.
         if not self._silent:
             print (f"Starting UDP discovery on port {self._port} with timeout {self._timeout}")
 
+        self._stats.runs += 1
+        self._stats.devices = 0
+        self._sent_at = time.perf_counter ()
+
         # Sends N discovery packets.
         for i in range (0, self._packet_count):
             self._send_discover ()
@@ -103,6 +269,7 @@ class Discovery:
         # Sets the start timestamp.
         self._start = time.time ()
         self._devices = list ()
+        self._seen = set ()
 
     """
         Handles the reception of a possible data packet.
@@ -110,28 +277,74 @@ class Discovery:
         / addr: the address which sent the data.
     """
     def _on_packet (self, data, addr):
-        # HBH: uint16_t, uint8_t, uint16_t
-        device_id, flags, port, name_len = struct.unpack ("<HBHH", data[0:7])
+        self._stats.responses_received += 1
 
-        # Makes sure that it's a ProjectA instance, and that we're dealing with an response.
-        if device_id != DiscoveryPacketDevID.ProjectA.value:
-            return False
-        elif not (flags & DISCOVERY_PKT_FLAG_RESPONSE):
+        response = _parse_response (data)
+        if response == None:
+            self._stats.invalid_responses += 1
             return False
 
         # Makes sure that we haven't discovered the specified address already.
-        for device in self._devices:
-            if device[1] == addr[0]:
-                return False
+        if addr[0] in self._seen:
+            self._stats.duplicate_responses += 1
+            return False
 
-        # Reads the device name.
-        name = struct.unpack (f"{name_len - 1}s", data[7:(8 + name_len - 2)])
         self._devices.append ((
-            name[0].decode ('utf8'), addr[0], port
+            response[0], addr[0], response[1]
         ))
+        self._seen.add (addr[0])
+
+        self._stats.devices = len (self._devices)
+        if len (self._devices) == 1:
+            self._stats.found_first (time.perf_counter () - self._sent_at)
 
         return True
 
+    """
+        Reads all responses which already arrived without blocking, and yields the
+         newly discovered devices as (name, ip, port).
+    """
+    def receive (self):
+        assert (self._active == True)
+        assert (self._socket != None)
+
+        while True:
+            try:
+                data, addr = self._socket.recvfrom (1024)
+            except BlockingIOError:
+                return
+
+            if self._on_packet (data, addr) == True:
+                if not self._silent:
+                    print (f"Discovered ProjectA instance on {addr[0]}")
+
+                yield self._devices[-1]
+
+    """
+        Gets the seconds left until the discovery deadline.
+    """
+    def remaining (self):
+        assert (self._start != None)
+        return self._start + self._timeout - time.time ()
+
+    """
+        Ends the discovery, and closes the socket. The devices stay available.
+    """
+    def stop (self):
+        if not self._active:
+            return
+
+        if not self._silent:
+            print (f"Discovery finished, found {len (self._devices)} devices.")
+
+        self._selector.close ()
+        self._socket.close ()
+
+        self._selector = None
+        self._socket = None
+        self._start = None
+        self._active = False
+
     """
         Performs packet polling, this is so the user can run code while ongoing discovery.
     """
@@ -142,41 +355,378 @@ class Discovery:
 
         # Polls if there is new data available from the UDP broadcast socket, if so
         #  we will read it, and attempt to parse the packet.
-        read_sockets, _, _ = select.select ([ self._socket ], [], [], 0.01)
-        if len (read_sockets) == 1:
-            data, addr = read_sockets[0].recvfrom(1024)
-            if self._on_packet (data, addr) == True and not self._silent:
-                print (f"Discovered ProjectA instance on {addr[0]}")
+        if len (self._selector.select (0.01)) > 0:
+            for _ in self.receive ():
+                pass
 
         # Check if we need to poll another time, if not set the session to non-active.
-        if time.time () > self._start + self._timeout:
-            if not self._silent:
-                print (f"Discovery finished, found {len (self._devices)} devices.")
+        if self.remaining () < 0.0:
+            self.stop ()
+            return False
 
-            self._socket.close ()
+        return True
 
-            self._socket = None
-            self._start = None
-            self._active = False
+    """
+        Performs a whole discovery, yielding each device as (name, ip, port) the moment
+         its response arrives. Sleeps in select until a response or the deadline.
+        \ expected: stop as soon as this many devices were found, or None to wait for the timeout.
+    """
+    def discover (self, expected = None):
+        if not self._active:
+            self.start ()
 
-            return False
+        try:
+            while True:
+                for device in self.receive ():
+                    yield device
 
-        return True
+                    if expected != None and len (self._devices) >= expected:
+                        return
+
+                remaining = self.remaining ()
+                if remaining <= 0.0:
+                    return
+
+                self._selector.select (remaining)
+        finally:
+            self.stop ()
+
+    """
+        Performs a whole discovery on the running event loop, yielding each device as
+         (name, ip, port) the moment its response arrives.
+        \ expected: stop as soon as this many devices were found, or None to wait for the timeout.
+    """
+    async def discover_async (self, expected = None):
+        if not self._active:
+            self.start ()
+
+        loop = asyncio.get_running_loop ()
+        readable = asyncio.Event ()
+
+        fd = self._socket.fileno ()
+        loop.add_reader (fd, readable.set)
+
+        try:
+            while True:
+                # Cleared before reading, so a response arriving meanwhile sets it again.
+                readable.clear ()
+
+                for device in self.receive ():
+                    yield device
+
+                    if expected != None and len (self._devices) >= expected:
+                        return
+
+                remaining = self.remaining ()
+                if remaining <= 0.0:
+                    return
+
+                try:
+                    await asyncio.wait_for (readable.wait (), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader (fd)
+            self.stop ()
+
+    """
+        Gets the discovery statistics as a dict, accumulated over all runs.
+    """
+    def stats (self):
+        return self._stats.as_dict ()
 
     def __del__ (self):
         if self._socket != None:
             self._socket.close ()
 
+class DiscoveredDevice:
+    """
+        Creates new registry entry of a device found by the DiscoveryService.
+        \ name: the device name.
+        \ ip: the IPv4 address, which identifies the device.
+        \ port: the control port.
+        \ last_seen: the time.monotonic of the last response.
+    """
+    __slots__ = ("name", "ip", "port", "first_seen", "last_seen")
+
+    def __init__ (self, name, ip, port, last_seen):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.first_seen = last_seen
+        self.last_seen = last_seen
+
+    """
+        Gets the device as (name, ip, port), like Discovery returns them.
+    """
+    def as_tuple (self):
+        return (self.name, self.ip, self.port)
+
+    def __repr__ (self):
+        return f"DiscoveredDevice(name={self.name!r}, ip={self.ip!r}, port={self.port}, last_seen={self.last_seen:.3f})"
+
+class DiscoveryService:
+    """
+        Creates new background discovery service, which keeps probing from its own thread
+         and maintains a registry of all devices which responded within the TTL.
+
+        Probes are sent every interval while the registry keeps changing, once a probe
+         brings nothing new the interval doubles until max_interval. Every interval gets
+         a random jitter, so several controllers on the same network don't probe in lock
+         step. A device is removed once it didn't respond for ttl, which should cover a
+         few max_interval probes, since broadcasts may get lost.
+
+        Subscribers are called with (event, device, previous) on the service thread, event
+         being one of the DISCOVERY_EVENT_* values, device the DiscoveredDevice, and
+         previous the former (name, ip, port) for changed events, else None.
+
+        \ port: the port to discover on.
+        \ interval: the probe interval while the registry changes.
+        \ max_interval: the probe interval the backoff stops at.
+        \ ttl: seconds without a response before a device is removed.
+        \ packet_count: number of discover packets per probe.
+    """
+    def __init__ (self, port = DISCOVERY_PORT, interval = DISCOVERY_SERVICE_INTERVAL, max_interval = DISCOVERY_SERVICE_MAX_INTERVAL, ttl = DISCOVERY_SERVICE_TTL,
+            packet_count = 1, silent = True, targets = None):
+        assert (0 < interval <= max_interval)
+        assert (ttl > max_interval)
+
+        self._port = port
+        self._interval = interval
+        self._min_interval = interval
+        self._max_interval = max_interval
+        self._ttl = ttl
+        self._packet_count = packet_count
+        self._silent = silent
+        self._targets = [ DISCOVERY_BROADCAST ] if targets == None else list (targets)
+
+        self._lock = threading.Lock ()
+        self._devices = {}
+        self._subscribers = []
+        self._changed = True
+        self._refresh = False
+        self._running = False
+        self._thread = None
+
+        self._socket = None
+        self._selector = None
+        self._wake_r = None
+        self._wake_w = None
+
+        # Always on, see stats.
+        self._stats = DiscoveryStats ()
+
+    """
+        Starts probing, from a daemon thread.
+    """
+    def start (self):
+        assert (self._running == False)
+
+        self._socket = _create_socket ()
+
+        # Written to for refresh and stop, to wake the thread from select.
+        self._wake_r, self._wake_w = socket.socketpair ()
+        self._wake_r.setblocking (False)
+        self._wake_w.setblocking (False)
+
+        self._selector = selectors.DefaultSelector ()
+        self._selector.register (self._socket, selectors.EVENT_READ)
+        self._selector.register (self._wake_r, selectors.EVENT_READ)
+
+        self._running = True
+        self._thread = threading.Thread (target = self._run, name = f"discovery-{self._port}", daemon = True)
+        self._thread.start ()
+
+    """
+        Stops probing, the registry stays available.
+    """
+    def stop (self):
+        if not self._running:
+            return
+
+        self._running = False
+        self._wake ()
+        self._thread.join ()
+
+        self._selector.close ()
+        self._socket.close ()
+        self._wake_r.close ()
+        self._wake_w.close ()
+
+        self._socket = None
+        self._selector = None
+        self._wake_r = None
+        self._wake_w = None
+
+    """
+        Subscribes to registry events.
+        \ callback: called with (event, device, previous) on the service thread.
+    """
+    def subscribe (self, callback):
+        with self._lock:
+            self._subscribers = self._subscribers + [ callback ]
+
+    """
+        Unsubscribes from registry events.
+        \ callback: the subscribed callback.
+    """
+    def unsubscribe (self, callback):
+        with self._lock:
+            self._subscribers = [ other for other in self._subscribers if other != callback ]
+
+    """
+        Gets all registered devices, as a list of DiscoveredDevice.
+    """
+    def devices (self):
+        with self._lock:
+            return list (self._devices.values ())
+
+    """
+        Probes right away, and restarts the backoff.
+    """
+    def refresh (self):
+        self._changed = True
+        self._refresh = True
+        self._wake ()
+
+    """
+        Gets the discovery statistics as a dict, see Discovery.stats.
+    """
+    def stats (self):
+        return self._stats.as_dict ()
+
+    def _wake (self):
+        # Not running, or stopped meanwhile, so there's nothing to wake.
+        try:
+            self._wake_w.send (b"\0")
+        except (OSError, AttributeError):
+            pass
+
+    """
+        Sends the probe packets.
+    """
+    def _probe (self):
+        self._stats.runs += 1
+
+        # Failed sends are skipped, the network may be down for a while and the next probe retries.
+        for _ in range (0, self._packet_count):
+            _send_requests (self._socket, self._targets, self._port, self._stats, self._silent)
+
+    """
+        Reads all responses which arrived, and updates the registry.
+    """
+    def _receive (self, now):
+        while True:
+            try:
+                data, addr = self._socket.recvfrom (1024)
+            except BlockingIOError:
+                return
+
+            self._stats.responses_received += 1
+
+            response = _parse_response (data)
+            if response == None:
+                self._stats.invalid_responses += 1
+                continue
+
+            name, port = response
+            previous = None
+
+            with self._lock:
+                device = self._devices.get (addr[0])
+
+                if device == None:
+                    event = DISCOVERY_EVENT_ADDED
+                    device = self._devices[addr[0]] = DiscoveredDevice (name, addr[0], port, now)
+                elif device.name != name or device.port != port:
+                    event = DISCOVERY_EVENT_CHANGED
+                    previous = device.as_tuple ()
+                    device.name = name
+                    device.port = port
+                    device.last_seen = now
+                else:
+                    event = None
+                    device.last_seen = now
+
+                self._stats.devices = len (self._devices)
+
+            if event == None:
+                self._stats.duplicate_responses += 1
+                continue
+
+            self._changed = True
+            self._emit (event, device, previous)
+
+    """
+        Removes all devices which weren't seen within the TTL.
+    """
+    def _expire (self, now):
+        with self._lock:
+            expired = [ device for device in self._devices.values () if now - device.last_seen > self._ttl ]
+            for device in expired:
+                del self._devices[device.ip]
+
+            self._stats.devices = len (self._devices)
+
+        for device in expired:
+            self._changed = True
+            self._emit (DISCOVERY_EVENT_REMOVED, device, None)
+
+    def _emit (self, event, device, previous):
+        if not self._silent:
+            print (f"Discovery {event}: {device}")
+
+        for callback in self._subscribers:
+            try:
+                callback (event, device, previous)
+            except Exception as e:
+                if not self._silent:
+                    print (f"Discovery subscriber failed: {e}")
+
+    """
+        The service thread main loop.
+    """
+    def _run (self):
+        next_probe = time.monotonic ()
+
+        while self._running:
+            now = time.monotonic ()
+
+            if self._refresh:
+                self._refresh = False
+                next_probe = now
+
+            if now >= next_probe:
+                # Backs off while probes keep bringing nothing new.
+                if self._changed:
+                    self._interval = self._min_interval
+                else:
+                    self._interval = min (self._interval * 2.0, self._max_interval)
+
+                self._changed = False
+                self._probe ()
+
+                next_probe = now + self._interval * random.uniform (1.0 - DISCOVERY_SERVICE_JITTER, 1.0 + DISCOVERY_SERVICE_JITTER)
+
+            for key, _ in self._selector.select (max (0.0, next_probe - now)):
+                if key.fileobj == self._wake_r:
+                    try:
+                        while self._wake_r.recv (4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+            now = time.monotonic ()
+            self._receive (now)
+            self._expire (now)
+
 ####
 ## Testing Code
 ####
 
 if __name__ == "__main__":
-    discovery = Discovery (DISCOVERY_PORT, DISCOVERY_TIMEOUT, DISCOVERY_PACKET_COUNT, False)
-    discovery.start ()
-
-    while discovery.poll ():
-        pass
+    # Any arguments are networks to sweep, like 10.1.0.0/24.
+    discovery = Discovery (DISCOVERY_PORT, DISCOVERY_TIMEOUT, DISCOVERY_PACKET_COUNT, False, discovery_targets (sys.argv[1:]))
 
-    for device in discovery._devices:
+    for device in discovery.discover ():
         print (device)
@@ -0,0 +1,168 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from discovery import DISCOVERY_PORT, DISCOVERY_TIMEOUT, Discovery
+
+####
+## Global Constants
+####
+
+DISCOVERY_CACHE_DIRECTORY = "project-a"
+DISCOVERY_CACHE_FILE = "devices.json"
+DISCOVERY_CACHE_VERSION = 1
+DISCOVERY_CACHE_MAX_AGE = 30 * 24 * 3600.0 # seconds since last seen before an entry is dropped
+
+####
+## Functions
+####
+
+"""
+    Gets the default cache file path, under $XDG_CACHE_HOME or ~/.cache.
+"""
+def default_cache_path ():
+    base = os.environ.get ("XDG_CACHE_HOME") or os.path.join (os.path.expanduser ("~"), ".cache")
+    return os.path.join (base, DISCOVERY_CACHE_DIRECTORY, DISCOVERY_CACHE_FILE)
+
+"""
+    Probes the given devices with unicast discovery requests, and returns the ones which
+     answered as a list of (name, ip, port). Returns as soon as all of them answered.
+    \ devices: the (name, ip, port) to probe.
+    \ port: the discovery port.
+    \ timeout: how long to wait for responses.
+"""
+def revalidate (devices, port = DISCOVERY_PORT, timeout = DISCOVERY_TIMEOUT):
+    addresses = list (dict.fromkeys (device[1] for device in devices))
+    if len (addresses) == 0:
+        return []
+
+    discovery = Discovery (port, timeout, 1, True, addresses)
+    return list (discovery.discover (len (addresses)))
+
+####
+## Classes
+####
+
+class DiscoveryCache:
+    """
+        Creates new discovery cache, which remembers discovered devices on disk, so they
+         can be shown right away on the next start, before any discovery completed.
+        \ path: the cache file, or None for the default one.
+        \ max_age: seconds since last seen before an entry is dropped.
+    """
+    def __init__ (self, path = None, max_age = DISCOVERY_CACHE_MAX_AGE):
+        self._path = default_cache_path () if path == None else path
+        self._max_age = max_age
+
+        # Per IP: [ name, ip, port, last_seen (time.time) ].
+        self._devices = {}
+
+    """
+        Loads the cache file, a missing or broken one is treated as empty.
+    """
+    def load (self):
+        self._devices = {}
+
+        try:
+            with open (self._path, "r") as file:
+                data = json.load (file)
+        except (OSError, ValueError):
+            return self
+
+        if not isinstance (data, dict) or data.get ("version") != DISCOVERY_CACHE_VERSION:
+            return self
+
+        for entry in data.get ("devices", []):
+            try:
+                self._devices[str (entry["ip"])] = [ str (entry["name"]), str (entry["ip"]), int (entry["port"]), float (entry["last_seen"]) ]
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        return self
+
+    """
+        Writes the cache file atomically, so a crash never leaves a half-written one.
+    """
+    def save (self):
+        now = time.time ()
+        devices = [ { "name": name, "ip": ip, "port": port, "last_seen": last_seen }
+            for name, ip, port, last_seen in self._devices.values () if now - last_seen <= self._max_age ]
+
+        directory = os.path.dirname (self._path)
+        os.makedirs (directory, exist_ok = True)
+
+        fd, temporary = tempfile.mkstemp (dir = directory, prefix = ".devices-", suffix = ".json")
+        try:
+            with os.fdopen (fd, "w") as file:
+                json.dump ({ "version": DISCOVERY_CACHE_VERSION, "devices": devices }, file, indent = 4)
+
+            os.replace (temporary, self._path)
+        except BaseException:
+            os.unlink (temporary)
+            raise
+
+    """
+        Gets the cached devices as a list of (name, ip, port), most recently seen first.
+    """
+    def devices (self):
+        entries = sorted (self._devices.values (), key = lambda entry: entry[3], reverse = True)
+        return [ (name, ip, port) for name, ip, port, _ in entries ]
+
+    """
+        Gets the time.time a device was last seen, or None if it isn't cached.
+        \ ip: the device address.
+    """
+    def last_seen (self, ip):
+        entry = self._devices.get (ip)
+        return None if entry == None else entry[3]
+
+    """
+        Records devices as seen now.
+        \ devices: the (name, ip, port) which responded.
+    """
+    def update (self, devices):
+        now = time.time ()
+
+        for name, ip, port in devices:
+            self._devices[ip] = [ name, ip, port, now ]
+
+    """
+        Forgets a device.
+        \ ip: the device address.
+    """
+    def remove (self, ip):
+        self._devices.pop (ip, None)
+
+####
+## Main Code
+####
+
+if __name__ == "__main__":
+    cache = DiscoveryCache ().load ()
+    responses = revalidate (cache.devices ())
+    alive = set (device[1] for device in responses)
+
+    for device in cache.devices ():
+        print (device, "online" if device[1] in alive else "stale")
+
+    cache.update (responses)
+    cache.save ()
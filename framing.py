@@ -0,0 +1,161 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from codec import HEADER_STRUCT
+
+####
+## Global Constants
+####
+
+FRAME_HEADER_SIZE = HEADER_STRUCT.size # uint16_t (length, including header) + uint16_t (op)
+FRAME_BUFFER_SIZE = 4096
+
+####
+## Exceptions
+####
+
+class FrameError (Exception):
+    pass
+
+####
+## Classes
+####
+
+class FrameDecoder:
+    """
+        Creates new frame decoder, which reassembles control protocol frames from
+         an arbitrarily segmented byte stream.
+
+        Data is received straight into a preallocated bytearray, and complete frames
+         are handed out as memoryview slices of that buffer, so no bytes get copied
+         per read. Once the read position runs into the end of the buffer, the
+         (small) unconsumed tail is moved back to the front.
+
+        Frames returned by next_frame stay valid until the next call to get_buffer,
+         recv_into or feed.
+
+        \ capacity: the buffer size, also the max frame size.
+    """
+    def __init__ (self, capacity = FRAME_BUFFER_SIZE):
+        assert (capacity >= FRAME_HEADER_SIZE)
+
+        self._buffer = bytearray (capacity)
+        self._view = memoryview (self._buffer)
+        self._start = 0
+        self._end = 0
+
+    """
+        Gets the number of buffered, not yet consumed bytes.
+    """
+    def pending (self):
+        return self._end - self._start
+
+    """
+        Discards all buffered data.
+    """
+    def reset (self):
+        self._start = 0
+        self._end = 0
+
+    """
+        Gets the writable region of the buffer, compatible with asyncio.BufferedProtocol.
+        \ sizehint: ignored, the whole free region is returned.
+    """
+    def get_buffer (self, sizehint = -1):
+        # Nothing pending, so we can simply start over at the front.
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+        # Moves the partial frame back to the front once we run out of room.
+        elif self._end == len (self._buffer) or self._start > len (self._buffer) // 2:
+            length = self._end - self._start
+            self._view[0:length] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = length
+
+        if self._end == len (self._buffer):
+            raise FrameError (f"Frame exceeds buffer capacity of {len (self._buffer)} bytes")
+
+        return self._view[self._end:]
+
+    """
+        Marks N bytes written into the region returned by get_buffer as valid.
+        \ nbytes: the number of bytes written.
+    """
+    def buffer_updated (self, nbytes):
+        assert (self._end + nbytes <= len (self._buffer))
+        self._end += nbytes
+
+    """
+        Performs a single recv_into on the socket, returns the number of bytes read.
+        \ sock: the socket to read from.
+    """
+    def recv_into (self, sock):
+        nbytes = sock.recv_into (self.get_buffer ())
+        if nbytes == 0:
+            raise ConnectionError ("Connection closed by peer")
+
+        self.buffer_updated (nbytes)
+        return nbytes
+
+    """
+        Copies the given bytes into the buffer, for sources which can't write in place.
+        \ data: the received bytes.
+    """
+    def feed (self, data):
+        data = memoryview (data)
+
+        while len (data) > 0:
+            region = self.get_buffer ()
+            nbytes = min (len (region), len (data))
+            region[:nbytes] = data[:nbytes]
+            self.buffer_updated (nbytes)
+            data = data[nbytes:]
+
+    """
+        Gets the next complete frame as (op, frame), where frame is a memoryview of the
+         whole frame including its header, or None if no complete frame is buffered.
+    """
+    def next_frame (self):
+        if self._end - self._start < FRAME_HEADER_SIZE:
+            return None
+
+        length, op = HEADER_STRUCT.unpack_from (self._buffer, self._start)
+
+        if length < FRAME_HEADER_SIZE:
+            raise FrameError (f"Invalid frame length {length}")
+        elif length > len (self._buffer):
+            raise FrameError (f"Frame length {length} exceeds buffer capacity of {len (self._buffer)} bytes")
+        elif self._end - self._start < length:
+            return None
+
+        frame = self._view[self._start:self._start + length]
+        self._start += length
+
+        return op, frame
+
+    """
+        Yields all complete buffered frames.
+    """
+    def __iter__ (self):
+        while True:
+            frame = self.next_frame ()
+            if frame == None:
+                return
+
+            yield frame
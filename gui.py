@@ -16,10 +16,19 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from discovery import DISCOVERY_PORT, Discovery, DISCOVERY_PACKET_COUNT
-from control import CONTROL_PORT, Control, CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC, CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED, CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING
+from discovery import DISCOVERY_PORT, Discovery, DISCOVERY_PACKET_COUNT, discovery_targets
+from discovery_cache import DiscoveryCache, revalidate
+from control import CONTROL_PORT, Control, ControlThread
+from codec import CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED, CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC, CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING, DeviceSnapshot
+from scheduler import PollScheduler
+from pool import ControlPool
+from plot import PLOT_CAPACITY, PLOT_WINDOW, PLOT_IDLE_INTERVAL, PLOT_SIZE, PLOT_MARGIN, PLOT_COLOR_CURRENT_POS, PLOT_COLOR_TARGET_POS, PLOT_COLOR_SPEED, PLOT_COLOR_BACKGROUND, PLOT_COLOR_GRID, RingBuffer, decimate_minmax
+import asyncio
+import concurrent.futures
 import gi
 import os
+import threading
+import time
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
@@ -32,6 +41,29 @@ DISCOVERY_WINDOW_TITLE = "Project-A Device Explorer"
 DISCOVERY_WINDOW_SIZE = (500, 400)
 DISCOVERY_WINDOW_TIMEOUT = 0.5
 
+DEVICE_STATUS_CACHED = "Cached"
+DEVICE_STATUS_ONLINE = "Online"
+DEVICE_STATUS_STALE = "Stale"
+DEVICE_STATUS_WAITING = "Waiting"
+
+CONTROL_CONNECT_WAIT = 5.0 # max seconds to wait for fleet windows to release a device
+
+FLEET_WINDOW_TITLE = "Project-A Fleet Dashboard"
+FLEET_WINDOW_SIZE = (900, 600)
+FLEET_STALE_AFTER = 5.0 # seconds without a snapshot before a device is shown as stale
+FLEET_STALE_CHECK_INTERVAL = 1000 # ms
+
+"""
+    Gets the short text of stepper info flags, as shown in the GUI.
+    \ flags: the CONTROL_PACKET_STEPPER_INFO_FLAG_* bits.
+"""
+def stepper_flags_text (flags):
+    moving = flags & CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING
+    enabled = flags & CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED
+    automatic = flags & CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC
+
+    return f"{'IM' if moving else 'NM'} | {'EN' if enabled else 'NE'} | {'AT' if automatic else 'MA'}"
+
 class DiscoveryWindow (Gtk.Window):
     """
         Creates an new discovery window instance.
@@ -78,16 +110,23 @@ class DiscoveryWindow (Gtk.Window):
         self._top_box_refresh_button.connect ("pressed", self._on_discovery_start_pressed)
         self._top_box.add (self._top_box_refresh_button)
 
+        self._top_box.add (Gtk.Separator (orientation = Gtk.Orientation.VERTICAL, margin_left = 10, margin_right = 10))
+
+        self._top_box_fleet_button = Gtk.Button.new_with_label ("Fleet Dashboard")
+        self._top_box_fleet_button.connect ("pressed", self._on_fleet_pressed)
+        self._top_box.add (self._top_box_fleet_button)
+
         # Widgets for: self._scroll_box
 
-        self._scroll_box_discovered_list_store = Gtk.ListStore (str, str, str)
-        self._scroll_box_discovered_list_store.append ([ "Press Discover Button", "0.0.0.0", "0" ])
+        self._scroll_box_discovered_list_store = Gtk.ListStore (str, str, str, str)
+        self._scroll_box_discovered_list_store.append ([ "Press Discover Button", "0.0.0.0", "0", "" ])
 
         self._scroll_box_discovered_tree_view = Gtk.TreeView (model = self._scroll_box_discovered_list_store)
         self._scroll_box_discovered_tree_view.connect ("row-activated", self._on_connect_press)
         self._scroll_box_discovered_tree_view.append_column (Gtk.TreeViewColumn ("Name", Gtk.CellRendererText (), text = 0))
         self._scroll_box_discovered_tree_view.append_column (Gtk.TreeViewColumn ("IP Address", Gtk.CellRendererText (), text = 1))
         self._scroll_box_discovered_tree_view.append_column (Gtk.TreeViewColumn ("Port", Gtk.CellRendererText (), text = 2))
+        self._scroll_box_discovered_tree_view.append_column (Gtk.TreeViewColumn ("Status", Gtk.CellRendererText (), text = 3))
 
         self._scroll_box.add (self._scroll_box_discovered_tree_view)
 
@@ -104,6 +143,96 @@ class DiscoveryWindow (Gtk.Window):
 
         self._active_discoverer = None
         self._active_discoverer_io_watcher = None
+        self._active_discoverer_found = None
+
+        # Shared by all control and fleet windows, so they poll within one request budget.
+        self._poll_scheduler = PollScheduler ()
+
+        # The open control windows per (host, port), and the open fleet windows. A device
+        #  only accepts one session, so the fleet windows hand it over to a control window.
+        self._control_windows = {}
+        self._fleet_windows = []
+
+        # Lists the devices of the last session right away, and checks them in the background.
+        self._discovery_cache = DiscoveryCache ().load ()
+
+        cached = self._discovery_cache.devices ()
+        for device in cached:
+            self._set_device_row (device, DEVICE_STATUS_CACHED)
+
+        if len (cached) > 0:
+            threading.Thread (target = self._revalidate_cache, args = (cached, int (self._top_box_port_entry.get_text ())), daemon = True).start ()
+
+    """
+        Adds or updates the row of a device, replacing the placeholder row.
+        \ device: the (name, ip, port).
+        \ status: one of the DEVICE_STATUS_* values.
+    """
+    def _set_device_row (self, device, status):
+        store = self._scroll_box_discovered_list_store
+
+        for row in store:
+            if row[1] == "0.0.0.0" and row[2] == "0":
+                store.remove (row.iter)
+                break
+
+        for row in store:
+            if row[1] == device[1]:
+                store[row.iter] = [ device[0], device[1], str (device[2]), status ]
+                return
+
+        store.append ([ device[0], device[1], str (device[2]), status ])
+
+    """
+        Marks all devices which aren't in the given addresses stale.
+        \ addresses: the IPs which responded.
+    """
+    def _mark_stale (self, addresses):
+        for row in self._scroll_box_discovered_list_store:
+            if row[1] not in addresses and row[1] != "0.0.0.0":
+                row[3] = DEVICE_STATUS_STALE
+
+    """
+        Saves the cache, a failure only costs the next startup.
+    """
+    def _save_cache (self):
+        try:
+            self._discovery_cache.save ()
+        except OSError as e:
+            print (f"Could not save the discovery cache: {e}")
+
+    """
+        Probes the cached devices with unicast requests, runs on a worker thread.
+    """
+    def _revalidate_cache (self, devices, port):
+        try:
+            responses = revalidate (devices, port, DISCOVERY_WINDOW_TIMEOUT)
+        except OSError as e:
+            print (f"Could not revalidate the cached devices: {e}")
+            return
+
+        GLib.idle_add (self._on_cache_revalidated, responses)
+
+    """
+        Gets called on the main loop once the cached devices were probed.
+    """
+    def _on_cache_revalidated (self, responses):
+        # A discovery in the meantime has the more recent result.
+        if self._active_discoverer != None:
+            return False
+
+        for device in responses:
+            self._set_device_row (device, DEVICE_STATUS_ONLINE)
+
+        addresses = set (device[1] for device in responses)
+        for row in self._scroll_box_discovered_list_store:
+            if row[3] == DEVICE_STATUS_CACHED and row[1] not in addresses:
+                row[3] = DEVICE_STATUS_STALE
+
+        self._discovery_cache.update (responses)
+        self._save_cache ()
+
+        return False
 
     """
         Starts the connect process to the specified device.
@@ -130,21 +259,72 @@ class DiscoveryWindow (Gtk.Window):
         connectWindow.set_modal (True)
         connectWindow.set_transient_for (self)
         connectWindow.set_position(Gtk.WindowPosition.CENTER)
+        connectWindow.connect ("destroy", self._on_connect_window_destroyed, (address, port))
         connectWindow.show_all ()
 
-        # Checks if we're connected.
-        if connectWindow.connect ():
-            control = connectWindow._control
+        # Connects in the background, once the fleet windows closed their sessions to the device.
+        connectWindow.start_connect (self._on_connected, [ fleetWindow.release ((address, port)) for fleetWindow in self._fleet_windows ])
+
+    """
+        Gets called once a connect window is gone, hands the device back to the fleet
+         windows unless it got a control window.
+    """
+    def _on_connect_window_destroyed (self, connectWindow, key):
+        if key not in self._control_windows:
+            for fleetWindow in self._fleet_windows:
+                fleetWindow.adopt (key)
+
+    """
+        Gets called once a connect window connected.
+        \ connectWindow: the ConnectWindow.
+        \ control: the connected Control.
+    """
+    def _on_connected (self, connectWindow, control):
+        key = (control._host, control._port)
+
+        # Creates the new control window, the fleet windows show what it polls.
+        controlWIndow = ControlWindow (control, self._poll_scheduler)
+        controlWIndow.set_transient_for (self)
+        controlWIndow.set_position(Gtk.WindowPosition.CENTER)
+        controlWIndow.connect ("destroy", self._on_control_window_destroyed, key)
+        controlWIndow.show_all ()
+
+        self._control_windows[key] = controlWIndow
+        for fleetWindow in self._fleet_windows:
+            fleetWindow.attach (controlWIndow)
+
+        # Destroys the connect window.
+        connectWindow.destroy ()
+
+    """
+        Gets called once a control window is gone, hands the device back to the fleet windows.
+    """
+    def _on_control_window_destroyed (self, controlWindow, key):
+        if self._control_windows.get (key) is controlWindow:
+            del self._control_windows[key]
+
+            for fleetWindow in self._fleet_windows:
+                fleetWindow.adopt (key)
 
-            # Destroys the connect window.
-            connectWindow.destroy ()
-            del connectWindow
+    """
+        Opens a fleet dashboard of all listed devices.
+        \ widget: the callee widget.
+    """
+    def _on_fleet_pressed (self, widget):
+        devices = [ (row[0], row[1], int (row[2])) for row in self._scroll_box_discovered_list_store
+            if not (row[1] == "0.0.0.0" and row[2] == "0") ]
 
-            # Creates the new control window.
-            controlWIndow = ControlWindow (control)
-            controlWIndow.set_transient_for (self)
-            controlWIndow.set_position(Gtk.WindowPosition.CENTER)
-            controlWIndow.show_all ()
+        if len (devices) == 0:
+            print ("No devices to show in the fleet dashboard.")
+            return
+
+        fleetWindow = FleetWindow (devices, self._poll_scheduler, self._control_windows)
+        fleetWindow.set_transient_for (self)
+        fleetWindow.set_position (Gtk.WindowPosition.CENTER)
+        fleetWindow.connect ("destroy", lambda widget: self._fleet_windows.remove (widget))
+        fleetWindow.show_all ()
+
+        self._fleet_windows.append (fleetWindow)
 
     """
         Starts the discovery for new devices.
@@ -160,12 +340,28 @@ class DiscoveryWindow (Gtk.Window):
         
         self._bottom_box_spinner.start ()
 
-        self._active_discoverer = Discovery (int (self._top_box_port_entry.get_text ()), DISCOVERY_WINDOW_TIMEOUT, int (self._top_box_pkt_cnt_spin_button.get_value ()), False)
+        # Broadcasts on every local interface, not just the default route.
+        self._active_discoverer = Discovery (int (self._top_box_port_entry.get_text ()), DISCOVERY_WINDOW_TIMEOUT, int (self._top_box_pkt_cnt_spin_button.get_value ()), False, discovery_targets ())
         self._active_discoverer.start ()
 
-        self._active_discoverer_io_watcher = GLib.io_add_watch (self._active_discoverer._socket.fileno (), GLib.IO_IN, lambda a, b : self._active_discoverer.poll ())
+        # Devices are listed the moment they respond, the ones which don't are marked stale at the end.
+        self._active_discoverer_found = set ()
+
+        self._active_discoverer_io_watcher = GLib.io_add_watch (self._active_discoverer._socket.fileno (), GLib.IO_IN, self._on_discovery_readable)
         GLib.timeout_add (DISCOVERY_WINDOW_TIMEOUT * 1000.0, self._on_discovery_likely_end)
 
+    """
+        Gets called when discovery responses arrived, and lists the new devices.
+    """
+    def _on_discovery_readable (self, fd, condition):
+        assert (self._active_discoverer != None)
+
+        for device in self._active_discoverer.receive ():
+            self._active_discoverer_found.add (device[1])
+            self._set_device_row (device, DEVICE_STATUS_ONLINE)
+
+        return True
+
     """
         Gets called at the end of the discovery process.
     """
@@ -173,15 +369,15 @@ class DiscoveryWindow (Gtk.Window):
         assert (self._active_discoverer != None)
         assert (self._active_discoverer_io_watcher != None)
 
-        # Since we're not entirely sure if this is done properly, end in infinite loop
-        #  until poll returns False, which indicates the scan is done.
-        while self._active_discoverer.poll () == True:
-            pass
+        # Removes the IO watch, and picks up whatever arrived in between.
+        GLib.source_remove (self._active_discoverer_io_watcher)
+        self._on_discovery_readable (None, None)
+        self._mark_stale (self._active_discoverer_found)
 
-        # Processes the devices, and adds them to our result list.
-        self._scroll_box_discovered_list_store.clear ()
-        for device in self._active_discoverer._devices:
-            self._scroll_box_discovered_list_store.append ([ device[0], device[1], str (device[2]) ])
+        self._discovery_cache.update (self._active_discoverer._devices)
+        self._save_cache ()
+
+        self._active_discoverer.stop ()
 
         # Sets the button to be used again, and stops the spinner.
         self._top_box_refresh_button.set_sensitive (True)
@@ -190,10 +386,7 @@ class DiscoveryWindow (Gtk.Window):
         # Since we're done processing, restore reset everything.
         self._active_discoverer_io_watcher = None
         self._active_discoverer = None
-
-        # Removes the IO watch
-        if (self._active_discoverer_io_watcher != None):
-            GLib.source_remove (self._active_discoverer_io_watcher)
+        self._active_discoverer_found = None
 
         return False
 
@@ -221,7 +414,12 @@ class ConnectWindow (Gtk.Window):
 
         self.add (self._main_box)
 
-    def connect (self):
+    """
+        Connects on a worker thread, the progress is shown as it goes.
+        \ on_connected: called on the main loop with (window, control) once connected.
+        \ wait_for: futures to wait for before connecting.
+    """
+    def start_connect (self, on_connected, wait_for = ()):
         # Creates the TCP socket.
         self._control = Control (self._host, self._port, False)
         
@@ -229,47 +427,197 @@ class ConnectWindow (Gtk.Window):
         self._main_box_progress_bar.set_fraction (0.3)
         self._main_box_progress_bar.set_text ("Connecting ...")
 
-        # Since we're blocking, trigger update.
-        while Gtk.events_pending ():
-            Gtk.main_iteration ()
+        threading.Thread (target = self._connect_worker, args = (on_connected, list (wait_for)), daemon = True).start ()
+
+    """
+        Performs the blocking connect, runs on the worker thread.
+    """
+    def _connect_worker (self, on_connected, wait_for):
+        control = self._control
+
+        # Failures don't matter here, the connect attempt tells whether the device is free.
+        concurrent.futures.wait (wait_for, CONTROL_CONNECT_WAIT)
 
         # Attempts to connect the TCP socket.
         try:
-            self._control.tcp_connect ()    
+            control.tcp_connect ()    
         except Exception as e:
-            self._control = None
-            self._main_box_progress_bar.set_text (f"Connection failed: {e}")
-            return False
+            GLib.idle_add (self._on_connect_progress, f"Connection failed: {e}", 0.3)
+            return
 
-        # Since we're blocking, trigger update.
-        while Gtk.events_pending ():
-            Gtk.main_iteration ()
+        GLib.idle_add (self._on_connect_progress, "Requesting connection ...", 0.6)
 
         # Performs the connection attempt.
         try:
-            if self._control.proto_connect () == False:
-                self._main_box_progress_bar.set_text ("Connection rejected!")
-                self._main_box_progress_bar.set_fraction (1.0)
-                return False
+            if control.proto_connect () == False:
+                GLib.idle_add (self._on_connect_progress, "Connection rejected!", 1.0)
+                return
         except Exception as e:
-            self._control = None
-            self._main_box_progress_bar.set_text (f"Connection failed: {e}")
-            return False
+            GLib.idle_add (self._on_connect_progress, f"Connection failed: {e}", 0.6)
+            return
 
         # Sets the text to indicate we're connected.
-        self._main_box_progress_bar.set_text ("Connection approved.")
-        self._main_box_progress_bar.set_fraction (1.0)
+        GLib.idle_add (self._on_connect_progress, "Connection approved.", 1.0)
+        GLib.idle_add (on_connected, self, control)
 
-        # Returns true, since we're connected.
-        return True
+    def _on_connect_progress (self, text, fraction):
+        self._main_box_progress_bar.set_text (text)
+        self._main_box_progress_bar.set_fraction (fraction)
+        return False
+
+
+class StepperStatusView (Gtk.Box):
+    """
+        Creates new stepper status view, with a separate fixed-width label per field, so
+         rendering only touches the labels whose value changed, and those don't cause a
+         relayout.
+    """
+    def __init__ (self):
+        Gtk.Box.__init__ (self, orientation = Gtk.Orientation.HORIZONTAL)
+
+        # Per field: (text before the value, width in chars).
+        layout = (("Pos: ", 11), ("/", 11), (", Speed: ", 5), ("/", 5), ("/", 5), (", ", 12))
+
+        self._labels = []
+        for prefix, width in layout:
+            self.add (Gtk.Label (label = prefix))
 
+            label = Gtk.Label (label = "*", width_chars = width, xalign = 0.0)
+            self.add (label)
+            self._labels.append (label)
+
+        self._rendered = [ None ] * len (self._labels)
+
+    """
+        Gets the rendered values of a StepperState: current_pos, target_pos, current_speed,
+         min_speed, max_speed and flags.
+        \ state: the StepperState.
+    """
+    @staticmethod
+    def values (state):
+        return (state.current_pos, state.target_pos, state.current_speed, state.min_speed, state.max_speed, state.flags)
+
+    """
+        Renders the given values, only setting the labels which changed.
+        \ values: as returned by values.
+    """
+    def render (self, values):
+        rendered = self._rendered
+
+        for i in range (0, len (values) - 1):
+            if values[i] != rendered[i]:
+                self._labels[i].set_text (str (values[i]))
+                rendered[i] = values[i]
+
+        flags = values[-1]
+        if flags != rendered[-1]:
+            self._labels[-1].set_text (stepper_flags_text (flags))
+            rendered[-1] = flags
+
+class StepperPlot (Gtk.DrawingArea):
+    """
+        Creates new stepper plot, showing current_pos against target_pos on top and
+         current_speed below, over the last PLOT_WINDOW seconds. The history is a fixed-size
+         ring buffer, decimated to one min/max pair per pixel column when drawn, so drawing
+         costs the same no matter the sample rate or window.
+    """
+    def __init__ (self):
+        Gtk.DrawingArea.__init__ (self)
+        self.set_size_request (*PLOT_SIZE)
+        self.connect ("draw", self._on_draw)
+
+        # Columns: current_pos, target_pos, current_speed.
+        self._history = RingBuffer (PLOT_CAPACITY, 3)
+
+    """
+        Adds a sample, doesn't redraw.
+        \ timestamp: the time.monotonic the values were received.
+        \ values: as returned by StepperStatusView.values.
+    """
+    def append (self, timestamp, values):
+        self._history.append (timestamp, values[0], values[1], values[2])
+
+    """
+        Draws the min/max envelope of decimated series, scaled together to the given area.
+    """
+    @staticmethod
+    def _draw_series (cr, series, x, y, width, height):
+        # Empty columns are NaN, which never equals itself.
+        low = min ((v for mins, _, _ in series for v in mins if v == v), default = None)
+        high = max ((v for _, maxs, _ in series for v in maxs if v == v), default = None)
+        if low == None:
+            return
+
+        # A flat line is drawn in the middle.
+        span = high - low
+        if span == 0.0:
+            low -= 1.0
+            span = 2.0
+
+        scale = (height - 1) / span
+        bottom = y + height - 0.5
+
+        for mins, maxs, color in series:
+            cr.set_source_rgb (*color)
+            cr.new_path ()
+
+            for column, (minimum, maximum) in enumerate (zip (mins, maxs)):
+                if minimum != minimum:
+                    continue
+
+                # Going through the max and the min of each column draws the envelope,
+                #  and connects it to the previous column.
+                cr.line_to (x + column + 0.5, bottom - (maximum - low) * scale)
+                cr.line_to (x + column + 0.5, bottom - (minimum - low) * scale)
+
+            cr.stroke ()
+
+    def _on_draw (self, widget, cr):
+        width = self.get_allocated_width () - 2 * PLOT_MARGIN
+        height = self.get_allocated_height () - 3 * PLOT_MARGIN
+        if width <= 0 or height <= 0:
+            return False
+
+        cr.set_source_rgb (*PLOT_COLOR_BACKGROUND)
+        cr.paint ()
+        cr.set_line_width (1.0)
+
+        end = time.monotonic ()
+        start = end - PLOT_WINDOW
+        times, (current_pos, target_pos, current_speed) = self._history.since (start)
+
+        position_height = height * 2 // 3
+        speed_top = 2 * PLOT_MARGIN + position_height
+        speed_height = height - position_height
+
+        cr.set_source_rgb (*PLOT_COLOR_GRID)
+        cr.move_to (PLOT_MARGIN, speed_top - PLOT_MARGIN / 2.0)
+        cr.line_to (PLOT_MARGIN + width, speed_top - PLOT_MARGIN / 2.0)
+        cr.stroke ()
+
+        def decimate (values, color):
+            mins, maxs = decimate_minmax (times, values, start, end, width)
+            return (mins if isinstance (mins, list) else mins.tolist (), maxs if isinstance (maxs, list) else maxs.tolist (), color)
+
+        self._draw_series (cr, (decimate (target_pos, PLOT_COLOR_TARGET_POS), decimate (current_pos, PLOT_COLOR_CURRENT_POS)),
+            PLOT_MARGIN, PLOT_MARGIN, width, position_height)
+        self._draw_series (cr, (decimate (current_speed, PLOT_COLOR_SPEED),), PLOT_MARGIN, speed_top, width, speed_height)
+
+        return False
 
 class ControlWindow (Gtk.Window):
     """
-        Creates an new control window instance.
+        Creates an new control window instance. All I/O runs on a ControlThread, its
+         results are handed back to the main loop with GLib.idle_add.
+        \ control: the connected control.
+        \ scheduler: the PollScheduler deciding when to poll.
     """
-    def __init__ (self, control):
+    def __init__ (self, control, scheduler):
         self._control = control
+        self._control_thread = ControlThread (control)
+        self._destroyed = False
+        self._scheduler = scheduler
+        self._scheduler_key = (control._host, control._port)
 
         Gtk.Window.__init__ (self, title = f"{self._control._host}:{self._control._port}")
         self.connect ("destroy", self._on_destroy)
@@ -290,7 +638,7 @@ class ControlWindow (Gtk.Window):
 
         # Widgets for: self._top_box
 
-        self._top_box.add (Gtk.Label (label = "Update Interval (ms): ", margin_right = 10))
+        self._top_box.add (Gtk.Label (label = "Update Interval While Moving (ms): ", margin_right = 10))
 
         self._top_box_update_interval_spin_button =  Gtk.SpinButton ()
         self._top_box_update_interval_spin_button.set_adjustment (Gtk.Adjustment (upper = 1000, lower = 50, step_increment = 5, page_increment = 5, value = 200))
@@ -325,8 +673,8 @@ class ControlWindow (Gtk.Window):
             motor_box_control_top.add (motor_box_control_top_enable_disable_button)
             motor_box_control_top.add (Gtk.Separator (orientation = Gtk.Orientation.VERTICAL, margin_left = 10, margin_right = 10))
 
-            motor_box_control_top_status_label = Gtk.Label (label = "Pos: */*, Speed: */*/*, NA | NA | NA")
-            motor_box_control_top.add (motor_box_control_top_status_label)
+            motor_box_control_top_status_view = StepperStatusView ()
+            motor_box_control_top.add (motor_box_control_top_status_view)
 
             motor_box_control_bottom_new_pos_spin_button = Gtk.SpinButton ()
             motor_box_control_bottom_new_pos_spin_button.set_adjustment (Gtk.Adjustment (upper = 2_147_483_647, lower = -2_147_483_647, step_increment = 2, page_increment = 10, value = 0))
@@ -339,13 +687,18 @@ class ControlWindow (Gtk.Window):
             motor_box.add (Gtk.Image.new_from_file (os.path.dirname(os.path.realpath(__file__)) + '/assets/stepper.png'))
             motor_box.add (motor_box_control)
 
+            motor_box_plot = StepperPlot ()
+            motor_box_plot.set_margin_start (20)
+            motor_box.pack_end (motor_box_plot, True, True, 0)
+
             self._scroll_box.add (motor_box)
 
             self._scroll_box_motors.append ((
                 motor_box,
                 motor_box_control_top_enable_disable_button,
                 motor_box_control_bottom_new_pos_spin_button,
-                motor_box_control_top_status_label
+                motor_box_control_top_status_view,
+                motor_box_plot
             ))
 
         # Widgets for: self._bottom_box
@@ -361,36 +714,458 @@ class ControlWindow (Gtk.Window):
 
         self.add (self._main_box)
 
-        # Sets the interval with default
-        self._info_change_timeout = GLib.timeout_add (200.0, self._on_info_request_interval)
+        # The snapshot is reused for every poll, it's updated in place.
+        self._snapshot = DeviceSnapshot ()
+
+        # Polls right away, after that the scheduler decides.
+        self._scheduler.add (self._scheduler_key, self._top_box_update_interval_spin_button.get_value () / 1000.0)
+        self._info_change_timeout = None
+        self._info_request_in_flight = False
+        self._schedule_info_request (0.0)
+
+        # The latest values to render, rendering happens at most once per frame.
+        self._render_pending = None
+        self._render_received = None
+        self._render_last = None
+        self._render_tick = None
+        self._plot_sampled = 0.0
+
+        # Called with ((host, port), values) on every result, see add_listener.
+        self._listeners = []
+
+    """
+        Adds a listener, called on the main loop with ((host, port), values) for every
+         stepper info result, values being a list of StepperStatusView.values per stepper.
+        \ listener: the callable.
+    """
+    def add_listener (self, listener):
+        self._listeners.append (listener)
+
+    """
+        Removes a listener.
+        \ listener: the added callable.
+    """
+    def remove_listener (self, listener):
+        if listener in self._listeners:
+            self._listeners.remove (listener)
+
+    """
+        Schedules the next info request.
+        \ delay: seconds from now.
+    """
+    def _schedule_info_request (self, delay):
+        if self._info_change_timeout != None:
+            GLib.source_remove (self._info_change_timeout)
+
+        self._info_change_timeout = GLib.timeout_add (int (delay * 1000.0), self._on_info_request_interval)
 
     def _on_info_interval_change (self, widget):
-        GLib.source_remove (self._info_change_timeout)
-        self._info_change_timeout = GLib.timeout_add (float (widget.get_value ()), self._on_info_request_interval)
+        self._scheduler.set_min_interval (self._scheduler_key, widget.get_value () / 1000.0)
+
+        # Otherwise the new interval is picked up once the outstanding result is in.
+        if not self._info_request_in_flight:
+            self._schedule_info_request (self._scheduler.delay (self._scheduler_key))
 
     def _on_info_request_interval (self):
-        steppers = self._control.get_stepper_info ()
+        # The timeout is one-shot, we're rescheduling it ourselves.
+        self._info_change_timeout = None
 
-        for i, stepper in enumerate (steppers, start = 0):
-            gtk_stepper = self._scroll_box_motors[i]
-            gtk_stepper[3].set_text (f"Pos: {stepper.get('current_pos')}/{stepper.get('target_pos')}, Speed: {stepper.get('current_speed')}/{stepper.get('min_speed')}/{stepper.get('max_speed')}, {'IM' if stepper.get('flags') & CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING else 'NM'} | {'EN' if stepper.get('flags') & CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED else 'NE'} | {'AT' if stepper.get('flags') & CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC else 'MA'}")
-        
-        return True
+        # Waits for the shared request budget.
+        wait = self._scheduler.acquire ()
+        if wait > 0.0:
+            self._schedule_info_request (wait)
+            return False
+
+        # The snapshot is only written by the I/O thread while this request is in flight,
+        #  the next one is scheduled once the result has been handled.
+        self._info_request_in_flight = True
+        future = self._control_thread.get_stepper_state (self._snapshot)
+        future.add_done_callback (lambda future: GLib.idle_add (self._on_stepper_state, future))
+
+        return False
+
+    """
+        Gets called on the main loop once the stepper info request completed.
+    """
+    def _on_stepper_state (self, future):
+        if self._destroyed:
+            return False
+
+        self._info_request_in_flight = False
+
+        try:
+            snapshot = future.result ()
+        except Exception as e:
+            print (f"Stepper info request to {self._control._host}:{self._control._port} failed: {e}")
+            snapshot = None
+
+        if snapshot == None:
+            self._scheduler.record_failure (self._scheduler_key)
+        else:
+            self._scheduler.record (self._scheduler_key, snapshot.any_moving ())
+
+            # Copied out, since the snapshot gets reused by the next request.
+            values = [ StepperStatusView.values (stepper) for stepper in snapshot.steppers ]
+
+            for listener in list (self._listeners):
+                listener (self._scheduler_key, values)
+
+            self._render_pending = values
+            self._render_received = time.monotonic ()
+
+            # Changed values are rendered with the next frame, an idle device only wakes
+            #  the frame clock to scroll the plots once per PLOT_IDLE_INTERVAL.
+            if self._render_tick == None and (values != self._render_last or self._render_received - self._plot_sampled >= PLOT_IDLE_INTERVAL):
+                self._render_tick = self.add_tick_callback (self._on_render_tick)
+
+        # The I/O thread is gone once the connection failed.
+        if self._control_thread._running:
+            self._schedule_info_request (self._scheduler.delay (self._scheduler_key))
+
+        return False
+
+    """
+        Renders the latest stepper values and samples them into the plots, once per frame
+         at most, since any results arriving in between replace the pending ones.
+    """
+    def _on_render_tick (self, widget, frame_clock):
+        self._render_tick = None
+
+        values = self._render_pending
+        self._render_pending = None
+
+        if values != self._render_last:
+            for stepper_values, gtk_stepper in zip (values, self._scroll_box_motors):
+                gtk_stepper[3].render (stepper_values)
+
+            self._render_last = values
+
+        for stepper_values, gtk_stepper in zip (values, self._scroll_box_motors):
+            gtk_stepper[4].append (self._render_received, stepper_values)
+            gtk_stepper[4].queue_draw ()
+
+        self._plot_sampled = self._render_received
+
+        return GLib.SOURCE_REMOVE
+
+    """
+        Reports a failed command, called from the I/O thread.
+    """
+    def _on_command_done (self, future):
+        if future.exception () != None:
+            print (f"Command to {self._control._host}:{self._control._port} failed: {future.exception ()}")
 
     def _on_stepper_enable_disable_toggle(self, widget, gparam, stepper_n):
-        self._control.stepper_enable_disable (stepper_n, widget.get_active ())
+        self._control_thread.stepper_enable_disable (stepper_n, widget.get_active ()).add_done_callback (self._on_command_done)
 
     def _on_trigger_movement_pressed (self, widget, stepper_n):
         gtk_motor = self._scroll_box_motors[stepper_n]
         new_pos = int (gtk_motor[2].get_value ())
-        self._control.send_stepper_move_to (stepper_n, new_pos)
+        self._control_thread.send_stepper_move_to (stepper_n, new_pos).add_done_callback (self._on_command_done)
 
     def _on_close_connection_pressed (self, widget):
         self.destroy ()
 
     def _on_destroy (self, widget):
-        GLib.source_remove (self._info_change_timeout)
-        self._control._reset ()
+        self._destroyed = True
+
+        if self._render_tick != None:
+            self.remove_tick_callback (self._render_tick)
+            self._render_tick = None
+
+        if self._info_change_timeout != None:
+            GLib.source_remove (self._info_change_timeout)
+            self._info_change_timeout = None
+
+        self._scheduler.remove (self._scheduler_key)
+
+        # Closing joins the I/O thread, which may still be waiting on the device.
+        threading.Thread (target = self._control_thread.close, daemon = True).start ()
+
+class FleetWindow (Gtk.Window):
+    """
+        Creates new fleet dashboard, showing the live status of every device and stepper
+         in a single tree view. All devices are polled by one ControlPool on an event loop
+         thread, on the schedule of the shared PollScheduler. Devices with a control window
+         are shown from its results instead, since a device only accepts one session.
+         Snapshots are collected and applied to the model in batches on the main loop,
+         only touching the rows whose values changed. The tree view uses fixed height
+         mode, so only the visible rows are ever measured and drawn.
+        \ devices: the (name, ip, port) to show.
+        \ scheduler: the PollScheduler shared with the control windows.
+        \ control_windows: the open ControlWindow per (host, port).
+    """
+    def __init__ (self, devices, scheduler, control_windows):
+        Gtk.Window.__init__ (self, title = FLEET_WINDOW_TITLE)
+        self.resize (FLEET_WINDOW_SIZE[0], FLEET_WINDOW_SIZE[1])
+        self.connect ("destroy", self._on_destroy)
+
+        self._main_box = Gtk.Box (orientation=Gtk.Orientation.VERTICAL)
+
+        # Widgets for: self._main_box
+
+        self._scroll_box = Gtk.ScrolledWindow ()
+        self._bottom_box = Gtk.Box (orientation=Gtk.Orientation.HORIZONTAL, margin = 10)
+
+        self._main_box.pack_start (self._scroll_box, True, True, 0)
+        self._main_box.pack_end (self._bottom_box, False, True, 0)
+        self._main_box.pack_end (Gtk.Separator (orientation = Gtk.Orientation.HORIZONTAL), False, True, 0)
+
+        # Widgets for: self._scroll_box
+
+        # Device rows: name, address, "", status, stepper count. Stepper rows: "", "", index, and its values.
+        self._tree_store = Gtk.TreeStore (str, str, str, str, str, str, str, str, str, str)
+
+        self._tree_view = Gtk.TreeView ()
+        self._tree_view.set_fixed_height_mode (True)
+
+        columns = ("Name", "IP Address", "Stepper", "Status", "Pos", "Target", "Speed", "Min Speed", "Max Speed", "Flags")
+        widths = (160, 120, 60, 80, 100, 100, 70, 80, 80, 120)
+        for i, (title, width) in enumerate (zip (columns, widths)):
+            column = Gtk.TreeViewColumn (title, Gtk.CellRendererText (), text = i)
+            column.set_sizing (Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width (width)
+            column.set_resizable (True)
+            self._tree_view.append_column (column)
+
+        self._scroll_box.add (self._tree_view)
+
+        # Widgets for: self._bottom_box
+
+        self._bottom_box_label = Gtk.Label (label = f"Polling {len (devices)} devices")
+        self._bottom_box.pack_end (self._bottom_box_label, True, True, 5)
+
+        self.add (self._main_box)
+
+        # Filled before the model is attached, so the view doesn't process every insert.
+        self._device_rows = {}
+        for name, ip, port in devices:
+            key = (ip, port)
+            if key not in self._device_rows:
+                self._device_rows[key] = self._tree_store.append (None, [ name, f"{ip}:{port}", "", DEVICE_STATUS_WAITING, "", "", "", "", "", "" ])
+
+        self._tree_view.set_model (self._tree_store)
+
+        # Per device: the rendered stepper values, their child rows, the time.monotonic of the
+        #  last snapshot and the shown status. Devices which never answer turn stale as well.
+        self._rendered = {}
+        self._stepper_rows = {}
+        self._updated = dict.fromkeys (self._device_rows, time.monotonic ())
+        self._status = dict.fromkeys (self._device_rows, DEVICE_STATUS_WAITING)
+
+        # Written on the event loop thread, swapped out on the main loop.
+        self._pending = {}
+        self._pending_lock = threading.Lock ()
+        self._flush_scheduled = False
+
+        self._stale_check = GLib.timeout_add (FLEET_STALE_CHECK_INTERVAL, self._on_stale_check)
+
+        # Only touched from the event loop thread, except for the scheduler.
+        self._scheduler = scheduler
+        self._pool = ControlPool ()
+        self._tasks = {}
+
+        # The control windows whose results are shown, per (host, port).
+        self._attached = {}
+        for key, controlWindow in control_windows.items ():
+            self.attach (controlWindow)
+
+        self._loop = asyncio.new_event_loop ()
+        self._poll_task = self._loop.create_task (self._poll ([ key for key in self._device_rows if key not in self._attached ]))
+        self._thread = threading.Thread (target = self._run_loop, daemon = True)
+        self._thread.start ()
+
+    """
+        Stops polling a device and closes its session, so a control window can connect.
+         Returns a concurrent.futures.Future resolving once the session is closed.
+        \ key: the (host, port) of the device.
+    """
+    def release (self, key):
+        try:
+            return asyncio.run_coroutine_threadsafe (self._release (key), self._loop)
+        except RuntimeError:
+            # The loop is closed already, so are the sessions.
+            future = concurrent.futures.Future ()
+            future.set_result (None)
+            return future
+
+    """
+        Shows a device from the results of its control window, instead of polling it.
+        \ controlWindow: the ControlWindow.
+    """
+    def attach (self, controlWindow):
+        key = controlWindow._scheduler_key
+        if key not in self._device_rows or key in self._attached:
+            return
+
+        controlWindow.add_listener (self._on_values)
+        self._attached[key] = controlWindow
+
+    """
+        Polls a device again, once its control window is gone.
+        \ key: the (host, port) of the device.
+    """
+    def adopt (self, key):
+        if key not in self._device_rows:
+            return
+
+        controlWindow = self._attached.pop (key, None)
+        if controlWindow != None:
+            controlWindow.remove_listener (self._on_values)
+
+        try:
+            self._loop.call_soon_threadsafe (self._adopt, key)
+        except RuntimeError:
+            pass
+
+    """
+        Runs the event loop until polling was cancelled, on the event loop thread.
+    """
+    def _run_loop (self):
+        try:
+            self._loop.run_until_complete (self._poll_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close ()
+
+    """
+        Polls the given devices until cancelled, on the event loop thread.
+        \ keys: the (host, port) of the devices.
+    """
+    async def _poll (self, keys):
+        for key in keys:
+            self._adopt (key)
+
+        try:
+            await asyncio.Event ().wait ()
+        finally:
+            for key in list (self._tasks):
+                await self._release (key)
+
+            await self._pool.close ()
+
+    """
+        Starts polling a device, on the event loop thread.
+    """
+    def _adopt (self, key):
+        if key in self._tasks:
+            return
+
+        self._pool.add (key[0], key[1])
+        self._tasks[key] = asyncio.ensure_future (self._scheduler.run_device (self._pool, key, self._on_snapshot))
+
+    """
+        Stops polling a device and closes its session, on the event loop thread.
+    """
+    async def _release (self, key):
+        task = self._tasks.pop (key, None)
+        if task == None:
+            return
+
+        task.cancel ()
+        await asyncio.gather (task, return_exceptions = True)
+
+        self._scheduler.remove (key)
+        await self._pool.remove (key)
+
+    """
+        Gets called on the event loop thread after every successful poll.
+    """
+    def _on_snapshot (self, key, snapshot):
+        # Copied out, since the pool reuses the snapshot. The number of steppers follows the has_next chain.
+        self._on_values (key, [ StepperStatusView.values (stepper) for stepper in snapshot.steppers ])
+
+    """
+        Queues the stepper values of a device, from any thread. Only the latest values per
+         device are kept, and a single flush is scheduled per batch.
+    """
+    def _on_values (self, key, values):
+        with self._pending_lock:
+            self._pending[key] = values
+
+            if self._flush_scheduled:
+                return
+
+            self._flush_scheduled = True
+
+        GLib.idle_add (self._on_flush)
+
+    """
+        Applies the queued values to the model, on the main loop.
+    """
+    def _on_flush (self):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = {}
+            self._flush_scheduled = False
+
+        if self._tree_view.get_model () == None:
+            return False
+
+        now = time.monotonic ()
+        store = self._tree_store
+
+        for key, values in pending.items ():
+            device_row = self._device_rows[key]
+            rendered = self._rendered.setdefault (key, [])
+            stepper_rows = self._stepper_rows.setdefault (key, [])
+
+            self._updated[key] = now
+
+            if self._status[key] != DEVICE_STATUS_ONLINE or len (values) != len (rendered):
+                self._status[key] = DEVICE_STATUS_ONLINE
+                store.set (device_row, [ 3, 4 ], [ DEVICE_STATUS_ONLINE, f"{len (values)} steppers" ])
+
+            # The child rows follow the number of steppers the device reported.
+            while len (stepper_rows) > len (values):
+                store.remove (stepper_rows.pop ())
+                rendered.pop ()
+
+            while len (stepper_rows) < len (values):
+                stepper_rows.append (store.append (device_row, [ "", "", str (len (stepper_rows)), "", "", "", "", "", "", "" ]))
+                rendered.append (None)
+
+            for i, stepper_values in enumerate (values):
+                if stepper_values == rendered[i]:
+                    continue
+
+                current_pos, target_pos, current_speed, min_speed, max_speed, flags = stepper_values
+                store.set (stepper_rows[i], [ 4, 5, 6, 7, 8, 9 ],
+                    [ str (current_pos), str (target_pos), str (current_speed), str (min_speed), str (max_speed), stepper_flags_text (flags) ])
+                rendered[i] = stepper_values
+
+        return False
+
+    """
+        Marks the devices which haven't been polled successfully for a while as stale.
+    """
+    def _on_stale_check (self):
+        now = time.monotonic ()
+
+        for key, updated in self._updated.items ():
+            if now - updated > FLEET_STALE_AFTER and self._status[key] != DEVICE_STATUS_STALE:
+                self._status[key] = DEVICE_STATUS_STALE
+                self._tree_store.set (self._device_rows[key], [ 3 ], [ DEVICE_STATUS_STALE ])
+
+        return True
+
+    def _on_destroy (self, widget):
+        GLib.source_remove (self._stale_check)
+
+        # Detached, so a flush still queued does nothing.
+        self._tree_view.set_model (None)
+
+        for key, controlWindow in self._attached.items ():
+            controlWindow.remove_listener (self._on_values)
+
+        self._attached = {}
+
+        # The pool closes its sessions once the task is cancelled, the loop may be gone already.
+        try:
+            self._loop.call_soon_threadsafe (self._poll_task.cancel)
+        except RuntimeError:
+            pass
 
 
 
@@ -0,0 +1,440 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bisect
+import math
+import time
+
+from codec import CONTROL_PACKET_MOTOR_MOVE_TO_SIZE, CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING, DeviceSnapshot, encode_move_to_into, np
+from control import ControlThread
+
+####
+## Global Constants
+####
+
+MOTION_PROFILE_TRAPEZOID = "trapezoid"
+MOTION_PROFILE_S_CURVE = "s-curve"
+
+MOTION_DT = 0.02 # seconds between trajectory samples
+MOTION_LOOKAHEAD = 8 # samples the streamed target may run ahead of the device
+MOTION_POLL_MIN = 0.01 # seconds
+MOTION_POLL_MAX = 0.1 # seconds
+MOTION_STALL_TIMEOUT = 2.0 # seconds without progress before streaming fails
+
+# Per profile: how much longer than a constant acceleration ramp the ramp takes, so its
+#  peak acceleration stays within the limit. The S-curve ramp follows a smoothstep speed.
+_RAMP_LENGTH = { MOTION_PROFILE_TRAPEZOID: 1.0, MOTION_PROFILE_S_CURVE: 1.5 }
+
+####
+## Classes
+####
+
+class GroupMoveReport:
+    """
+        Creates new group move report.
+        \ start_ns: time.perf_counter_ns when the dispatch started.
+        \ sent_ns: list of (device, time.perf_counter_ns) at which each device's write completed.
+    """
+    def __init__ (self, start_ns, sent_ns):
+        self.start_ns = start_ns
+        self.sent_ns = sent_ns
+
+    """
+        Gets the time between the first and the last device write completing.
+    """
+    @property
+    def skew_ns (self):
+        if len (self.sent_ns) == 0:
+            return 0
+
+        times = [ sent for _, sent in self.sent_ns ]
+        return max (times) - min (times)
+
+    """
+        Gets the time from the start of the dispatch until the last device write completed.
+    """
+    @property
+    def duration_ns (self):
+        if len (self.sent_ns) == 0:
+            return 0
+
+        return max (sent for _, sent in self.sent_ns) - self.start_ns
+
+    def __repr__ (self):
+        return f"GroupMoveReport(devices={len (self.sent_ns)}, skew={self.skew_ns / 1000.0:.1f}us, duration={self.duration_ns / 1000.0:.1f}us)"
+
+class GroupMove:
+    """
+        Creates new group move, which encodes the StepperMoveTo frames of all targets up
+         front, so dispatching is nothing but one vectored write per device.
+
+        Devices may be Control or ControlThread instances. A ControlThread writes from its
+         own I/O thread, so those devices are dispatched in parallel. Plain Control
+         devices are written back to back from the calling thread, which costs a few
+         microseconds per device.
+
+        \ targets: iterable of (device, stepper, pos).
+    """
+    def __init__ (self, targets):
+        self._groups = []
+
+        # Groups the targets per device, keeping their order.
+        per_device = {}
+        for device, stepper, pos in targets:
+            if id (device) not in per_device:
+                per_device[id (device)] = (device, [])
+
+            per_device[id (device)][1].append ((stepper, pos))
+
+        # Encodes every device's frames into one buffer, split into per-frame views.
+        for device, moves in per_device.values ():
+            buffer = bytearray (len (moves) * CONTROL_PACKET_MOTOR_MOVE_TO_SIZE)
+            view = memoryview (buffer)
+
+            offset = 0
+            frames = []
+            for stepper, pos in moves:
+                end = encode_move_to_into (buffer, offset, stepper, pos)
+                frames.append (view[offset:end])
+                offset = end
+
+            self._groups.append ((device, frames))
+
+    """
+        Sends all frames, and returns a GroupMoveReport with the measured skew.
+    """
+    def dispatch (self):
+        start_ns = time.perf_counter_ns ()
+        sent_ns = []
+        futures = []
+
+        # Queues the threaded devices first, so they run while we write the rest.
+        for device, frames in self._groups:
+            if isinstance (device, ControlThread):
+                futures.append ((device, device.send_frames (frames)))
+
+        for device, frames in self._groups:
+            if not isinstance (device, ControlThread):
+                device.send_frames (frames)
+                sent_ns.append ((device, time.perf_counter_ns ()))
+
+        for device, future in futures:
+            sent_ns.append ((device, future.result ()))
+
+        return GroupMoveReport (start_ns, sent_ns)
+
+class Trajectory:
+    """
+        Creates new trajectory, the positions of one or more axes sampled every dt.
+        \ times: the sample times in seconds from the start.
+        \ positions: per sample, the position of every axis.
+        \ dt: the sample interval.
+    """
+    def __init__ (self, times, positions, dt):
+        self.times = times
+        self.positions = positions
+        self.dt = dt
+
+    def __len__ (self):
+        return len (self.times)
+
+    """
+        Gets the duration in seconds.
+    """
+    @property
+    def duration (self):
+        return float (self.times[-1]) if len (self.times) > 0 else 0.0
+
+    """
+        Gets the positions rounded to steps, as a list of tuples.
+    """
+    def steps (self):
+        if np != None and not isinstance (self.positions, list):
+            return [ tuple (sample) for sample in np.rint (self.positions).astype (np.int64).tolist () ]
+
+        return [ tuple (int (round (position)) for position in sample) for sample in self.positions ]
+
+class TrajectoryStreamer:
+    """
+        Creates new trajectory streamer, which feeds a trajectory to a device as a moving
+         StepperMoveTo target.
+
+        The target of every axis runs up to lookahead samples ahead of where the device
+         actually is, according to the current_pos of its stepper info, so the steppers
+         never come to a halt at intermediate targets. It also never runs more than
+         lookahead samples ahead of the trajectory timing, so the device follows the
+         planned speed profile instead of its own. The poll interval follows from how
+         long the device needs to reach its target at its current_speed.
+
+        \ device: a connected Control or ControlThread.
+        \ steppers: the stepper of every trajectory axis.
+        \ trajectory: the Trajectory.
+        \ lookahead: max samples the target runs ahead.
+        \ stall_timeout: seconds without progress before streaming fails.
+    """
+    def __init__ (self, device, steppers, trajectory, lookahead = MOTION_LOOKAHEAD, stall_timeout = MOTION_STALL_TIMEOUT):
+        assert (lookahead >= 1)
+        assert (len (trajectory) > 0)
+
+        self._device = device
+        self._steppers = list (steppers)
+        self._trajectory = trajectory
+        self._samples = trajectory.steps ()
+        self._lookahead = lookahead
+        self._stall_timeout = stall_timeout
+
+        assert (len (self._samples[0]) == len (self._steppers))
+
+        # The sample the device reached, and the one last sent as target.
+        self._reached = 0
+        self._sent = -1
+        self._started = None
+        self._progressed = None
+
+        self._snapshot = DeviceSnapshot ()
+
+    """
+        Gets the sample index the device reached, the lowest over all axes which move
+         between the reached and the sent sample.
+        \ positions: the current_pos of every axis.
+    """
+    def _progress (self, positions):
+        window = self._samples[self._reached:self._sent + 1]
+        progress = self._sent
+
+        for axis, position in enumerate (positions):
+            first = window[0][axis]
+            if all (sample[axis] == first for sample in window):
+                continue
+
+            # The last of the nearest samples, since the device may sit on a plateau.
+            nearest = min (range (len (window) - 1, -1, -1), key = lambda i: abs (window[i][axis] - position))
+            progress = min (progress, self._reached + nearest)
+
+        return progress
+
+    """
+        Handles one stepper info result, sends the new targets and returns the seconds
+         until the next poll, or None once the trajectory completed.
+        \ snapshot: the DeviceSnapshot.
+        \ now: the current time.monotonic.
+    """
+    def step (self, snapshot, now):
+        if self._started == None:
+            self._started = self._progressed = now
+
+        states = [ snapshot.steppers[stepper] for stepper in self._steppers ]
+        positions = [ state.current_pos for state in states ]
+
+        last = len (self._samples) - 1
+
+        if self._sent >= 0:
+            reached = self._progress (positions)
+            if reached > self._reached:
+                self._reached = reached
+                self._progressed = now
+
+        if self._sent == last and list (self._samples[last]) == positions and not any (state.flags & CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING for state in states):
+            return None
+
+        if now - self._progressed > self._stall_timeout:
+            raise TimeoutError (f"Trajectory stalled at sample {self._reached} of {len (self._samples)}")
+
+        # Ahead of the device, but never too far ahead of the planned timing.
+        planned = int ((now - self._started) / self._trajectory.dt)
+        target = min (last, self._reached + self._lookahead, planned + self._lookahead)
+
+        if target > self._sent:
+            previous = self._samples[self._sent] if self._sent >= 0 else None
+            sample = self._samples[target]
+
+            moves = [ (self._device, stepper, pos) for axis, (stepper, pos) in enumerate (zip (self._steppers, sample))
+                if previous == None or previous[axis] != pos ]
+            if len (moves) > 0:
+                group_move (moves)
+
+            self._sent = target
+
+        # Polls about halfway through the slowest axis reaching its target.
+        delay = MOTION_POLL_MAX
+        for state, position, pos in zip (states, positions, self._samples[self._sent]):
+            if position != pos:
+                delay = min (delay, abs (pos - position) / max (1, state.current_speed) / 2.0)
+
+        return max (MOTION_POLL_MIN, delay)
+
+    """
+        Streams the whole trajectory, blocks until the device reached its end.
+    """
+    def run (self):
+        while True:
+            if isinstance (self._device, ControlThread):
+                snapshot = self._device.get_stepper_state (self._snapshot).result ()
+            else:
+                snapshot = self._device.get_stepper_state (self._snapshot)
+
+            if snapshot == None:
+                raise ConnectionError ("Stepper info request failed while streaming a trajectory")
+
+            delay = self.step (snapshot, time.monotonic ())
+            if delay == None:
+                return
+
+            time.sleep (delay)
+
+####
+## Functions
+####
+
+"""
+    Moves a group of steppers across one or more devices together.
+    \ targets: iterable of (device, stepper, pos).
+"""
+def group_move (targets):
+    return GroupMove (targets).dispatch ()
+
+"""
+    Gets the part of a ramp covered at x, from 0 to 1, with ramp (1) == 0.5.
+"""
+def _ramp (x, profile):
+    if profile == MOTION_PROFILE_TRAPEZOID:
+        return x * x / 2.0
+
+    return x * x * x - x * x * x * x / 2.0
+
+"""
+    Plans a trajectory through the given waypoints, stopping at each of them. Every
+     segment is a trapezoidal or S-curve move of the axis with the longest distance, the
+     other axes follow in proportion, so all of them arrive together. The segments are
+     planned together with NumPy if available, so thousands of them take about as long
+     as one.
+    \ waypoints: the positions to pass, the first is the start. A number per waypoint for
+     a single axis, or a tuple with one per axis.
+    \ max_speed: the max speed in steps per second.
+    \ accel: the max acceleration in steps per second squared.
+    \ dt: the sample interval in seconds.
+    \ profile: MOTION_PROFILE_TRAPEZOID or MOTION_PROFILE_S_CURVE.
+"""
+def plan_trajectory (waypoints, max_speed, accel, dt = MOTION_DT, profile = MOTION_PROFILE_TRAPEZOID):
+    assert (max_speed > 0 and accel > 0 and dt > 0)
+    assert (profile in _RAMP_LENGTH)
+    assert (len (waypoints) > 0)
+
+    ramp_length = _RAMP_LENGTH[profile]
+
+    if np == None:
+        return _plan_trajectory_python (waypoints, max_speed, accel, dt, profile, ramp_length)
+
+    points = np.asarray (waypoints, dtype = np.float64)
+    if points.ndim == 1:
+        points = points[:, None]
+
+    delta = np.diff (points, axis = 0)
+    distance = np.abs (delta).max (axis = 1, initial = 0.0)
+
+    # Segments without any movement take no time.
+    moving = distance > 0.0
+    starts = points[:-1][moving]
+    delta = delta[moving]
+    distance = distance[moving]
+
+    if len (distance) == 0:
+        return Trajectory (np.zeros (1), points[:1].copy (), dt)
+
+    # Short segments don't reach max_speed, both ramps take half of the distance then.
+    speed = np.minimum (max_speed, np.sqrt (distance * accel / ramp_length))
+    ramp = ramp_length * speed / accel
+    cruise = np.maximum (0.0, distance / speed - ramp)
+    duration = 2.0 * ramp + cruise
+
+    ends = np.cumsum (duration)
+    times = np.append (np.arange (0.0, ends[-1], dt), ends[-1])
+
+    segment = np.minimum (np.searchsorted (ends, times, side = "right"), len (ends) - 1)
+    t = times - (ends - duration)[segment]
+
+    speed = speed[segment]
+    ramp = ramp[segment]
+    cruise = cruise[segment]
+    duration = duration[segment]
+
+    # Accelerating, cruising and decelerating, each part clipped to its own time span.
+    covered = speed * ramp * _ramp (np.clip (t / ramp, 0.0, 1.0), profile)
+    covered += speed * np.clip (t - ramp, 0.0, cruise)
+    covered += speed * ramp * (0.5 - _ramp (np.clip ((duration - t) / ramp, 0.0, 1.0), profile))
+
+    positions = starts[segment] + delta[segment] * (covered / distance[segment])[:, None]
+    return Trajectory (times, positions, dt)
+
+"""
+    Plans a trajectory without NumPy, see plan_trajectory.
+"""
+def _plan_trajectory_python (waypoints, max_speed, accel, dt, profile, ramp_length):
+    points = [ tuple (float (p) for p in waypoint) if isinstance (waypoint, (tuple, list)) else (float (waypoint),) for waypoint in waypoints ]
+
+    segments = []
+    ends = []
+    end = 0.0
+
+    for start, stop in zip (points, points[1:]):
+        delta = [ b - a for a, b in zip (start, stop) ]
+        distance = max (abs (d) for d in delta)
+        if distance == 0.0:
+            continue
+
+        speed = min (max_speed, math.sqrt (distance * accel / ramp_length))
+        ramp = ramp_length * speed / accel
+        cruise = max (0.0, distance / speed - ramp)
+        duration = 2.0 * ramp + cruise
+
+        segments.append ((start, delta, distance, speed, ramp, cruise, duration))
+        end += duration
+        ends.append (end)
+
+    if len (segments) == 0:
+        return Trajectory ([ 0.0 ], [ points[0] ], dt)
+
+    times = [ i * dt for i in range (0, int (math.ceil (end / dt))) if i * dt < end ] + [ end ]
+    positions = []
+
+    for sample_time in times:
+        i = min (bisect.bisect_right (ends, sample_time), len (ends) - 1)
+        start, delta, distance, speed, ramp, cruise, duration = segments[i]
+        t = sample_time - (ends[i] - duration)
+
+        covered = speed * ramp * _ramp (min (1.0, max (0.0, t / ramp)), profile)
+        covered += speed * min (cruise, max (0.0, t - ramp))
+        covered += speed * ramp * (0.5 - _ramp (min (1.0, max (0.0, (duration - t) / ramp)), profile))
+
+        positions.append (tuple (a + d * covered / distance for a, d in zip (start, delta)))
+
+    return Trajectory (times, positions, dt)
+
+"""
+    Plans a trajectory and streams it to a device, see plan_trajectory and TrajectoryStreamer.
+    \ device: a connected Control or ControlThread.
+    \ steppers: the stepper of every axis.
+    \ waypoints: the positions to pass, the first is the start.
+    \ max_speed: the max speed in steps per second.
+    \ accel: the max acceleration in steps per second squared.
+    \ profile: MOTION_PROFILE_TRAPEZOID or MOTION_PROFILE_S_CURVE.
+"""
+def follow_path (device, steppers, waypoints, max_speed, accel, profile = MOTION_PROFILE_TRAPEZOID):
+    trajectory = plan_trajectory (waypoints, max_speed, accel, profile = profile)
+    TrajectoryStreamer (device, steppers, trajectory).run ()
+    return trajectory
@@ -0,0 +1,168 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import array
+import math
+
+from codec import np
+
+####
+## Global Constants
+####
+
+PLOT_CAPACITY = 4096 # samples kept per plot
+PLOT_WINDOW = 20.0 # seconds shown
+PLOT_IDLE_INTERVAL = 1.0 # seconds between redraws while nothing changes
+PLOT_SIZE = (360, 90)
+PLOT_MARGIN = 2
+
+# Series colors as (r, g, b).
+PLOT_COLOR_CURRENT_POS = (0.13, 0.45, 0.80)
+PLOT_COLOR_TARGET_POS = (0.85, 0.33, 0.10)
+PLOT_COLOR_SPEED = (0.20, 0.63, 0.17)
+PLOT_COLOR_BACKGROUND = (0.12, 0.12, 0.12)
+PLOT_COLOR_GRID = (0.30, 0.30, 0.30)
+
+####
+## Functions
+####
+
+"""
+    Decimates time-sorted samples to one (min, max) pair per pixel column, so drawing
+     costs the same no matter how many samples there are. Columns without samples get
+     NaN. Returns (mins, maxs), as NumPy arrays if available, else as lists.
+    \ times: the sample times, ascending.
+    \ values: the sample values.
+    \ start: the time at the left edge.
+    \ end: the time at the right edge.
+    \ width: the number of columns.
+"""
+def decimate_minmax (times, values, start, end, width):
+    assert (end > start)
+    assert (width > 0)
+
+    scale = width / (end - start)
+
+    if np != None:
+        mins = np.full (width, np.nan)
+        maxs = np.full (width, np.nan)
+
+        if len (times) == 0:
+            return mins, maxs
+
+        columns = np.clip (((np.asarray (times) - start) * scale).astype (np.int64), 0, width - 1)
+        values = np.asarray (values, dtype = np.float64)
+
+        # The columns are sorted, so every run of equal columns can be reduced at once.
+        starts = np.flatnonzero (np.diff (columns, prepend = -1))
+        mins[columns[starts]] = np.minimum.reduceat (values, starts)
+        maxs[columns[starts]] = np.maximum.reduceat (values, starts)
+
+        return mins, maxs
+
+    mins = [ math.nan ] * width
+    maxs = [ math.nan ] * width
+
+    for time, value in zip (times, values):
+        column = min (width - 1, max (0, int ((time - start) * scale)))
+
+        if math.isnan (mins[column]) or value < mins[column]:
+            mins[column] = value
+        if math.isnan (maxs[column]) or value > maxs[column]:
+            maxs[column] = value
+
+    return mins, maxs
+
+####
+## Classes
+####
+
+class RingBuffer:
+    """
+        Creates new fixed-size ring buffer of timestamped samples, with one or more value
+         columns. Appending never allocates, the oldest sample is overwritten once full.
+        \ capacity: the max number of samples.
+        \ columns: the number of values per sample.
+    """
+    def __init__ (self, capacity = PLOT_CAPACITY, columns = 1):
+        assert (capacity > 0)
+
+        self._capacity = capacity
+        self._count = 0
+        self._next = 0
+
+        if np != None:
+            self._times = np.zeros (capacity, dtype = np.float64)
+            self._values = [ np.zeros (capacity, dtype = np.float64) for _ in range (0, columns) ]
+        else:
+            self._times = array.array ("d", bytes (8 * capacity))
+            self._values = [ array.array ("d", bytes (8 * capacity)) for _ in range (0, columns) ]
+
+    def __len__ (self):
+        return self._count
+
+    """
+        Appends a sample.
+        \ time: the sample time.
+        \ values: one value per column.
+    """
+    def append (self, time, *values):
+        i = self._next
+
+        self._times[i] = time
+        for column, value in zip (self._values, values):
+            column[i] = value
+
+        self._next = (i + 1) % self._capacity
+        self._count = min (self._count + 1, self._capacity)
+
+    """
+        Gets the samples from the given time on, oldest first, as (times, [ values per column ]).
+        \ start: the first time to include, or None for all samples.
+    """
+    def since (self, start = None):
+        first = (self._next - self._count) % self._capacity
+
+        if first + self._count <= self._capacity:
+            times = self._times[first:first + self._count]
+            values = [ column[first:first + self._count] for column in self._values ]
+        elif np != None:
+            times = np.concatenate ((self._times[first:], self._times[:self._next]))
+            values = [ np.concatenate ((column[first:], column[:self._next])) for column in self._values ]
+        else:
+            times = self._times[first:] + self._times[:self._next]
+            values = [ column[first:] + column[:self._next] for column in self._values ]
+
+        if start != None:
+            # The samples are in time order, so a binary search finds the cut.
+            if np != None:
+                cut = int (np.searchsorted (times, start))
+            else:
+                low, high = 0, len (times)
+                while low < high:
+                    middle = (low + high) // 2
+                    if times[middle] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+                cut = low
+
+            times = times[cut:]
+            values = [ column[cut:] for column in values ]
+
+        return times, values
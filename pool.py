@@ -0,0 +1,241 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import sys
+import time
+
+from async_control import ASYNC_CONTROL_TIMEOUT, AsyncControl
+from codec import DeviceSnapshot
+from control import CONTROL_PORT
+
+####
+## Global Constants
+####
+
+CONTROL_POOL_RECONNECT_INTERVAL = 1.0
+
+####
+## Classes
+####
+
+class ControlPool:
+    """
+        Creates new control pool, which keeps one protocol-level AsyncControl session per
+         (host, port) on the running event loop. Sessions are connected on first use,
+         dropped when they fail, and reconnected lazily on the next use.
+        \ timeout: the AsyncControl connect / response timeout.
+        \ reconnect_interval: min seconds between connection attempts to a failed device.
+    """
+    def __init__ (self, timeout = ASYNC_CONTROL_TIMEOUT, reconnect_interval = CONTROL_POOL_RECONNECT_INTERVAL, silent = True):
+        self._timeout = timeout
+        self._reconnect_interval = reconnect_interval
+        self._silent = silent
+
+        self._devices = set ()
+        self._sessions = {}
+        self._connecting = {}
+        self._failures = {}
+        self._snapshots = {}
+
+    """
+        Adds a device to the pool, it's connected on first use.
+        \ host: the IPv4 address of the device.
+        \ port: the port of the device.
+    """
+    def add (self, host, port = CONTROL_PORT):
+        key = (host, port)
+        self._devices.add (key)
+        return key
+
+    """
+        Removes a device from the pool, and closes its session.
+        \ key: the (host, port) of the device.
+    """
+    async def remove (self, key):
+        self._devices.discard (key)
+        self._failures.pop (key, None)
+        self._snapshots.pop (key, None)
+
+        # A connect still in flight would store its session after we dropped it.
+        task = self._connecting.pop (key, None)
+        if task != None:
+            task.cancel ()
+            await asyncio.gather (task, return_exceptions = True)
+
+        await self._drop (key)
+
+    """
+        Gets the (host, port) of all devices in the pool.
+    """
+    def keys (self):
+        return list (self._devices)
+
+    """
+        Gets the latest snapshot of a device, as stored by poll_all.
+        \ key: the (host, port) of the device.
+    """
+    def snapshot (self, key):
+        return self._snapshots.get (key)
+
+    """
+        Gets the connected session of a device, connecting it if required. Concurrent
+         callers share a single connection attempt.
+        \ key: the (host, port) of the device.
+    """
+    async def get (self, key):
+        session = self._sessions.get (key)
+        if session != None and session._connected:
+            return session
+
+        self._devices.add (key)
+
+        task = self._connecting.get (key)
+        if task == None:
+            task = asyncio.ensure_future (self._connect (key))
+            self._connecting[key] = task
+
+            # Clears the entry however the attempt ends, the result stays with the waiters.
+            task.add_done_callback (lambda _: self._connecting.pop (key, None))
+
+        return await asyncio.shield (task)
+
+    """
+        Connects a session, unless the device failed too recently.
+        \ key: the (host, port) of the device.
+    """
+    async def _connect (self, key):
+        failed = self._failures.get (key)
+        if failed != None and time.monotonic () - failed < self._reconnect_interval:
+            raise ConnectionError (f"Device {key[0]}:{key[1]} failed recently, not reconnecting yet")
+
+        session = AsyncControl (key[0], key[1], self._timeout, self._silent)
+
+        try:
+            await session.tcp_connect ()
+            if not await session.proto_connect ():
+                raise ConnectionRefusedError (f"Connection rejected by {key[0]}:{key[1]}")
+        except BaseException as e:
+            # A cancelled attempt, say by remove, says nothing about the device.
+            if not isinstance (e, asyncio.CancelledError):
+                self._failures[key] = time.monotonic ()
+
+            await session.close ()
+            raise
+
+        self._failures.pop (key, None)
+        self._sessions[key] = session
+
+        if not self._silent:
+            print (f"Pool connected to {key[0]}:{key[1]}")
+
+        return session
+
+    """
+        Closes and forgets the session of a device.
+        \ key: the (host, port) of the device.
+    """
+    async def _drop (self, key):
+        session = self._sessions.pop (key, None)
+        if session != None:
+            await session.close ()
+
+    """
+        Runs a coroutine function on the session of a device. A failed session is dropped,
+         since a timed out or broken stream can't be trusted to stay in sync.
+        \ key: the (host, port) of the device.
+        \ func: called with the session.
+    """
+    async def _call (self, key, func):
+        session = await self.get (key)
+
+        try:
+            return await func (session)
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self._failures[key] = time.monotonic ()
+            await self._drop (key)
+            raise
+
+    """
+        Moves a stepper on a device to the specified position.
+    """
+    async def send_stepper_move_to (self, key, stepper, pos):
+        await self._call (key, lambda session: session.send_stepper_move_to (stepper, pos))
+
+    """
+        Enables / Disables a stepper on a device.
+    """
+    async def stepper_enable_disable (self, key, stepper, enabled):
+        await self._call (key, lambda session: session.stepper_enable_disable (stepper, enabled))
+
+    """
+        Gets the stepper state of a device, updating its snapshot in place.
+        \ key: the (host, port) of the device.
+    """
+    async def get_stepper_state (self, key):
+        snapshot = self._snapshots.get (key)
+        if snapshot == None:
+            snapshot = self._snapshots[key] = DeviceSnapshot ()
+
+        return await self._call (key, lambda session: session.get_stepper_state (snapshot))
+
+    """
+        Polls the stepper state of every device concurrently, so the whole fleet takes
+         about one round trip. Returns a dict of (host, port) to the DeviceSnapshot, or
+         to the exception if the device failed.
+    """
+    async def poll_all (self):
+        keys = list (self._devices)
+        results = await asyncio.gather (*[ self.get_stepper_state (key) for key in keys ], return_exceptions = True)
+        return dict (zip (keys, results))
+
+    """
+        Closes all sessions.
+    """
+    async def close (self):
+        tasks = list (self._connecting.values ())
+        for task in tasks:
+            task.cancel ()
+
+        # Waits for the cancelled connects to clean up their sessions, before dropping the rest.
+        await asyncio.gather (*tasks, return_exceptions = True)
+        await asyncio.gather (*[ self._drop (key) for key in list (self._sessions) ])
+
+####
+## Testing Code
+####
+
+"""
+    Polls every given host once through a pool.
+"""
+async def _main (hosts):
+    pool = ControlPool (silent = False)
+    for host in hosts:
+        pool.add (host)
+
+    start = time.monotonic ()
+    results = await pool.poll_all ()
+    print (f"Polled {len (results)} devices in {(time.monotonic () - start) * 1000.0:.1f} ms")
+
+    for key, result in results.items ():
+        print (f"{key[0]}:{key[1]} {result.steppers if isinstance (result, DeviceSnapshot) else result}")
+
+    await pool.close ()
+
+if __name__ == "__main__":
+    asyncio.run (_main (sys.argv[1:]))
@@ -0,0 +1,331 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+
+from codec import HEADER_STRUCT, OP_STEPPER_INFO_RESPONSE, decode_stepper_info_batch, np
+
+####
+## Global Constants
+####
+
+RECORDER_SEGMENT_SIZE = 64 * 1024 * 1024
+RECORDER_INDEX_EVERY = 256 # records per sparse index entry
+RECORDER_MAGIC = b"PAREC001"
+
+# Segment layout: header padded to 32 bytes, followed by the records.
+#  header: char[8] magic, uint64_t end offset of the written records, uint64_t record count.
+#  record: double timestamp, uint32_t frame length, followed by the raw frame.
+RECORDER_SEGMENT_HEADER_STRUCT = struct.Struct ("<8sQQ")
+RECORDER_SEGMENT_HEADER_SIZE = 32
+RECORDER_RECORD_STRUCT = struct.Struct ("<dI")
+
+# Sparse index layout, one file per segment: entries of double timestamp, uint64_t offset.
+RECORDER_INDEX_STRUCT = struct.Struct ("<dQ")
+
+####
+## Functions
+####
+
+"""
+    Gets the segment file paths in a recording directory, in order.
+    \ directory: the recording directory.
+"""
+def _segment_paths (directory):
+    return [ os.path.join (directory, name) for name in sorted (os.listdir (directory)) if name.endswith (".seg") ]
+
+####
+## Classes
+####
+
+class TelemetryRecorder:
+    """
+        Creates new telemetry recorder, which appends timestamped raw frames to memory-mapped
+         segment files in a directory. Appending is a copy into the mapping, no syscalls,
+         so it can sit right in the poll loop. Every RECORDER_INDEX_EVERY records, an
+         entry is added to the sparse time index of the segment.
+        \ directory: the recording directory, created if needed.
+        \ segment_size: the size of each segment file.
+    """
+    def __init__ (self, directory, segment_size = RECORDER_SEGMENT_SIZE):
+        os.makedirs (directory, exist_ok = True)
+
+        self._directory = directory
+        self._segment_size = segment_size
+        self._segment_number = len (_segment_paths (directory))
+
+        self._file = None
+        self._mmap = None
+        self._index = None
+        self._offset = 0
+        self._count = 0
+
+        self._open_segment ()
+
+    """
+        Creates the next segment file, and maps it.
+    """
+    def _open_segment (self):
+        path = os.path.join (self._directory, f"{self._segment_number:08d}.seg")
+        self._segment_number += 1
+
+        self._file = open (path, "w+b")
+        self._file.truncate (self._segment_size)
+        self._mmap = mmap.mmap (self._file.fileno (), self._segment_size)
+        self._index = open (path[:-4] + ".idx", "wb")
+
+        self._offset = RECORDER_SEGMENT_HEADER_SIZE
+        self._count = 0
+        RECORDER_SEGMENT_HEADER_STRUCT.pack_into (self._mmap, 0, RECORDER_MAGIC, self._offset, self._count)
+
+    """
+        Closes the current segment, shrinking the file to what was written.
+    """
+    def _close_segment (self):
+        self._mmap.flush ()
+        self._mmap.close ()
+        self._file.truncate (self._offset)
+        self._file.close ()
+        self._index.close ()
+
+        self._mmap = None
+        self._file = None
+        self._index = None
+
+    """
+        Appends a frame.
+        \ frame: the whole frame, including its header.
+        \ timestamp: the receive time.time, defaults to now.
+    """
+    def append (self, frame, timestamp = None):
+        if timestamp == None:
+            timestamp = time.time ()
+
+        size = RECORDER_RECORD_STRUCT.size + len (frame)
+        if self._offset + size > self._segment_size:
+            if self._offset == RECORDER_SEGMENT_HEADER_SIZE:
+                raise ValueError (f"Frame of {len (frame)} bytes doesn't fit in a segment")
+
+            self._close_segment ()
+            self._open_segment ()
+
+        offset = self._offset
+
+        if self._count % RECORDER_INDEX_EVERY == 0:
+            self._index.write (RECORDER_INDEX_STRUCT.pack (timestamp, offset))
+
+        RECORDER_RECORD_STRUCT.pack_into (self._mmap, offset, timestamp, len (frame))
+        self._mmap[offset + RECORDER_RECORD_STRUCT.size:offset + size] = frame
+
+        # The header is only updated once the record is complete, for concurrent readers.
+        self._offset = offset + size
+        self._count += 1
+        RECORDER_SEGMENT_HEADER_STRUCT.pack_into (self._mmap, 0, RECORDER_MAGIC, self._offset, self._count)
+
+    """
+        Flushes the mapping and the index to disk.
+    """
+    def flush (self):
+        self._mmap.flush ()
+        self._index.flush ()
+
+    """
+        Closes the recorder.
+    """
+    def close (self):
+        if self._mmap != None:
+            self._close_segment ()
+
+class TelemetryReader:
+    """
+        Opens a recording directory for reading, it may still be recorded into. The segments
+         the recorder rolls over to are picked up whenever reading gets to the last segment.
+        \ directory: the recording directory.
+    """
+    def __init__ (self, directory):
+        self._directory = directory
+        self._segments = []
+
+        # The first timestamp of each non-empty segment, and its index in _segments, for
+        #  finding the segment to seek into.
+        self._starts = []
+        self._start_indices = []
+
+        self._rescan ()
+
+    """
+        Opens the segments created since the last scan, and adds the starts of the segments
+         which got their first record since.
+    """
+    def _rescan (self):
+        paths = _segment_paths (self._directory)
+
+        for path in paths[len (self._segments):]:
+            try:
+                self._segments.append (_Segment (path))
+            except ValueError:
+                # The recorder may not have written the header of its newest segment yet.
+                if path != paths[-1]:
+                    raise
+
+        # Empty segments are skipped, only the last one can still get records.
+        first = self._start_indices[-1] + 1 if len (self._start_indices) > 0 else 0
+        for i in range (first, len (self._segments)):
+            timestamp = self._segments[i].first_timestamp ()
+            if timestamp != None:
+                self._starts.append (timestamp)
+                self._start_indices.append (i)
+
+    """
+        Yields (timestamp, op, frame) for all records in [start, end), frame being a
+         memoryview into the mapping, which must be released before close.
+        \ start: the first time.time to include, or None for the beginning.
+        \ end: the time.time to stop at, or None for the end.
+    """
+    def iter (self, start = None, end = None):
+        self._rescan ()
+
+        i = 0
+        if start != None and len (self._starts) > 0:
+            i = self._start_indices[max (0, bisect.bisect_right (self._starts, start) - 1)]
+
+        while i < len (self._segments):
+            # Scanned before reading the last segment to its end, so once the recorder rolled
+            #  over, the end read is final, and no record in between is missed.
+            if i == len (self._segments) - 1:
+                self._rescan ()
+
+            for timestamp, op, frame in self._segments[i].iter (start):
+                if end != None and timestamp >= end:
+                    return
+
+                yield timestamp, op, frame
+
+            i += 1
+
+    """
+        Bulk-loads the StepperInfoResponses in [start, end) into columnar NumPy arrays,
+         as returned by codec.decode_stepper_info_batch, with an extra "timestamp" column.
+        \ start: the first time.time to include, or None for the beginning.
+        \ end: the time.time to stop at, or None for the end.
+    """
+    def load (self, start = None, end = None):
+        if np == None:
+            raise ImportError ("numpy is required for TelemetryReader.load")
+
+        timestamps = []
+        frames = []
+        for timestamp, op, frame in self.iter (start, end):
+            if op == OP_STEPPER_INFO_RESPONSE:
+                timestamps.append (timestamp)
+                frames.append (frame)
+
+        result = decode_stepper_info_batch (frames)
+        result["timestamp"] = np.asarray (timestamps, dtype = np.float64)[result["frame"]]
+        return result
+
+    """
+        Closes all segments.
+    """
+    def close (self):
+        for segment in self._segments:
+            segment.close ()
+
+class _Segment:
+    """
+        Maps a single segment file, and loads its sparse index.
+        \ path: the segment file path.
+    """
+    def __init__ (self, path):
+        self._file = open (path, "rb")
+        try:
+            self._mmap = mmap.mmap (self._file.fileno (), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close ()
+            raise
+
+        magic, _, _ = RECORDER_SEGMENT_HEADER_STRUCT.unpack_from (self._mmap, 0)
+        if magic != RECORDER_MAGIC:
+            self.close ()
+            raise ValueError (f"{path} is not a telemetry segment")
+
+        self._index_timestamps = []
+        self._index_offsets = []
+
+        index_path = path[:-4] + ".idx"
+        if os.path.exists (index_path):
+            with open (index_path, "rb") as index:
+                data = index.read ()
+
+            for timestamp, offset in RECORDER_INDEX_STRUCT.iter_unpack (data[:len (data) - len (data) % RECORDER_INDEX_STRUCT.size]):
+                self._index_timestamps.append (timestamp)
+                self._index_offsets.append (offset)
+
+    """
+        Gets the timestamp of the first record, or None if the segment is empty.
+    """
+    def first_timestamp (self):
+        _, end, _ = RECORDER_SEGMENT_HEADER_STRUCT.unpack_from (self._mmap, 0)
+        if end == RECORDER_SEGMENT_HEADER_SIZE:
+            return None
+
+        return RECORDER_RECORD_STRUCT.unpack_from (self._mmap, RECORDER_SEGMENT_HEADER_SIZE)[0]
+
+    """
+        Yields (timestamp, op, frame) from the first record at or after start.
+        \ start: the time.time to seek to, or None for the beginning.
+    """
+    def iter (self, start = None):
+        view = memoryview (self._mmap)
+        _, end, _ = RECORDER_SEGMENT_HEADER_STRUCT.unpack_from (self._mmap, 0)
+
+        # Jumps to the last index entry before start, and scans from there.
+        offset = RECORDER_SEGMENT_HEADER_SIZE
+        if start != None:
+            i = bisect.bisect_left (self._index_timestamps, start) - 1
+            if i >= 0:
+                offset = self._index_offsets[i]
+
+        while offset < end:
+            timestamp, length = RECORDER_RECORD_STRUCT.unpack_from (self._mmap, offset)
+
+            frame_start = offset + RECORDER_RECORD_STRUCT.size
+            offset = frame_start + length
+
+            if start == None or timestamp >= start:
+                op = HEADER_STRUCT.unpack_from (self._mmap, frame_start)[1] if length >= HEADER_STRUCT.size else None
+                yield timestamp, op, view[frame_start:offset]
+
+    def close (self):
+        self._mmap.close ()
+        self._file.close ()
+
+####
+## Testing Code
+####
+
+if __name__ == "__main__":
+    reader = TelemetryReader (sys.argv[1])
+
+    for timestamp, op, frame in reader.iter ():
+        print (f"{timestamp:.6f} op={op} length={len (frame)}")
@@ -0,0 +1,246 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import threading
+import time
+
+from control import CONTROL_STATUS_INTERVAL
+
+####
+## Global Constants
+####
+
+SCHEDULER_MIN_INTERVAL = 0.05
+SCHEDULER_MAX_INTERVAL = CONTROL_STATUS_INTERVAL
+SCHEDULER_BACKOFF = 2.0
+SCHEDULER_BUDGET = 500.0 # requests per second, shared by all devices
+SCHEDULER_BURST = 0.1 # seconds worth of budget which may be spent at once
+
+####
+## Classes
+####
+
+class PollScheduler:
+    """
+        Creates new poll scheduler, which decides when each device gets polled next.
+
+        A device is polled every min_interval while any of its steppers reports the
+         MOVING flag. Once everything is idle, the interval doubles (by backoff) after
+         every poll until it reaches max_interval. On top of that, a token bucket limits
+         the polls of all devices together to budget per second.
+
+        A single scheduler may be shared between threads, as long as every device is
+         only polled from one of them.
+
+        \ min_interval: the interval while moving.
+        \ max_interval: the interval the idle backoff stops at.
+        \ backoff: the factor the interval grows by per idle poll.
+        \ budget: max polls per second over all devices, or None for no limit.
+        \ silent: don't print failing snapshot callbacks.
+    """
+    def __init__ (self, min_interval = SCHEDULER_MIN_INTERVAL, max_interval = SCHEDULER_MAX_INTERVAL, backoff = SCHEDULER_BACKOFF, budget = SCHEDULER_BUDGET, silent = True):
+        assert (0 < min_interval <= max_interval)
+        assert (backoff >= 1.0)
+
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._budget = budget
+        self._silent = silent
+
+        # Per device: [min_interval, interval, due].
+        self._devices = {}
+
+        self._burst = 1.0 if budget == None else max (1.0, budget * SCHEDULER_BURST)
+        self._tokens = self._burst
+        self._refilled = time.monotonic ()
+        self._lock = threading.Lock ()
+
+    """
+        Adds a device, it's due immediately.
+        \ key: the device key.
+        \ min_interval: overrides the interval while moving for this device.
+        \ now: the current time.monotonic.
+    """
+    def add (self, key, min_interval = None, now = None):
+        min_interval = self._min_interval if min_interval == None else min_interval
+        self._devices[key] = [ min_interval, min_interval, time.monotonic () if now == None else now ]
+
+    """
+        Removes a device.
+        \ key: the device key.
+    """
+    def remove (self, key):
+        self._devices.pop (key, None)
+
+    """
+        Gets the keys of all devices.
+    """
+    def keys (self):
+        return list (self._devices)
+
+    """
+        Changes the interval while moving of a device, and makes it due by then.
+        \ key: the device key.
+        \ min_interval: the new interval.
+        \ now: the current time.monotonic.
+    """
+    def set_min_interval (self, key, min_interval, now = None):
+        now = time.monotonic () if now == None else now
+
+        device = self._devices[key]
+        device[0] = min_interval
+        device[1] = min_interval
+        device[2] = min (device[2], now + min_interval)
+
+    """
+        Gets the current poll interval of a device.
+        \ key: the device key.
+    """
+    def interval (self, key):
+        return self._devices[key][1]
+
+    """
+        Gets the seconds until a device is due, zero if it's due already.
+        \ key: the device key.
+        \ now: the current time.monotonic.
+    """
+    def delay (self, key, now = None):
+        now = time.monotonic () if now == None else now
+        return max (0.0, self._devices[key][2] - now)
+
+    """
+        Takes one poll from the shared budget. Returns zero if the poll may go ahead,
+         else the seconds until the budget allows it.
+        \ now: the current time.monotonic.
+    """
+    def acquire (self, now = None):
+        if self._budget == None:
+            return 0.0
+
+        now = time.monotonic () if now == None else now
+
+        with self._lock:
+            self._tokens = min (self._burst, self._tokens + (now - self._refilled) * self._budget)
+            self._refilled = now
+
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+
+            return (1.0 - self._tokens) / self._budget
+
+    """
+        Records a completed poll, and schedules the next one.
+        \ key: the device key.
+        \ moving: whether any stepper is moving, DeviceSnapshot.any_moving.
+        \ now: the current time.monotonic.
+    """
+    def record (self, key, moving, now = None):
+        device = self._devices.get (key)
+        if device == None:
+            return
+
+        now = time.monotonic () if now == None else now
+
+        if moving:
+            device[1] = device[0]
+        else:
+            device[1] = min (device[1] * self._backoff, max (device[0], self._max_interval))
+
+        device[2] = now + device[1]
+
+    """
+        Records a failed poll, which backs off like an idle one.
+        \ key: the device key.
+        \ now: the current time.monotonic.
+    """
+    def record_failure (self, key, now = None):
+        self.record (key, False, now)
+
+    """
+        Polls every device of a ControlPool on schedule, until cancelled. Devices added to
+         the pool later on are picked up within max_interval.
+        \ pool: the ControlPool.
+        \ on_snapshot: called with (key, snapshot) after every successful poll.
+    """
+    async def run (self, pool, on_snapshot = None):
+        tasks = {}
+
+        try:
+            while True:
+                keys = set (pool.keys ())
+
+                for key in keys - tasks.keys ():
+                    if key not in self._devices:
+                        self.add (key)
+
+                    tasks[key] = asyncio.ensure_future (self.run_device (pool, key, on_snapshot))
+
+                for key in tasks.keys () - keys:
+                    tasks.pop (key).cancel ()
+                    self.remove (key)
+
+                await asyncio.sleep (self._max_interval)
+        finally:
+            for task in tasks.values ():
+                task.cancel ()
+
+    """
+        Polls a single device of a ControlPool on schedule, until cancelled or the device
+         is removed from the scheduler. The device is added if it isn't yet.
+        \ pool: the ControlPool.
+        \ key: the (host, port) of the device.
+        \ on_snapshot: called with (key, snapshot) after every successful poll.
+    """
+    async def run_device (self, pool, key, on_snapshot = None):
+        if key not in self._devices:
+            self.add (key)
+
+        while key in self._devices:
+            await asyncio.sleep (self.delay (key))
+
+            # Removed while sleeping.
+            if key not in self._devices:
+                break
+
+            wait = self.acquire ()
+            if wait > 0.0:
+                await asyncio.sleep (wait)
+                continue
+
+            try:
+                snapshot = await pool.get_stepper_state (key)
+            except Exception:
+                self.record_failure (key)
+                continue
+
+            if snapshot == None:
+                self.record_failure (key)
+                continue
+
+            self.record (key, snapshot.any_moving ())
+
+            # A failing callback must not end the polling of this device.
+            if on_snapshot != None:
+                try:
+                    on_snapshot (key, snapshot)
+                except Exception as e:
+                    if not self._silent:
+                        print (f"Snapshot callback for {key} failed: {e}")
@@ -0,0 +1,281 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import multiprocessing
+import signal
+import struct
+import sys
+import threading
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+from codec import CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE, STEPPER_INFO_RECORD_STRUCT, DeviceSnapshot, StepperState
+from control import CONTROL_PORT, Control
+from scheduler import SCHEDULER_MIN_INTERVAL
+
+####
+## Global Constants
+####
+
+SHM_MAX_STEPPERS = 16
+SHM_READ_TIMEOUT = 0.5 # seconds a read keeps retrying while the publisher is writing
+
+# Block layout: header, followed by max_steppers wire-format stepper info records.
+#  uint64_t sequence (odd while being written), uint64_t generation, double timestamp,
+#  uint32_t stepper count, uint32_t max steppers.
+SHM_HEADER_STRUCT = struct.Struct ("<QQdII")
+SHM_SEQUENCE_STRUCT = struct.Struct ("<Q")
+SHM_HEADER_FIELDS_STRUCT = struct.Struct ("<QdII") # the header after the sequence
+
+# The names of the blocks created by publishers in this process.
+_published_blocks = set ()
+
+####
+## Functions
+####
+
+"""
+    Gets the default shared memory block name for a device.
+    \ host: the IPv4 address of the device.
+    \ port: the port of the device.
+"""
+def shm_name (host, port = CONTROL_PORT):
+    return f"project_a_{host.replace ('.', '_')}_{port}"
+
+####
+## Classes
+####
+
+class SnapshotPublisher:
+    """
+        Creates new shared memory block, and publishes device snapshots into it. There
+         must be exactly one publisher per block.
+        \ name: the block name.
+        \ max_steppers: the number of stepper records the block has room for.
+    """
+    def __init__ (self, name, max_steppers = SHM_MAX_STEPPERS):
+        self._max_steppers = max_steppers
+        self._shm = shared_memory.SharedMemory (name, create = True, size = SHM_HEADER_STRUCT.size + max_steppers * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE)
+        self._sequence = 0
+
+        SHM_HEADER_STRUCT.pack_into (self._shm.buf, 0, 0, 0, 0.0, 0, max_steppers)
+        _published_blocks.add (self._shm._name)
+
+    """
+        Gets the block name.
+    """
+    @property
+    def name (self):
+        return self._shm.name
+
+    """
+        Writes a snapshot into the block.
+        \ snapshot: the DeviceSnapshot.
+    """
+    def write (self, snapshot):
+        buf = self._shm.buf
+        count = min (len (snapshot.steppers), self._max_steppers)
+
+        # An odd sequence tells the readers a write is in progress.
+        self._sequence += 1
+        SHM_SEQUENCE_STRUCT.pack_into (buf, 0, self._sequence)
+
+        offset = SHM_HEADER_STRUCT.size
+        for i in range (0, count):
+            state = snapshot.steppers[i]
+            STEPPER_INFO_RECORD_STRUCT.pack_into (buf, offset, state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed, i + 1 < count)
+            offset += CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+
+        SHM_HEADER_FIELDS_STRUCT.pack_into (buf, SHM_SEQUENCE_STRUCT.size, snapshot.generation, snapshot.timestamp or 0.0, count, self._max_steppers)
+
+        # Published last, so readers never accept a snapshot before all of it was written.
+        self._sequence += 1
+        SHM_SEQUENCE_STRUCT.pack_into (buf, 0, self._sequence)
+
+    """
+        Closes and removes the block.
+    """
+    def close (self):
+        _published_blocks.discard (self._shm._name)
+        self._shm.close ()
+        self._shm.unlink ()
+
+class SnapshotReader:
+    """
+        Attaches to a block created by a SnapshotPublisher. Reads take no locks, they're
+         retried whenever the publisher was writing at the same time.
+        \ name: the block name.
+        \ timeout: seconds a read keeps retrying, before raising TimeoutError.
+    """
+    def __init__ (self, name, timeout = SHM_READ_TIMEOUT):
+        self._shm = shared_memory.SharedMemory (name)
+        self._timeout = timeout
+
+        # Readers don't own the block, so the resource tracker must not unlink it on exit.
+        #  Unless a publisher in this process created it, it's still registered for that one.
+        if self._shm._name not in _published_blocks:
+            resource_tracker.unregister (self._shm._name, "shared_memory")
+
+    """
+        Gets ready for another attempt after the publisher got in the way, by yielding the
+         CPU, so a publisher preempted mid-write gets to finish it. Returns the deadline,
+         which is only set once the first attempt failed, so uncontended reads skip the clock.
+        \ deadline: the time.monotonic deadline, or None before the first retry.
+    """
+    def _retry (self, deadline):
+        now = time.monotonic ()
+
+        if deadline == None:
+            deadline = now + self._timeout
+        elif now > deadline:
+            raise TimeoutError (f"Shared memory block {self._shm.name} kept changing while reading")
+
+        time.sleep (0)
+        return deadline
+
+    """
+        Gets the generation of the latest published snapshot, without reading it.
+    """
+    def generation (self):
+        return SHM_HEADER_STRUCT.unpack_from (self._shm.buf, 0)[1]
+
+    """
+        Reads the latest snapshot, updating the given DeviceSnapshot in place, or a new one.
+        \ snapshot: the DeviceSnapshot to update.
+    """
+    def read (self, snapshot = None):
+        buf = self._shm.buf
+
+        if snapshot == None:
+            snapshot = DeviceSnapshot ()
+
+        deadline = None
+        while True:
+            sequence, generation, timestamp, count, _ = SHM_HEADER_STRUCT.unpack_from (buf, 0)
+            if sequence & 1:
+                deadline = self._retry (deadline)
+                continue
+
+            steppers = snapshot.steppers
+            while len (steppers) < count:
+                steppers.append (StepperState ())
+
+            offset = SHM_HEADER_STRUCT.size
+            for i in range (0, count):
+                state = steppers[i]
+                state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed, _ = STEPPER_INFO_RECORD_STRUCT.unpack_from (buf, offset)
+                offset += CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+
+            # Only valid if the publisher didn't start writing meanwhile.
+            if SHM_SEQUENCE_STRUCT.unpack_from (buf, 0)[0] != sequence:
+                deadline = self._retry (deadline)
+                continue
+
+            del steppers[count:]
+            snapshot.generation = generation
+            snapshot.timestamp = timestamp
+            return snapshot
+
+    """
+        Reads a single stepper, cheaper than reading the whole snapshot.
+        \ index: the index of the stepper record.
+        \ state: the StepperState to update, or None for a new one.
+    """
+    def read_stepper (self, index, state = None):
+        buf = self._shm.buf
+        offset = SHM_HEADER_STRUCT.size + index * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+
+        if state == None:
+            state = StepperState ()
+
+        deadline = None
+        while True:
+            sequence, _, _, count, _ = SHM_HEADER_STRUCT.unpack_from (buf, 0)
+            if sequence & 1:
+                deadline = self._retry (deadline)
+                continue
+            elif index >= count:
+                return None
+
+            state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed, _ = STEPPER_INFO_RECORD_STRUCT.unpack_from (buf, offset)
+
+            if SHM_SEQUENCE_STRUCT.unpack_from (buf, 0)[0] == sequence:
+                return state
+
+            deadline = self._retry (deadline)
+
+    """
+        Detaches from the block.
+    """
+    def close (self):
+        self._shm.close ()
+
+####
+## Publisher Process
+####
+
+"""
+    Connects to a device, and publishes its snapshot into shared memory until stopped.
+    \ host: the IPv4 address of the device.
+    \ port: the port of the device.
+    \ name: the block name.
+    \ interval: the poll interval.
+"""
+def run_publisher (host, port = CONTROL_PORT, name = None, interval = SCHEDULER_MIN_INTERVAL, silent = True):
+    control = Control (host, port, silent)
+    control.tcp_connect ()
+    if not control.proto_connect ():
+        return
+
+    publisher = SnapshotPublisher (shm_name (host, port) if name == None else name)
+    snapshot = DeviceSnapshot ()
+
+    # Makes a terminated publisher process still remove its block.
+    if threading.current_thread () == threading.main_thread ():
+        signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))
+
+    if not silent:
+        print (f"Publishing {host}:{port} into shared memory block {publisher.name}")
+
+    try:
+        while True:
+            if control.get_stepper_state (snapshot) != None:
+                publisher.write (snapshot)
+
+            time.sleep (interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close ()
+        control._reset ()
+
+"""
+    Starts run_publisher in a separate process, and returns the process.
+"""
+def start_publisher_process (host, port = CONTROL_PORT, name = None, interval = SCHEDULER_MIN_INTERVAL):
+    process = multiprocessing.Process (target = run_publisher, args = (host, port, name, interval), daemon = True)
+    process.start ()
+    return process
+
+####
+## Main Code
+####
+
+if __name__ == "__main__":
+    run_publisher (sys.argv[1], int (sys.argv[2]) if len (sys.argv) > 2 else CONTROL_PORT, silent = False)
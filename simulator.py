@@ -0,0 +1,446 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import ipaddress
+import math
+import random
+import socket
+import struct
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from codec import CONTROL_PACKET_CONNECT_REQUEST_SIZE, CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE, CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED, CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC, CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING
+from codec import OP_CONNECTION_REQUEST, OP_CONNECTION_REQUEST_APPROVED, OP_CONNECTION_REQUEST_REJECTED, OP_STEPPER_INFO_REQUEST, OP_STEPPER_MOVE_TO, OP_STEPPER_ENABLE_DISABLE, OP_STEPPER_INFO_RESPONSE
+from codec import HEADER_STRUCT, MOVE_TO_STRUCT, ENABLE_DISABLE_STRUCT, STEPPER_INFO_RECORD_STRUCT
+from control import CONTROL_PORT
+from discovery import DISCOVERY_BROADCAST, DISCOVERY_PORT, DISCOVERY_PKT_FLAG_REQUEST, DISCOVERY_PKT_FLAG_RESPONSE, DiscoveryPacketDevID, discovery_targets
+from framing import FrameDecoder
+
+####
+## Global Constants
+####
+
+SIMULATOR_BASE_ADDRESS = "127.0.1.1"
+SIMULATOR_STEPPERS = 6
+SIMULATOR_MIN_SPEED = 100 # steps per second
+SIMULATOR_MAX_SPEED = 1600 # steps per second
+SIMULATOR_ACCELERATION = 4000.0 # steps per second squared
+SIMULATOR_STEP = 0.005 # max seconds per integration step
+SIMULATOR_MAX_STEPS = 2000 # integration steps per update, longer gaps are jumped
+SIMULATOR_SPLIT_DELAY = 0.0005 # seconds between the segments of a split response
+SIMULATOR_FDS_PER_DEVICE = 3 # the listener, the discovery socket and one session
+SIMULATOR_FDS_RESERVED = 256 # for broadcast sockets, the event loop and whatever else the process has open
+
+SIMULATOR_DISCOVERY_REQUEST_STRUCT = struct.Struct ("<HB")
+SIMULATOR_DISCOVERY_RESPONSE_STRUCT = struct.Struct ("<HBHH")
+
+####
+## Functions
+####
+
+"""
+    Raises the soft open file limit to the hard limit if it's below the given count, so
+     large simulations don't run into EMFILE halfway. Raises OSError if even the hard
+     limit is too low.
+    \ needed: the number of file descriptors required.
+"""
+def raise_fd_limit (needed):
+    if resource == None:
+        return
+
+    soft, hard = resource.getrlimit (resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return
+
+    if hard != resource.RLIM_INFINITY and hard < needed:
+        raise OSError (f"Need {needed} file descriptors, but the hard limit is {hard}, raise it with ulimit -Hn")
+
+    resource.setrlimit (resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else needed, hard))
+
+####
+## Classes
+####
+
+class VirtualStepper:
+    """
+        Creates new virtual stepper, which accelerates toward its target with a
+         trapezoidal speed profile.
+        \ motor: the stepper index.
+    """
+    __slots__ = ("motor", "enabled", "automatic", "target_pos", "current_pos", "current_speed", "min_speed", "max_speed", "acceleration")
+
+    def __init__ (self, motor, enabled = True, min_speed = SIMULATOR_MIN_SPEED, max_speed = SIMULATOR_MAX_SPEED, acceleration = SIMULATOR_ACCELERATION):
+        self.motor = motor
+        self.enabled = enabled
+        self.automatic = True
+        self.target_pos = 0
+        self.current_pos = 0.0
+        self.current_speed = 0.0
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+
+    """
+        Advances the motion by the given time.
+        \ dt: seconds.
+    """
+    def advance (self, dt):
+        steps = min (SIMULATOR_MAX_STEPS, max (1, math.ceil (dt / SIMULATOR_STEP)))
+        dt = dt / steps
+
+        for _ in range (0, steps):
+            distance = self.target_pos - self.current_pos
+
+            if not self.enabled or distance == 0:
+                self.current_speed = 0.0
+                return
+
+            # Brakes once the remaining distance gets within the braking distance.
+            if abs (distance) <= self.current_speed * self.current_speed / (2.0 * self.acceleration):
+                self.current_speed = max (self.min_speed, self.current_speed - self.acceleration * dt)
+            else:
+                self.current_speed = min (self.max_speed, max (self.min_speed, self.current_speed + self.acceleration * dt))
+
+            step = self.current_speed * dt
+            if step >= abs (distance):
+                self.current_pos = float (self.target_pos)
+                self.current_speed = 0.0
+                return
+
+            self.current_pos += step if distance > 0 else -step
+
+    """
+        Gets the info flags.
+    """
+    def flags (self):
+        flags = CONTROL_PACKET_STEPPER_INFO_FLAG_AUTOMATIC if self.automatic else 0
+
+        if self.enabled:
+            flags |= CONTROL_PACKET_STEPPER_INFO_FLAG_ENABLED
+
+            if self.current_pos != self.target_pos:
+                flags |= CONTROL_PACKET_STEPPER_INFO_FLAG_MOVING
+
+        return flags
+
+class SimulatedDevice:
+    """
+        Creates new simulated Project-A board. The steppers are advanced lazily whenever
+         their state is requested, so idle devices cost nothing.
+        \ name: the device name reported by discovery.
+        \ address: the IPv4 address the device listens on.
+        \ port: the control port.
+        \ steppers: the number of virtual steppers.
+        \ max_sessions: the number of control sessions approved at the same time.
+    """
+    def __init__ (self, name, address, port = CONTROL_PORT, steppers = SIMULATOR_STEPPERS, max_sessions = 1):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.steppers = [ VirtualStepper (i) for i in range (0, steppers) ]
+        self.max_sessions = max_sessions
+        self.sessions = 0
+
+        self._updated = time.monotonic ()
+        self._info_frame = bytearray (HEADER_STRUCT.size + steppers * CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE)
+
+    """
+        Advances all steppers up to now.
+    """
+    def update (self):
+        now = time.monotonic ()
+        dt = now - self._updated
+        self._updated = now
+
+        for stepper in self.steppers:
+            stepper.advance (dt)
+
+    """
+        Encodes a StepperInfoResponse of the current state.
+    """
+    def stepper_info_frame (self):
+        self.update ()
+
+        frame = self._info_frame
+        HEADER_STRUCT.pack_into (frame, 0, len (frame), OP_STEPPER_INFO_RESPONSE)
+
+        offset = HEADER_STRUCT.size
+        for stepper in self.steppers:
+            STEPPER_INFO_RECORD_STRUCT.pack_into (frame, offset, stepper.motor, stepper.flags (), stepper.target_pos, round (stepper.current_pos),
+                stepper.min_speed, round (stepper.current_speed), stepper.max_speed, stepper.motor + 1 < len (self.steppers))
+            offset += CONTROL_PACKET_STEPPER_INFO_RECORD_SIZE
+
+        return bytes (frame)
+
+    """
+        Encodes the discovery response.
+    """
+    def discovery_response (self):
+        name = self.name.encode ("utf8") + b"\0"
+        return SIMULATOR_DISCOVERY_RESPONSE_STRUCT.pack (DiscoveryPacketDevID.ProjectA.value, DISCOVERY_PKT_FLAG_RESPONSE, self.port, len (name)) + name
+
+class _ControlProtocol (asyncio.BufferedProtocol):
+    """
+        Serves one control connection of a simulated device.
+    """
+    def __init__ (self, simulator, device):
+        self._simulator = simulator
+        self._device = device
+        self._decoder = FrameDecoder ()
+        self._transport = None
+        self._approved = False
+        self._send_at = 0.0
+
+        # The (time, data) still to write, in order, drained by a single timer.
+        self._send_queue = collections.deque ()
+        self._send_timer = None
+
+    def connection_made (self, transport):
+        self._transport = transport
+
+        sock = transport.get_extra_info ("socket")
+        if sock != None:
+            sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost (self, exc):
+        if self._approved:
+            self._device.sessions -= 1
+            self._approved = False
+
+        self._transport = None
+
+        if self._send_timer != None:
+            self._send_timer.cancel ()
+            self._send_timer = None
+
+        self._send_queue.clear ()
+
+    def get_buffer (self, sizehint):
+        return self._decoder.get_buffer (sizehint)
+
+    def buffer_updated (self, nbytes):
+        self._decoder.buffer_updated (nbytes)
+
+        for op, frame in self._decoder:
+            self._on_frame (op, frame)
+
+    def _on_frame (self, op, frame):
+        device = self._device
+
+        if op == OP_CONNECTION_REQUEST:
+            if not self._approved and device.sessions < device.max_sessions:
+                device.sessions += 1
+                self._approved = True
+                self._send (HEADER_STRUCT.pack (CONTROL_PACKET_CONNECT_REQUEST_SIZE, OP_CONNECTION_REQUEST_APPROVED))
+            elif not self._approved:
+                self._send (HEADER_STRUCT.pack (CONTROL_PACKET_CONNECT_REQUEST_SIZE, OP_CONNECTION_REQUEST_REJECTED))
+        elif not self._approved:
+            return
+        elif op == OP_STEPPER_INFO_REQUEST:
+            self._send (device.stepper_info_frame ())
+        elif op == OP_STEPPER_MOVE_TO and len (frame) >= MOVE_TO_STRUCT.size:
+            _, _, motor, pos, _ = MOVE_TO_STRUCT.unpack_from (frame, 0)
+            if motor < len (device.steppers):
+                device.update ()
+                device.steppers[motor].target_pos = pos
+        elif op == OP_STEPPER_ENABLE_DISABLE and len (frame) >= ENABLE_DISABLE_STRUCT.size:
+            _, _, motor, enabled, _ = ENABLE_DISABLE_STRUCT.unpack_from (frame, 0)
+            if motor < len (device.steppers):
+                device.update ()
+                device.steppers[motor].enabled = enabled
+
+    """
+        Sends a response after the configured latency, optionally split into segments.
+        Responses keep their order, even with jitter, since all segments go through one
+         queue which is written in order.
+    """
+    def _send (self, data):
+        simulator = self._simulator
+        loop = asyncio.get_running_loop ()
+
+        if simulator.latency == 0.0 and simulator.jitter == 0.0 and simulator.split == 0:
+            self._transport.write (data)
+            return
+
+        delay = max (0.0, simulator.latency + random.uniform (-simulator.jitter, simulator.jitter))
+        self._send_at = max (loop.time () + delay, self._send_at)
+
+        if simulator.split == 0:
+            self._send_queue.append ((self._send_at, data))
+        else:
+            offset = 0
+            while offset < len (data):
+                size = random.randint (1, simulator.split)
+                self._send_queue.append ((self._send_at, data[offset:offset + size]))
+                offset += size
+
+                if offset < len (data):
+                    self._send_at += SIMULATOR_SPLIT_DELAY
+
+        if self._send_timer == None:
+            self._send_timer = loop.call_at (self._send_queue[0][0], self._write)
+
+    """
+        Writes the queued segments which are due, and schedules the timer for the next one.
+    """
+    def _write (self):
+        self._send_timer = None
+
+        if self._transport == None:
+            return
+
+        loop = asyncio.get_running_loop ()
+        now = loop.time ()
+
+        while len (self._send_queue) > 0 and self._send_queue[0][0] <= now:
+            self._transport.write (self._send_queue.popleft ()[1])
+
+        if len (self._send_queue) > 0:
+            self._send_timer = loop.call_at (self._send_queue[0][0], self._write)
+
+class _DiscoveryProtocol (asyncio.DatagramProtocol):
+    """
+        Answers discovery requests, either for all devices (broadcast) or for one.
+        \ devices: the devices to answer for.
+    """
+    def __init__ (self, simulator, devices):
+        self._simulator = simulator
+        self._devices = devices
+
+    def datagram_received (self, data, addr):
+        if len (data) < SIMULATOR_DISCOVERY_REQUEST_STRUCT.size:
+            return
+
+        device_id, flags = SIMULATOR_DISCOVERY_REQUEST_STRUCT.unpack_from (data, 0)
+        if device_id != DiscoveryPacketDevID.ProjectA.value or not (flags & DISCOVERY_PKT_FLAG_REQUEST):
+            return
+
+        for device in self._devices:
+            self._simulator._respond_discovery (device, addr)
+
+class Simulator:
+    """
+        Creates new simulator for any number of Project-A boards in one process. Every
+         device gets its own loopback address, counting up from base_address, since
+         discovery tells devices apart by their IP.
+        \ count: the number of devices.
+        \ base_address: the address of the first device.
+        \ control_port: the control port of every device.
+        \ discovery_port: the port discovery requests are answered on.
+        \ steppers: the number of steppers per device.
+        \ latency: seconds before each response is sent.
+        \ jitter: max random seconds added to / taken from the latency.
+        \ split: if not zero, responses are split into random segments of at most this many bytes.
+    """
+    def __init__ (self, count = 1, base_address = SIMULATOR_BASE_ADDRESS, control_port = CONTROL_PORT, discovery_port = DISCOVERY_PORT,
+            steppers = SIMULATOR_STEPPERS, latency = 0.0, jitter = 0.0, split = 0, silent = True):
+        self.latency = latency
+        self.jitter = jitter
+        self.split = split
+
+        self._control_port = control_port
+        self._discovery_port = discovery_port
+        self._silent = silent
+
+        base = ipaddress.IPv4Address (base_address)
+        self.devices = [ SimulatedDevice (f"sim-{i}", str (base + i), control_port, steppers) for i in range (0, count) ]
+
+        self._servers = []
+        self._transports = {}
+
+    """
+        Starts listening for all devices.
+    """
+    async def start (self):
+        loop = asyncio.get_running_loop ()
+
+        raise_fd_limit (len (self.devices) * SIMULATOR_FDS_PER_DEVICE + SIMULATOR_FDS_RESERVED)
+
+        for device in self.devices:
+            server = await loop.create_server (lambda device = device: _ControlProtocol (self, device), device.address, device.port, reuse_address = True)
+            self._servers.append (server)
+
+            # Per-device socket, so responses come from the device address, and unicast probes reach it.
+            transport, _ = await loop.create_datagram_endpoint (lambda device = device: _DiscoveryProtocol (self, [ device ]),
+                local_addr = (device.address, self._discovery_port), reuse_port = True)
+            self._transports[device.address] = transport
+
+        # One socket per broadcast address, the limited one and those of the local subnets. Not the
+        #  wildcard address, since that would also answer unicast probes to addresses without a device.
+        for address in discovery_targets ():
+            address = "255.255.255.255" if address == DISCOVERY_BROADCAST else address
+
+            transport, _ = await loop.create_datagram_endpoint (lambda: _DiscoveryProtocol (self, self.devices),
+                local_addr = (address, self._discovery_port), reuse_port = True, allow_broadcast = True)
+            self._transports[address] = transport
+
+        if not self._silent:
+            print (f"Simulating {len (self.devices)} devices from {self.devices[0].address}, control port {self._control_port}, discovery port {self._discovery_port}")
+
+    """
+        Sends the discovery response of a device, after the configured latency.
+    """
+    def _respond_discovery (self, device, addr):
+        transport = self._transports[device.address]
+        delay = max (0.0, self.latency + random.uniform (-self.jitter, self.jitter))
+
+        if delay == 0.0:
+            transport.sendto (device.discovery_response (), addr)
+        else:
+            asyncio.get_running_loop ().call_later (delay, transport.sendto, device.discovery_response (), addr)
+
+    """
+        Stops all listeners.
+    """
+    async def close (self):
+        for server in self._servers:
+            server.close ()
+
+        for transport in self._transports.values ():
+            transport.close ()
+
+        await asyncio.gather (*[ server.wait_closed () for server in self._servers ])
+
+        self._servers = []
+        self._transports = {}
+
+####
+## Main Code
+####
+
+async def _main (count, base_address):
+    simulator = Simulator (count, base_address, silent = False)
+    await simulator.start ()
+
+    try:
+        await asyncio.Event ().wait ()
+    finally:
+        await simulator.close ()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run (_main (int (sys.argv[1]) if len (sys.argv) > 1 else 1, sys.argv[2] if len (sys.argv) > 2 else SIMULATOR_BASE_ADDRESS))
+    except KeyboardInterrupt:
+        pass
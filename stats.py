@@ -0,0 +1,427 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import http.server
+import threading
+import weakref
+
+from codec import ControlPkt_OP
+
+####
+## Global Constants
+####
+
+# Each power of two is split into 2^STATS_HISTOGRAM_SUB_BITS buckets, so recorded values
+#  are accurate to within 1 / 2^STATS_HISTOGRAM_SUB_BITS (6.25%).
+STATS_HISTOGRAM_SUB_BITS = 4
+STATS_HISTOGRAM_MAX_BITS = 40 # ~18 minutes in ns, larger values are clamped
+STATS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+STATS_HTTP_HOST = "127.0.0.1"
+STATS_HTTP_PORT = 9185
+
+_SUB_BUCKETS = 1 << STATS_HISTOGRAM_SUB_BITS
+_BUCKETS = (STATS_HISTOGRAM_MAX_BITS - STATS_HISTOGRAM_SUB_BITS + 1) * _SUB_BUCKETS
+_MAX_VALUE = (1 << STATS_HISTOGRAM_MAX_BITS) - 1
+
+####
+## Functions
+####
+
+"""
+    Gets the name of an opcode, for ops not in ControlPkt_OP too.
+    \ op: the opcode.
+"""
+def op_name (op):
+    try:
+        return ControlPkt_OP (op).name
+    except ValueError:
+        return f"Unknown{op}"
+
+"""
+    Gets the highest value which lands in the given histogram bucket.
+    \ index: the bucket index.
+"""
+def _bucket_value (index):
+    shift = max (0, index // _SUB_BUCKETS - 1)
+    return ((index - shift * _SUB_BUCKETS + 1) << shift) - 1
+
+"""
+    Formats a Prometheus label set.
+    \ labels: dict of label name to value.
+"""
+def _format_labels (labels):
+    if len (labels) == 0:
+        return ""
+
+    escaped = [ (name, str (value).replace ("\\", "\\\\").replace ("\n", "\\n").replace ("\"", "\\\"")) for name, value in labels.items () ]
+    return "{" + ",".join (f"{name}=\"{value}\"" for name, value in escaped) + "}"
+
+####
+## Classes
+####
+
+class LatencyHistogram:
+    """
+        Creates new log-linear (HDR-style) histogram of nanosecond latencies. Recording
+         is a bit_length and a list increment, so it's cheap enough for every frame.
+    """
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__ (self):
+        self.counts = [ 0 ] * _BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = _MAX_VALUE
+        self.max = 0
+
+    """
+        Records a value.
+        \ ns: the latency in nanoseconds.
+    """
+    def record (self, ns):
+        if ns < 0:
+            ns = 0
+        elif ns > _MAX_VALUE:
+            ns = _MAX_VALUE
+
+        if ns < _SUB_BUCKETS:
+            index = ns
+        else:
+            shift = ns.bit_length () - STATS_HISTOGRAM_SUB_BITS - 1
+            index = shift * _SUB_BUCKETS + (ns >> shift)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ns
+
+        if ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+
+    """
+        Gets the value at the given quantile, or None if nothing was recorded.
+        \ quantile: 0.0 to 1.0.
+    """
+    def quantile (self, quantile):
+        if self.count == 0:
+            return None
+
+        rank = max (1, round (quantile * self.count))
+        seen = 0
+
+        for index, count in enumerate (self.counts):
+            seen += count
+            if seen >= rank:
+                return min (_bucket_value (index), self.max)
+
+        return self.max
+
+    """
+        Adds the values of another histogram.
+        \ other: the LatencyHistogram.
+    """
+    def merge (self, other):
+        for index, count in enumerate (other.counts):
+            if count != 0:
+                self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+
+        self.min = min (self.min, other.min)
+        self.max = max (self.max, other.max)
+
+    """
+        Forgets all recorded values.
+    """
+    def reset (self):
+        self.__init__ ()
+
+    """
+        Gets a summary as a dict, all values in nanoseconds.
+    """
+    def as_dict (self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+            "quantiles": { quantile: self.quantile (quantile) for quantile in STATS_QUANTILES },
+        }
+
+class OpStats:
+    """
+        Creates new counters for a single opcode.
+    """
+    __slots__ = ("frames_sent", "frames_received", "bytes_sent", "bytes_received", "latency")
+
+    def __init__ (self):
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram ()
+
+    def as_dict (self):
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_received": self.frames_received,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency_ns": self.latency.as_dict (),
+        }
+
+class ControlStats:
+    """
+        Creates new control connection statistics. Requests record their round-trip time
+         under the request op, commands without a response are only counted.
+    """
+    def __init__ (self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.parse_errors = 0
+        self.unexpected_frames = 0
+        self.rejected_connections = 0
+
+        # Per opcode, created on first use.
+        self.ops = {}
+
+    """
+        Gets the counters of an opcode.
+        \ op: the opcode.
+    """
+    def op (self, op):
+        stats = self.ops.get (op)
+        if stats == None:
+            stats = self.ops[op] = OpStats ()
+
+        return stats
+
+    """
+        Counts a sent frame.
+        \ op: the opcode.
+        \ nbytes: the frame size.
+    """
+    def sent (self, op, nbytes):
+        stats = self.op (op)
+        stats.frames_sent += 1
+        stats.bytes_sent += nbytes
+        self.bytes_sent += nbytes
+
+    """
+        Records the round-trip time of a request.
+        \ op: the request opcode.
+        \ ns: the latency.
+    """
+    def record_latency (self, op, ns):
+        self.op (op).latency.record (ns)
+
+    """
+        Counts a received frame, the bytes are counted as they're read.
+        \ op: the opcode.
+        \ nbytes: the frame size.
+    """
+    def received (self, op, nbytes):
+        stats = self.op (op)
+        stats.frames_received += 1
+        stats.bytes_received += nbytes
+
+    def as_dict (self):
+        return {
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "parse_errors": self.parse_errors,
+            "unexpected_frames": self.unexpected_frames,
+            "rejected_connections": self.rejected_connections,
+            "ops": { op_name (op): stats.as_dict () for op, stats in sorted (self.ops.items ()) },
+        }
+
+    """
+        Yields Prometheus samples as (name, type, help, labels, value).
+    """
+    def samples (self):
+        yield "project_a_control_sent_bytes_total", "counter", "Bytes sent to the device.", {}, self.bytes_sent
+        yield "project_a_control_received_bytes_total", "counter", "Bytes received from the device.", {}, self.bytes_received
+        yield "project_a_control_parse_errors_total", "counter", "Frames or responses which could not be parsed.", {}, self.parse_errors
+        yield "project_a_control_unexpected_frames_total", "counter", "Frames which answered no outstanding request.", {}, self.unexpected_frames
+        yield "project_a_control_rejected_connections_total", "counter", "Rejected protocol connection requests.", {}, self.rejected_connections
+
+        for op, stats in sorted (self.ops.items ()):
+            labels = { "op": op_name (op) }
+
+            if stats.frames_sent > 0:
+                yield "project_a_control_sent_frames_total", "counter", "Frames sent, per op.", labels, stats.frames_sent
+            if stats.frames_received > 0:
+                yield "project_a_control_received_frames_total", "counter", "Frames received, per op.", labels, stats.frames_received
+
+            if stats.latency.count == 0:
+                continue
+
+            for quantile in STATS_QUANTILES:
+                yield "project_a_control_latency_seconds", "summary", "Request latency, per op.", dict (labels, quantile = quantile), stats.latency.quantile (quantile) / 1e9
+
+            yield "project_a_control_latency_seconds_sum", None, None, labels, stats.latency.total / 1e9
+            yield "project_a_control_latency_seconds_count", None, None, labels, stats.latency.count
+
+class DiscoveryStats:
+    """
+        Creates new discovery statistics, accumulated over all discovery runs.
+    """
+    def __init__ (self):
+        self.runs = 0
+        self.packets_sent = 0
+        self.responses_received = 0
+        self.invalid_responses = 0
+        self.duplicate_responses = 0
+        self.devices = 0
+
+        # Seconds from sending the first packet to the first device, of the last run.
+        self.first_device_seconds = None
+        self.first_device = LatencyHistogram ()
+
+    """
+        Counts the first device of a discovery run.
+        \ seconds: the time since the run started.
+    """
+    def found_first (self, seconds):
+        self.first_device_seconds = seconds
+        self.first_device.record (int (seconds * 1e9))
+
+    def as_dict (self):
+        return {
+            "runs": self.runs,
+            "packets_sent": self.packets_sent,
+            "responses_received": self.responses_received,
+            "invalid_responses": self.invalid_responses,
+            "duplicate_responses": self.duplicate_responses,
+            "devices": self.devices,
+            "first_device_seconds": self.first_device_seconds,
+            "first_device_ns": self.first_device.as_dict (),
+        }
+
+    """
+        Yields Prometheus samples as (name, type, help, labels, value).
+    """
+    def samples (self):
+        yield "project_a_discovery_runs_total", "counter", "Discovery runs started.", {}, self.runs
+        yield "project_a_discovery_sent_packets_total", "counter", "Discovery requests sent.", {}, self.packets_sent
+        yield "project_a_discovery_responses_total", "counter", "Discovery responses received.", {}, self.responses_received
+        yield "project_a_discovery_invalid_responses_total", "counter", "Discovery responses which were not from a device.", {}, self.invalid_responses
+        yield "project_a_discovery_duplicate_responses_total", "counter", "Discovery responses from already discovered devices.", {}, self.duplicate_responses
+        yield "project_a_discovery_devices", "gauge", "Devices found by the last run.", {}, self.devices
+
+        if self.first_device_seconds != None:
+            yield "project_a_discovery_first_device_seconds", "gauge", "Time to the first device of the last run.", {}, self.first_device_seconds
+
+class StatsRegistry:
+    """
+        Creates new registry, which renders the statistics of any number of Controls and
+         Discoveries in the Prometheus text format. Sources are held weakly, so they
+         drop out once they're gone.
+    """
+    def __init__ (self):
+        self._lock = threading.Lock ()
+        self._sources = []
+
+    """
+        Registers a Control or Discovery.
+        \ source: anything with a _stats having samples ().
+        \ labels: extra labels for all its samples, like host and port.
+    """
+    def register (self, source, **labels):
+        with self._lock:
+            self._sources.append ((weakref.ref (source), labels))
+
+    """
+        Renders all sources in the Prometheus text exposition format.
+    """
+    def render (self):
+        with self._lock:
+            self._sources = [ (ref, labels) for ref, labels in self._sources if ref () != None ]
+            sources = list (self._sources)
+
+        # Samples of the same metric must be grouped, under a single HELP / TYPE.
+        metrics = {}
+        for ref, labels in sources:
+            source = ref ()
+            if source == None:
+                continue
+
+            for name, kind, description, sample_labels, value in source._stats.samples ():
+                family = metrics.setdefault (name, [ kind, description, [] ])
+                family[2].append ((dict (labels, **sample_labels), value))
+
+        lines = []
+        for name, (kind, description, samples) in metrics.items ():
+            if description != None:
+                lines.append (f"# HELP {name} {description}")
+                lines.append (f"# TYPE {name} {kind}")
+
+            for labels, value in samples:
+                lines.append (f"{name}{_format_labels (labels)} {value}")
+
+        return "\n".join (lines) + "\n"
+
+class _StatsRequestHandler (http.server.BaseHTTPRequestHandler):
+    def do_GET (self):
+        if self.path != "/metrics":
+            self.send_error (404)
+            return
+
+        body = self.server.registry.render ().encode ("utf8")
+
+        self.send_response (200)
+        self.send_header ("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header ("Content-Length", str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def log_message (self, format, *args):
+        pass
+
+class StatsServer:
+    """
+        Creates new HTTP server, which serves a StatsRegistry on /metrics for Prometheus,
+         from a daemon thread. Only binds to localhost by default.
+        \ registry: the StatsRegistry.
+        \ host: the address to bind to.
+        \ port: the port to bind to.
+    """
+    def __init__ (self, registry, host = STATS_HTTP_HOST, port = STATS_HTTP_PORT):
+        self._server = http.server.ThreadingHTTPServer ((host, port), _StatsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+
+        self._thread = threading.Thread (target = self._server.serve_forever, name = "stats-http", daemon = True)
+        self._thread.start ()
+
+    """
+        Gets the (host, port) the server listens on.
+    """
+    def address (self):
+        return self._server.server_address
+
+    """
+        Stops the server.
+    """
+    def close (self):
+        self._server.shutdown ()
+        self._server.server_close ()
+        self._thread.join ()
@@ -0,0 +1,243 @@
+#!/bin/python3
+
+"""
+Copyright 2021 Luke A.C.A. Rieff
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import threading
+
+####
+## Global Constants
+####
+
+# The StepperState fields compared for changes, motor identifies the stepper itself.
+TELEMETRY_FIELDS = ("flags", "target_pos", "current_pos", "min_speed", "current_speed", "max_speed")
+
+####
+## Classes
+####
+
+class StepperDelta:
+    """
+        Creates new stepper delta, the fields of one stepper which changed.
+        \ motor: the stepper index.
+        \ changes: dict of field name to the new value.
+    """
+    __slots__ = ("motor", "changes")
+
+    def __init__ (self, motor, changes):
+        self.motor = motor
+        self.changes = changes
+
+    def __repr__ (self):
+        return f"StepperDelta(motor={self.motor}, changes={self.changes})"
+
+class TelemetrySubscription:
+    """
+        Creates new callback subscription.
+        \ bus: the TelemetryBus.
+        \ callback: called with (key, deltas) on the publishing thread.
+        \ key: only deliver this device, or None for all devices.
+    """
+    def __init__ (self, bus, callback, key):
+        self._bus = bus
+        self._callback = callback
+        self._key = key
+
+    def _push (self, key, deltas):
+        self._callback (key, deltas)
+
+    """
+        Stops the delivery.
+    """
+    def close (self):
+        self._bus._unsubscribe (self)
+
+class TelemetryStream:
+    """
+        Creates new async iterator subscription, yielding (key, deltas). Deltas which
+         arrive while the consumer is busy are merged per stepper, so a slow consumer
+         skips intermediate values but never misses a change, and memory stays bounded.
+        \ bus: the TelemetryBus.
+        \ key: only deliver this device, or None for all devices.
+        \ loop: the event loop the consumer runs on.
+    """
+    def __init__ (self, bus, key, loop):
+        self._bus = bus
+        self._key = key
+        self._loop = loop
+        self._pending = {}
+        self._event = asyncio.Event ()
+        self._closed = False
+
+    def _push (self, key, deltas):
+        # The publisher may run on another thread, so merging happens on our loop.
+        self._loop.call_soon_threadsafe (self._merge, key, deltas)
+
+    def _merge (self, key, deltas):
+        pending = self._pending.setdefault (key, {})
+
+        for delta in deltas:
+            merged = pending.get (delta.motor)
+            if merged == None:
+                pending[delta.motor] = StepperDelta (delta.motor, dict (delta.changes))
+            else:
+                merged.changes.update (delta.changes)
+
+        self._event.set ()
+
+    def __aiter__ (self):
+        return self
+
+    async def __anext__ (self):
+        while len (self._pending) == 0:
+            if self._closed:
+                raise StopAsyncIteration
+
+            self._event.clear ()
+            await self._event.wait ()
+
+        key = next (iter (self._pending))
+        return key, list (self._pending.pop (key).values ())
+
+    """
+        Stops the delivery, the iteration ends once the pending deltas are consumed.
+    """
+    def close (self):
+        self._bus._unsubscribe (self)
+        self._closed = True
+        self._loop.call_soon_threadsafe (self._event.set)
+
+class TelemetryBus:
+    """
+        Creates new telemetry bus, which turns the snapshots of each device into per-stepper
+         deltas, and fans them out to any number of in-process subscribers. Each device
+         only has to be polled once, no matter how many consumers there are.
+        \ silent: don't print failing subscribers.
+    """
+    def __init__ (self, silent = True):
+        self._silent = silent
+        self._lock = threading.Lock ()
+        self._subscribers = []
+        self._last = {}
+
+    """
+        Subscribes a callback.
+        \ callback: called with (key, deltas) on the publishing thread.
+        \ key: only deliver this device, or None for all devices.
+    """
+    def subscribe (self, callback, key = None):
+        subscription = TelemetrySubscription (self, callback, key)
+
+        with self._lock:
+            self._subscribers = self._subscribers + [ subscription ]
+
+        return subscription
+
+    """
+        Subscribes an async iterator, on the running event loop.
+        \ key: only deliver this device, or None for all devices.
+    """
+    def stream (self, key = None):
+        stream = TelemetryStream (self, key, asyncio.get_running_loop ())
+
+        with self._lock:
+            self._subscribers = self._subscribers + [ stream ]
+
+        return stream
+
+    def _unsubscribe (self, subscriber):
+        with self._lock:
+            self._subscribers = [ other for other in self._subscribers if other != subscriber ]
+
+    """
+        Gets the last published values of a device, as a list of (motor, *TELEMETRY_FIELDS).
+        \ key: the device key.
+    """
+    def last (self, key):
+        return list (self._last.get (key, {}).values ())
+
+    """
+        Publishes a new snapshot of a device, and delivers whatever changed.
+        \ key: the device key.
+        \ snapshot: the DeviceSnapshot.
+    """
+    def publish (self, key, snapshot):
+        with self._lock:
+            last = self._last.setdefault (key, {})
+            deltas = []
+
+            for state in snapshot.steppers:
+                values = (state.motor, state.flags, state.target_pos, state.current_pos, state.min_speed, state.current_speed, state.max_speed)
+                previous = last.get (state.motor)
+
+                if previous == values:
+                    continue
+
+                # The first time we see a stepper, everything counts as changed.
+                if previous == None:
+                    changes = dict (zip (TELEMETRY_FIELDS, values[1:]))
+                else:
+                    changes = { name: value for name, old, value in zip (TELEMETRY_FIELDS, previous[1:], values[1:]) if old != value }
+
+                last[state.motor] = values
+                deltas.append (StepperDelta (state.motor, changes))
+
+            subscribers = self._subscribers
+
+        if len (deltas) == 0:
+            return deltas
+
+        # A failing subscriber doesn't keep the deltas from the others, nor fails the publisher.
+        for subscriber in subscribers:
+            if subscriber._key == None or subscriber._key == key:
+                try:
+                    subscriber._push (key, deltas)
+                except Exception as e:
+                    if not self._silent:
+                        print (f"Telemetry subscriber failed: {e}")
+
+        return deltas
+
+    """
+        Forgets a device, so its next snapshot is delivered in full.
+        \ key: the device key.
+    """
+    def forget (self, key):
+        with self._lock:
+            self._last.pop (key, None)
+
+    """
+        Polls a Control once, and publishes the result.
+        \ key: the device key.
+        \ control: the connected Control.
+        \ snapshot: the DeviceSnapshot to reuse.
+    """
+    def poll (self, key, control, snapshot = None):
+        snapshot = control.get_stepper_state (snapshot)
+        if snapshot != None:
+            self.publish (key, snapshot)
+
+        return snapshot
+
+    """
+        Polls all devices of a ControlPool on the schedule of a PollScheduler, and
+         publishes every result, until cancelled.
+        \ pool: the ControlPool.
+        \ scheduler: the PollScheduler.
+    """
+    async def run (self, pool, scheduler):
+        await scheduler.run (pool, self.publish)